@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+"""Asyncio pipeline to process the log files with overlapped stages.
+
+The log files are processed by four stages connected by bounded
+queues, each stage works on a different file (or chunk) at the same
+time, so the next file is parsed while the records of the current one
+are sent to the database:
+
+    * read: Read the log JSON file (or its chunks) into a dataframe.
+    * transform: Prepare the time, user and songplays records
+      ('etl.transform_log_frame').
+    * lookup: Find the song IDs and artist IDs ('etl.resolve_song_ids'),
+      on its own pooled connection if the SQL search is used.
+    * write: Insert the records ('etl.write_log_data') and commit the
+      files with the manifest as the commit policy requires
+      ('transactions.FileTransactions').
+
+The blocking work of each stage runs in a thread, when a queue is full
+the previous stage waits, so the memory used is capped by the queues
+size.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import asyncio
+import contextlib
+
+# Third-party imports
+import pandas as pd
+
+# Propietary imports
+import database
+import dedup
+import etl
+import loaders
+import metrics
+import parse_cache
+import transactions
+
+# Files (or chunks) waiting between two stages
+DEFAULT_QUEUE_SIZE = 2
+
+async def read_stage(all_files, output, chunk_size=None):
+    """Read the log files and send the events to the next stage.
+
+    The whole files are read from the parse cache, if it is enabled
+    ('parse_cache.read_json'), the files read by chunks are parsed.
+
+    Parameters
+    ----------
+    all_files : String List
+        description -> The JSON files location as full paths
+        format -> No apply
+        options -> No apply
+
+    output : asyncio.Queue Instance
+        description -> Queue of the transform stage
+        format -> Items: (<file_path>, Pandas Dataframe), the dataframe
+            is 'None' at the end of each file and the item is 'None'
+            at the end of the files
+        options -> No apply
+
+    chunk_size : Integer
+        description -> Number of events read at once
+        format -> No apply
+        options -> 'None': Read the whole file at once.
+    """
+    for datafile in all_files:
+        if chunk_size is None:
+            logs_df = await asyncio.to_thread(
+                parse_cache.read_json, datafile
+            )
+            await output.put((datafile, logs_df))
+        else:
+            reader = await asyncio.to_thread(
+                pd.read_json, datafile, lines=True, chunksize=chunk_size
+            )
+            with reader:
+                while True:
+                    logs_df = await asyncio.to_thread(next, reader, None)
+                    if logs_df is None:
+                        break
+                    await output.put((datafile, logs_df))
+        await output.put((datafile, None))
+    await output.put(None)
+
+async def transform_stage(source, output, chunked=False):
+    """Prepare the records of the events and send them to the next stage.
+
+    Parameters
+    ----------
+    source : asyncio.Queue Instance
+        description -> Queue filled by the read stage
+        format -> No apply
+        options -> No apply
+
+    output : asyncio.Queue Instance
+        description -> Queue of the lookup stage
+        format -> Items: (<file_path>, Dictionary), the dictionary is
+            'None' at the end of each file and the item is 'None' at
+            the end of the files
+        options -> No apply
+
+    chunked : bool
+        description -> The files are read by chunks, the duplicated
+            records between chunks of the same file are dropped
+        format -> No apply
+        options -> No apply
+    """
+    dedup_state = None
+    while True:
+        item = await source.get()
+        if item is None:
+            break
+        datafile, logs_df = item
+        if logs_df is None:
+            dedup_state = None
+            await output.put((datafile, None))
+            continue
+
+        if chunked and dedup_state is None:
+            dedup_state = dedup.LogDedupState()
+        log_data = await asyncio.to_thread(
+            etl.transform_log_frame, logs_df, dedup_state
+        )
+        del logs_df
+        await output.put((datafile, log_data))
+    await output.put(None)
+
+async def lookup_stage(source, output, cur=None, lookup_index=None):
+    """Find the song IDs and artist IDs and send the records to write.
+
+    Parameters
+    ----------
+    source : asyncio.Queue Instance
+        description -> Queue filled by the transform stage
+        format -> No apply
+        options -> No apply
+
+    output : asyncio.Queue Instance
+        description -> Queue of the write stage
+        format -> Same items of the source queue
+        options -> No apply
+
+    cur : PostgreSQL Cursor Instance
+        description -> Cursor of the lookup connection
+        format -> No apply
+        options -> 'None': Only allowed with the in-memory index.
+
+    lookup_index : lookup.SongLookupIndex Instance
+        description -> In-memory index of the songs and artists
+        format -> No apply
+        options -> 'None': The song IDs and artist IDs are searched
+            with SQL statements.
+    """
+    while True:
+        item = await source.get()
+        if item is None:
+            break
+        datafile, log_data = item
+        if log_data is not None:
+            log_data["songplay"] = await asyncio.to_thread(
+                etl.resolve_song_ids,
+                cur,
+                log_data["songplay"],
+                lookup_index
+            )
+            if cur is not None:
+                # end the read-only transaction of the search
+                await asyncio.to_thread(cur.connection.rollback)
+        await output.put((datafile, log_data))
+    await output.put(None)
+
+async def write_stage(
+    source,
+    cur,
+    conn,
+    num_files,
+    engine=loaders.DEFAULT_ENGINE,
+    manifest=None,
+    run_cache=None,
+    partitions=None,
+    rollups=False,
+    commit_policy=None,
+    batch_commit=True
+):
+    """Insert the records and commit the files.
+
+    Each file is loaded inside a savepoint if the commit policy keeps
+    many files in a transaction, the remaining chunks of a file rolled
+    back are skipped.
+
+    Parameters
+    ----------
+    source : asyncio.Queue Instance
+        description -> Queue filled by the lookup stage
+        format -> No apply
+        options -> No apply
+
+    cur : PostgreSQL Cursor Instance
+        description -> Cursor of the writer connection
+        format -> No apply
+        options -> No apply
+
+    conn : PostgreSQL Connection Instance
+        description -> The writer connection
+        format -> No apply
+        options -> No apply
+
+    num_files : Integer
+        description -> Number of files to process, used by the progress
+            messages
+        format -> No apply
+        options -> No apply
+
+    engine : String
+        description -> The load engine used to insert the records
+        format -> No apply
+        options -> {'copy', 'execute_values', 'values'}
+
+    manifest : manifest.IngestManifest Instance
+        description -> The manifest of the ingested files
+        format -> No apply
+        options -> 'None': Only commit.
+
+    run_cache : dedup.RunDedupCache Instance
+        description -> The time and user records sent during the run
+        format -> No apply
+        options -> 'None': Send all the records.
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay'
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    rollups : bool
+        description -> Refresh the rollups of 'songplay' in each commit
+        format -> No apply
+        options -> No apply
+
+    commit_policy : transactions.CommitPolicy Instance
+        description -> When the loaded files are committed
+        format -> No apply
+        options -> 'None': Commit each file ('batch').
+
+    batch_commit : bool
+        description -> Commit each batch of records
+        format -> No apply
+        options -> 'False': Only the policy commits.
+
+    Returns
+    -------
+    failed : String List
+        description -> The files rolled back
+        format -> No apply
+        options -> No apply
+    """
+    file_transactions = transactions.FileTransactions(
+        conn,
+        commit_policy,
+        manifest=manifest,
+        rollups=rollups,
+        on_rollback=lambda cur: etl.reset_run_state(
+            cur, run_cache=run_cache, partitions=partitions
+        )
+    )
+    processed = 0
+    row_counts = {}
+    started = failed = None
+    while True:
+        item = await source.get()
+        if item is None:
+            break
+        datafile, log_data = item
+        if datafile == failed:
+            if log_data is None:
+                processed += 1
+            continue
+        if started != datafile:
+            await asyncio.to_thread(file_transactions.begin, [datafile])
+            started = datafile
+        if log_data is not None:
+            try:
+                chunk_counts = await asyncio.to_thread(
+                    etl.write_log_data,
+                    cur,
+                    log_data,
+                    conn,
+                    engine,
+                    run_cache,
+                    partitions,
+                    batch_commit
+                )
+            except Exception as error:
+                await asyncio.to_thread(
+                    file_transactions.rollback, [datafile], error
+                )
+                row_counts = {}
+                failed = datafile
+                continue
+            for table, records in chunk_counts.items():
+                row_counts[table] = row_counts.get(table, 0) + records
+            continue
+
+        await asyncio.to_thread(
+            file_transactions.release, [(datafile, row_counts)]
+        )
+        row_counts = {}
+        processed += 1
+        print('{}/{} files processed.'.format(processed, num_files))
+    await asyncio.to_thread(file_transactions.close)
+
+    return file_transactions.failed
+
+async def run_log_pipeline(
+    conn,
+    all_files,
+    lookup_conn=None,
+    engine=loaders.DEFAULT_ENGINE,
+    lookup_index=None,
+    manifest=None,
+    chunk_size=None,
+    queue_size=DEFAULT_QUEUE_SIZE,
+    run_cache=None,
+    partitions=None,
+    rollups=False,
+    commit_policy=None,
+    batch_commit=True
+):
+    """Process the log files with the four stages running concurrently.
+
+    If a stage fails, the other stages are cancelled and the error is
+    raised, the files committed before the failure are kept.
+
+    Parameters
+    ----------
+    conn : PostgreSQL Connection Instance
+        description -> The writer connection
+        format -> No apply
+        options -> No apply
+
+    all_files : String List
+        description -> The log JSON files location as full paths
+        format -> No apply
+        options -> No apply
+
+    lookup_conn : PostgreSQL Connection Instance
+        description -> The connection used by the lookup stage
+        format -> No apply
+        options -> 'None': Only allowed with the in-memory index.
+
+    engine : String
+        description -> The load engine used to insert the records
+        format -> No apply
+        options -> {'copy', 'execute_values', 'values'}
+
+    lookup_index : lookup.SongLookupIndex Instance
+        description -> In-memory index of the songs and artists
+        format -> No apply
+        options -> 'None': The song IDs and artist IDs are searched
+            with SQL statements.
+
+    manifest : manifest.IngestManifest Instance
+        description -> The manifest of the ingested files
+        format -> No apply
+        options -> 'None': Only commit.
+
+    chunk_size : Integer
+        description -> Number of events read at once
+        format -> No apply
+        options -> 'None': Read the whole file at once.
+
+    queue_size : Integer
+        description -> Files (or chunks) waiting between two stages
+        format -> No apply
+        options -> No apply
+
+    run_cache : dedup.RunDedupCache Instance
+        description -> The time and user records sent during the run,
+            the records sent by previous files are dropped
+        format -> No apply
+        options -> 'None': Send all the records.
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay', the
+            partitions of new months are created by the write stage
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    rollups : bool
+        description -> Refresh the rollups of 'songplay' in each commit
+            ('rollups.refresh')
+        format -> No apply
+        options -> No apply
+
+    commit_policy : transactions.CommitPolicy Instance
+        description -> When the loaded files are committed, the files
+            are isolated with savepoints if many files are committed
+            together
+        format -> No apply
+        options -> 'None': Commit each file ('batch').
+
+    batch_commit : bool
+        description -> Commit each batch of records
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    failed : String List
+        description -> The files rolled back
+        format -> No apply
+        options -> No apply
+    """
+    events = asyncio.Queue(maxsize=queue_size)
+    records = asyncio.Queue(maxsize=queue_size)
+    resolved = asyncio.Queue(maxsize=queue_size)
+    lookup_cur = None if lookup_conn is None else lookup_conn.cursor()
+    cur = conn.cursor()
+
+    tasks = [
+        asyncio.ensure_future(read_stage(all_files, events, chunk_size)),
+        asyncio.ensure_future(
+            transform_stage(events, records, chunked=chunk_size is not None)
+        ),
+        asyncio.ensure_future(
+            lookup_stage(records, resolved, lookup_cur, lookup_index)
+        ),
+        asyncio.ensure_future(
+            write_stage(
+                resolved,
+                cur,
+                conn,
+                len(all_files),
+                engine,
+                manifest,
+                run_cache,
+                partitions,
+                rollups,
+                commit_policy,
+                batch_commit
+            )
+        )
+    ]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        cur.close()
+        if lookup_cur is not None:
+            lookup_cur.close()
+
+    return results[-1]
+
+def process_log_files(
+    cur,
+    conn,
+    filepath,
+    db_pool=None,
+    manifest=None,
+    **kwargs
+):
+    """Read the log files directory and process it with the pipeline.
+
+    * Get the list of JSON files in the given 'filepath'.
+    * Skip the files already ingested, if a manifest is given, the
+      songplays of the previous load of the changed files are deleted.
+    * Take a lookup connection from the pool, if the SQL search of
+      song IDs is used, the writer connection is never shared with
+      the lookup stage.
+    * Run the pipeline ('run_log_pipeline') until all the files are
+      committed.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor of the writer connection
+        format -> No apply
+        options -> No apply
+
+    conn : PostgreSQL Connection Instance
+        description -> The writer connection
+        format -> No apply
+        options -> No apply
+
+    filepath : String
+        description -> The path to the log files
+        format -> No apply
+        options -> 'data/log_data'
+
+    db_pool : database.ConnectionPool Instance
+        description -> The pool used to take the lookup connection
+        format -> No apply
+        options -> 'None': Open a lookup connection out of the pool.
+
+    manifest : manifest.IngestManifest Instance
+        description -> The manifest of the ingested files
+        format -> No apply
+        options -> 'None': Process all the files.
+
+    kwargs : Keyword Arguments
+        description -> Extra options given to 'run_log_pipeline'
+        format -> No apply
+        options -> {
+            engine,
+            lookup_index,
+            chunk_size,
+            queue_size,
+            run_cache,
+            partitions,
+            rollups,
+            commit_policy,
+            batch_commit
+        }
+
+    Returns
+    -------
+    failed : String List
+        description -> The files rolled back
+        format -> No apply
+        options -> No apply
+    """
+    all_files = etl.list_files(filepath)
+    print('{} files found in {}'.format(len(all_files), filepath))
+    if manifest is not None:
+        all_files = manifest.pending_files(cur, all_files)
+        etl.rebuild_changed_rollups(
+            cur, manifest, kwargs.get("rollups", False)
+        )
+        conn.commit()
+        print('{} new or changed files to process.'.format(len(all_files)))
+
+    lookup_index = kwargs.get("lookup_index")
+    sql_lookup = lookup_index is None or lookup_index.overflow
+    with contextlib.ExitStack() as stack:
+        lookup_conn = None
+        if sql_lookup and db_pool is not None:
+            lookup_conn = stack.enter_context(db_pool.connection())
+        elif sql_lookup:
+            connection_factory = None
+            if metrics.enabled():
+                connection_factory = metrics.MetricsConnection
+            lookup_conn = stack.enter_context(
+                contextlib.closing(
+                    database.connect(connection_factory=connection_factory)
+                )
+            )
+        failed = asyncio.run(
+            run_log_pipeline(
+                conn,
+                all_files,
+                lookup_conn=lookup_conn,
+                manifest=manifest,
+                **kwargs
+            )
+        )
+
+    return failed
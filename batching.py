@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""Batches of records sent by each statement of the load and lookup.
+
+By default each statement sends up to 'FIXED_BATCH_ROWS' records. With
+the adaptive batches enabled ('enable'), the records of each table (or
+of the song IDs search) are batched by an 'AdaptiveBatcher':
+
+    * Size: The width of the records is estimated from a sample of
+      each dataframe, the batch fits in a target payload size, so a
+      'songplay' batch (long 'user_agent') has fewer records than a
+      'time' batch.
+    * Latency: The time of each batch is measured, the batch is
+      limited to the records processed in a target time.
+
+The batch size moves towards the smallest of both limits, at most
+doubling or halving after each full batch and always within the
+minimum and maximum records, the sizes settled on are reported at the
+end of the run ('report').
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import time
+
+# Third-party imports
+# None
+
+# Propietary imports
+# None
+
+# Records of each batch without the adaptive batches
+FIXED_BATCH_ROWS = 5_000
+
+DEFAULT_TARGET_BYTES = 2 * 2**20
+DEFAULT_TARGET_SECONDS = 0.5
+DEFAULT_MIN_ROWS = 500
+DEFAULT_MAX_ROWS = 50_000
+
+# Records sampled to estimate the width of the records
+SAMPLE_ROWS = 100
+
+# Weight of the last measure in the moving averages
+SMOOTHING = 0.3
+
+_batcher = None
+
+class BatchState():
+    """Batch size and measures of one table.
+
+    Attributes
+    ----------
+    rows : Integer
+        description -> Records of the next batch
+        format -> No apply
+        options -> No apply
+
+    row_bytes : Float
+        description -> Moving average of the width of the records
+        format -> Bytes
+        options -> 'None': Not estimated yet.
+
+    rows_per_second : Float
+        description -> Moving average of the records processed by second
+        format -> No apply
+        options -> 'None': Not measured yet.
+
+    batches : Integer
+        description -> Batches processed
+        format -> No apply
+        options -> No apply
+
+    seconds : Float
+        description -> Time of the processed batches
+        format -> Seconds
+        options -> No apply
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.row_bytes = None
+        self.rows_per_second = None
+        self.batches = 0
+        self.seconds = 0.0
+
+class AdaptiveBatcher():
+    """Rows per batch of each table, adapted to its records and latency.
+
+    Attributes
+    ----------
+    target_bytes : Integer
+        description -> Approximate payload size of each batch
+        format -> Bytes
+        options -> No apply
+
+    target_seconds : Float
+        description -> Approximate time of each batch
+        format -> Seconds
+        options -> No apply
+
+    min_rows, max_rows : Integer
+        description -> Limits of the records of each batch
+        format -> No apply
+        options -> No apply
+
+    states : Dictionary
+        description -> The batch state of each table
+        format -> {<table>: BatchState Instance}
+        options -> No apply
+
+    Methods
+    -------
+    batches : Method
+        Split a dataframe in batches, measuring each one.
+
+    report : Method
+        Batch sizes settled on by table.
+    """
+    def __init__(
+        self,
+        target_bytes=DEFAULT_TARGET_BYTES,
+        target_seconds=DEFAULT_TARGET_SECONDS,
+        min_rows=DEFAULT_MIN_ROWS,
+        max_rows=DEFAULT_MAX_ROWS
+    ):
+        if not 0 < min_rows <= max_rows:
+            raise ValueError("the batch limits require 0 < min <= max")
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.states = {}
+
+    def batches(self, table, dataframe):
+        """Split a dataframe in batches, measuring each one.
+
+        The time of a batch is measured until the next batch is
+        requested, so it includes the statement that sends it.
+
+        Parameters
+        ----------
+        table : String
+            description -> The table (or stage) of the records
+            format -> No apply
+            options -> e.g. {'time', 'users', 'songplay', 'lookup'}
+
+        dataframe : Pandas Dataframe
+            description -> The records to split
+            format -> No apply
+            options -> No apply
+
+        Yields
+        ------
+        batch : Pandas Dataframe
+            description -> The records of each batch, in order
+            format -> Same headers of the given dataframe
+            options -> No apply
+        """
+        state = self.states.get(table)
+        if state is None:
+            state = BatchState(
+                min(max(FIXED_BATCH_ROWS, self.min_rows), self.max_rows)
+            )
+            self.states[table] = state
+        if dataframe.empty:
+            return
+        self._estimate_width(state, dataframe)
+
+        index = 0
+        while index < len(dataframe):
+            rows = state.rows
+            batch = dataframe.iloc[index:index + rows]
+            start = time.perf_counter()
+            yield batch
+            seconds = time.perf_counter() - start
+            state.batches += 1
+            state.seconds += seconds
+            if len(batch) == rows:
+                self._adapt(state, rows, seconds)
+            index += len(batch)
+
+    def report(self):
+        """Batch sizes settled on by table.
+
+        Returns
+        -------
+        report : Dictionary
+            description -> The batch state of each table
+            format -> {<table>: {"rows": <records>, "row_bytes": <bytes>,
+                       "batches": <batches>, "mean_s": <seconds>}}
+            options -> No apply
+        """
+        return {
+            table: {
+                "rows": state.rows,
+                "row_bytes": round(state.row_bytes or 0.0, 1),
+                "batches": state.batches,
+                "mean_s": round(state.seconds / max(state.batches, 1), 6)
+            }
+            for table, state in self.states.items()
+        }
+
+    def _estimate_width(self, state, dataframe):
+        """Update the width of the records with a sample."""
+        sample = dataframe.iloc[:SAMPLE_ROWS].astype(str)
+        # one separator by value
+        widths = sample.apply(lambda column: column.str.len() + 1)
+        row_bytes = float(widths.sum(axis=1).mean())
+        if state.row_bytes is None:
+            state.row_bytes = row_bytes
+            state.rows = self._limit(state.rows, self._size_rows(state))
+        else:
+            state.row_bytes += SMOOTHING * (row_bytes - state.row_bytes)
+
+    def _adapt(self, state, rows, seconds):
+        """Move the batch size towards the size and latency limits."""
+        rows_per_second = rows / max(seconds, 1e-6)
+        if state.rows_per_second is None:
+            state.rows_per_second = rows_per_second
+        else:
+            state.rows_per_second += SMOOTHING * (
+                rows_per_second - state.rows_per_second
+            )
+        wanted = min(
+            self._size_rows(state),
+            state.rows_per_second * self.target_seconds
+        )
+        state.rows = self._limit(rows, wanted)
+
+    def _size_rows(self, state):
+        """Records that fit in the target payload size."""
+        return self.target_bytes / max(state.row_bytes, 1.0)
+
+    def _limit(self, rows, wanted):
+        """Limit a new batch size to double or half the current one."""
+        wanted = min(max(wanted, rows / 2), rows * 2)
+
+        return int(min(max(wanted, self.min_rows), self.max_rows))
+
+def enable(**kwargs):
+    """Batch the records with an 'AdaptiveBatcher'.
+
+    Parameters
+    ----------
+    kwargs : Keyword Arguments
+        description -> Options of the batcher
+        format -> No apply
+        options -> {target_bytes, target_seconds, min_rows, max_rows}
+
+    Returns
+    -------
+    batcher : AdaptiveBatcher Instance
+        description -> The enabled batcher
+        format -> No apply
+        options -> No apply
+    """
+    global _batcher
+    _batcher = AdaptiveBatcher(**kwargs)
+
+    return _batcher
+
+def enabled():
+    """'True' if the adaptive batches are enabled."""
+    return _batcher is not None
+
+def close():
+    """Go back to the fixed batches."""
+    global _batcher
+    _batcher = None
+
+def report():
+    """Batch sizes settled on by the enabled batcher.
+
+    See 'AdaptiveBatcher.report'.
+
+    Returns
+    -------
+    report : Dictionary
+        description -> The batch state of each table
+        format -> {<table>: {"rows": <records>, "row_bytes": <bytes>,
+                   "batches": <batches>, "mean_s": <seconds>}}
+        options -> Empty if the adaptive batches are disabled.
+    """
+    if _batcher is None:
+        return {}
+
+    return _batcher.report()
+
+def batches(table, dataframe):
+    """Split a dataframe in the batches sent by each statement.
+
+    Parameters
+    ----------
+    table : String
+        description -> The table (or stage) of the records
+        format -> No apply
+        options -> e.g. {'time', 'users', 'songplay', 'lookup'}
+
+    dataframe : Pandas Dataframe
+        description -> The records to split
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    batches : Iterator
+        description -> The batches in order, of 'FIXED_BATCH_ROWS'
+            records if the adaptive batches are disabled
+        format -> Pandas Dataframe
+        options -> No apply
+    """
+    if _batcher is not None:
+        return _batcher.batches(table, dataframe)
+
+    return (
+        dataframe.iloc[index:index + FIXED_BATCH_ROWS]
+        for index in range(0, len(dataframe), FIXED_BATCH_ROWS)
+    )
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the ETL pipeline.
+
+Each module is executed from the project root directory, e.g.:
+
+    python -m benchmarks.time_dimension
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""End-to-end benchmark of the ETL pipeline.
+
+Runs the complete pipeline over a dataset (e.g. one written by
+'benchmarks.generate_dataset') against the database configured in
+'database.cfg' and reports each phase:
+
+    * 'create_tables': Drop and create the database and the tables
+      ('create_tables.main').
+    * 'songs': Process the song files.
+    * 'logs': Process the log files.
+
+For each phase the wall time, the records by table, the records per
+second by table and the number of statements sent are saved, together
+with the peak resident memory of the run, in a JSON file, so the runs
+can be compared.
+
+    python -m benchmarks.etl_end_to_end --data data_bench \\
+        --output bench_results.json --engine copy
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+# Third-party imports
+import psycopg2.extensions
+
+# Propietary imports
+import create_tables
+import database
+import etl
+import loaders
+
+# Tables loaded by each phase
+PHASE_TABLES = {
+    "songs": ["artists", "songs"],
+    "logs": ["\"time\"", "users", "songplay"]
+}
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the statements sent to the server.
+
+    Attributes
+    ----------
+    statements : Integer
+        description -> Statements sent by all the counting cursors,
+            class attribute
+        format -> No apply
+        options -> No apply
+
+    Methods
+    -------
+    execute : Method
+        Execute a statement, counting it.
+
+    executemany : Method
+        Execute a statement once by parameters, counting each one.
+
+    copy_expert : Method
+        Execute a 'COPY' statement, counting it.
+    """
+    statements = 0
+
+    def execute(self, query, vars=None):
+        """Execute a statement, counting it.
+
+        Parameters
+        ----------
+        query : String
+            description -> The SQL statement
+            format -> No apply
+            options -> No apply
+
+        vars : Tuple or Dictionary
+            description -> The parameters of the statement
+            format -> No apply
+            options -> 'None': Statement without parameters.
+        """
+        CountingCursor.statements += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        """Execute a statement once by parameters, counting each one.
+
+        Parameters
+        ----------
+        query : String
+            description -> The SQL statement
+            format -> No apply
+            options -> No apply
+
+        vars_list : Iterable
+            description -> The parameters of each execution
+            format -> Tuple or Dictionary
+            options -> No apply
+        """
+        vars_list = list(vars_list)
+        CountingCursor.statements += len(vars_list)
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        """Execute a 'COPY' statement, counting it.
+
+        Parameters
+        ----------
+        sql : String
+            description -> The 'COPY' statement
+            format -> No apply
+            options -> No apply
+
+        file : File-like Object
+            description -> The data read (or written) by the statement
+            format -> No apply
+            options -> No apply
+
+        size : Integer
+            description -> Size of the buffer used to read the file
+            format -> Bytes
+            options -> No apply
+        """
+        CountingCursor.statements += 1
+        return super().copy_expert(sql, file, size)
+
+def peak_rss_bytes():
+    """Peak resident memory of the process and its finished children.
+
+    Returns
+    -------
+    peak : Integer
+        description -> The peak resident memory
+        format -> Bytes
+        options -> No apply
+    """
+    scale = 1 if platform.system() == "Darwin" else 1024
+    self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return max(self_peak, children_peak) * scale
+
+def table_counts(cur, tables):
+    """Number of records of each table.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    tables : String List
+        description -> The tables to count
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    counts : Dictionary
+        description -> The records by table, without quotes
+        format -> {<table>: <records>}
+        options -> No apply
+    """
+    counts = {}
+    for table in tables:
+        cur.execute(f"SELECT count(*) FROM {table};")
+        counts[table.strip("\"")] = cur.fetchone()[0]
+
+    return counts
+
+def run_phase(conn, tables, func):
+    """Execute a phase and measure it.
+
+    Parameters
+    ----------
+    conn : PostgreSQL Connection Instance
+        description -> The connection with the counting cursors
+        format -> No apply
+        options -> No apply
+
+    tables : String List
+        description -> The tables loaded by the phase
+        format -> No apply
+        options -> No apply
+
+    func : Function
+        description -> The phase, without arguments
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    result : Dictionary
+        description -> The measures of the phase
+        format -> {
+            "seconds": <wall time>,
+            "statements": <statements sent>,
+            "rows": {<table>: <records>},
+            "rows_per_second": {<table>: <records per second>}
+        }
+        options -> No apply
+    """
+    statements = CountingCursor.statements
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    statements = CountingCursor.statements - statements
+
+    cur = conn.cursor()
+    rows = table_counts(cur, tables)
+    conn.commit()
+    cur.close()
+
+    return {
+        "seconds": round(seconds, 4),
+        "statements": statements,
+        "rows": rows,
+        "rows_per_second": {
+            table: round(records / seconds, 1) if seconds else None
+            for table, records in rows.items()
+        }
+    }
+
+def parse_arguments(argv=None):
+    """Read the benchmark options from the command line.
+
+    Parameters
+    ----------
+    argv : String List
+        description -> The command line arguments
+        format -> No apply
+        options -> 'None': Use the arguments given to the script.
+
+    Returns
+    -------
+    args : argparse.Namespace
+        description -> The parsed options
+        format -> No apply
+        options -> No apply
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--data",
+        default="data",
+        help="Dataset root with the 'song_data' and 'log_data' folders."
+    )
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument(
+        "--engine",
+        choices=loaders.LOAD_ENGINES,
+        default=loaders.DEFAULT_ENGINE
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument(
+        "--log-mode", choices=("client", "staging"), default="client"
+    )
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Execute the benchmark.
+
+    * Create the database and the tables ('create_tables.main').
+    * Connect with counting cursors.
+    * Process the song files and then the log files, measuring each
+      phase.
+    * Save the results as JSON.
+    """
+    args = parse_arguments(argv)
+    results = {
+        "config": vars(args),
+        "python": platform.python_version(),
+        "phases": {}
+    }
+
+    script_argv = sys.argv
+    sys.argv = [create_tables.__file__]
+    try:
+        start = time.perf_counter()
+        create_tables.main()
+        results["phases"]["create_tables"] = {
+            "seconds": round(time.perf_counter() - start, 4)
+        }
+    finally:
+        sys.argv = script_argv
+
+    conn = database.connect()
+    conn.cursor_factory = CountingCursor
+    cur = conn.cursor()
+
+    log_func = etl.process_log_file
+    log_kwargs = {"engine": args.engine}
+    if args.log_mode == "staging":
+        log_func = etl.process_log_file_staged
+        log_kwargs = {}
+    if args.chunk_size is not None:
+        log_kwargs["chunk_size"] = args.chunk_size
+
+    results["phases"]["songs"] = run_phase(
+        conn,
+        PHASE_TABLES["songs"],
+        lambda: etl.process_data(
+            cur,
+            conn,
+            filepath=os.path.join(args.data, "song_data"),
+            func=etl.process_song_file,
+            workers=args.workers,
+            engine=args.engine
+        )
+    )
+    results["phases"]["logs"] = run_phase(
+        conn,
+        PHASE_TABLES["logs"],
+        lambda: etl.process_data(
+            cur,
+            conn,
+            filepath=os.path.join(args.data, "log_data"),
+            func=log_func,
+            workers=args.workers if args.chunk_size is None else 1,
+            **log_kwargs
+        )
+    )
+    conn.close()
+
+    results["peak_rss_bytes"] = peak_rss_bytes()
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=4)
+    print(json.dumps(results["phases"], indent=4))
+    print(f"Results saved in '{args.output}'")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""Generator of synthetic song and log datasets.
+
+Writes datasets with the same layout and schema of the Udacity sample,
+so the ETL pipeline can be measured at any scale:
+
+    * '<output>/song_data/<A>/<B>/<C>/<track_id>.json': One song per
+      file.
+    * '<output>/log_data/<YYYY>/<MM>/<YYYY>-<MM>-<DD>-events.json': The
+      events of one day per file, one JSON object per line.
+
+The songs played by a share of the NextSong events ('--match-rate')
+exist in the song files with the same title, artist name and duration,
+the other events play songs missed in the catalog.
+
+    python -m benchmarks.generate_dataset --output data_bench \\
+        --songs 10000 --events 1000000 --match-rate 0.3
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import argparse
+import json
+import os
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Propietary imports
+# None
+
+# First day of the generated events (2018-11-01 00:00:00 UTC)
+START_MS = 1_541_030_400_000
+DAY_MS = 86_400_000
+
+ID_CHARACTERS = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"))
+OTHER_PAGES = np.array(["Home", "Settings", "Logout", "Help", "About"])
+LOCATIONS = np.array([
+    "San Francisco-Oakland-Hayward, CA",
+    "New York-Newark-Jersey City, NY-NJ-PA",
+    "Atlanta-Sandy Springs-Roswell, GA",
+    "Chicago-Naperville-Elgin, IL-IN-WI",
+    "Portland-South Portland, ME"
+])
+USER_AGENTS = np.array([
+    "\"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, "
+    "like Gecko) Chrome/36.0.1985.143 Safari/537.36\"",
+    "\"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 "
+    "(KHTML, like Gecko) Version/7.0.6 Safari/537.78.2\"",
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 "
+    "Firefox/31.0"
+])
+
+def random_ids(generator, prefix, count):
+    """Generate unique identifiers of 18 characters.
+
+    Parameters
+    ----------
+    generator : Numpy Generator Instance
+        description -> The random generator
+        format -> No apply
+        options -> No apply
+
+    prefix : String
+        description -> The first two characters of the identifiers
+        format -> No apply
+        options -> {'AR', 'SO', 'TR'}
+
+    count : Integer
+        description -> Number of identifiers
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    ids : String List
+        description -> The identifiers, e.g. 'SOABCDE12345FGHIJ6'
+        format -> No apply
+        options -> No apply
+    """
+    ids = set()
+    while len(ids) < count:
+        characters = generator.choice(ID_CHARACTERS, (count, 16))
+        ids.update(prefix + "".join(row) for row in characters)
+
+    return sorted(ids)[:count]
+
+def generate_songs(generator, songs, artists):
+    """Generate the songs catalog.
+
+    Parameters
+    ----------
+    generator : Numpy Generator Instance
+        description -> The random generator
+        format -> No apply
+        options -> No apply
+
+    songs : Integer
+        description -> Number of songs
+        format -> No apply
+        options -> No apply
+
+    artists : Integer
+        description -> Number of artists
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    songs_df : Pandas Dataframe
+        description -> The songs, with the attributes of the song files
+            and the track ID used as file name
+        format -> No apply
+        options -> No apply
+    """
+    artist_ids = np.array(random_ids(generator, "AR", artists))
+    artist_names = np.array([f"Artist {i}" for i in range(artists)])
+    latitudes = np.round(generator.uniform(-90, 90, artists), 5)
+    longitudes = np.round(generator.uniform(-180, 180, artists), 5)
+    has_coordinates = generator.random(artists) < 0.5
+    artist_locations = generator.choice(LOCATIONS, artists)
+
+    artist_index = generator.integers(0, artists, songs)
+    songs_df = pd.DataFrame({
+        "track_id": random_ids(generator, "TR", songs),
+        "num_songs": 1,
+        "artist_id": artist_ids[artist_index],
+        "artist_latitude": np.where(
+            has_coordinates, latitudes, np.nan
+        )[artist_index],
+        "artist_longitude": np.where(
+            has_coordinates, longitudes, np.nan
+        )[artist_index],
+        "artist_location": artist_locations[artist_index],
+        "artist_name": artist_names[artist_index],
+        "song_id": random_ids(generator, "SO", songs),
+        "title": [f"Song {i}" for i in range(songs)],
+        "duration": np.round(generator.uniform(60, 600, songs), 5),
+        "year": generator.choice([0, *range(1960, 2019)], songs)
+    })
+
+    return songs_df
+
+def write_song_files(songs_df, output):
+    """Write one song file per song, in the Udacity directories layout.
+
+    Parameters
+    ----------
+    songs_df : Pandas Dataframe
+        description -> The songs, as returned by 'generate_songs'
+        format -> No apply
+        options -> No apply
+
+    output : String
+        description -> The dataset root directory
+        format -> No apply
+        options -> No apply
+    """
+    columns = [column for column in songs_df.columns if column != "track_id"]
+    for row in songs_df.itertuples(index=False):
+        record = row._asdict()
+        track_id = record.pop("track_id")
+        record = {
+            column: None if pd.isna(record[column]) else record[column]
+            for column in columns
+        }
+        record["num_songs"] = int(record["num_songs"])
+        record["year"] = int(record["year"])
+        directory = os.path.join(
+            output, "song_data", track_id[2], track_id[3], track_id[4]
+        )
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{track_id}.json"), "w") as file:
+            json.dump(record, file)
+
+def generate_users(generator, users):
+    """Generate the users attributes.
+
+    Parameters
+    ----------
+    generator : Numpy Generator Instance
+        description -> The random generator
+        format -> No apply
+        options -> No apply
+
+    users : Integer
+        description -> Number of users
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    users_df : Pandas Dataframe
+        description -> The users, with the attributes of the log events
+        format -> No apply
+        options -> No apply
+    """
+    return pd.DataFrame({
+        "userId": np.arange(1, users + 1).astype(str),
+        "firstName": [f"First{i}" for i in range(users)],
+        "lastName": [f"Last{i}" for i in range(users)],
+        "gender": generator.choice(["F", "M"], users),
+        "level": generator.choice(["free", "paid"], users),
+        "location": generator.choice(LOCATIONS, users),
+        "userAgent": generator.choice(USER_AGENTS, users),
+        "registration": (
+            START_MS - generator.integers(0, 365 * DAY_MS, users)
+        ).astype(float)
+    })
+
+def generate_events(
+    generator,
+    events,
+    day,
+    songs_df,
+    users_df,
+    match_rate,
+    next_song_rate
+):
+    """Generate the events of one day.
+
+    Parameters
+    ----------
+    generator : Numpy Generator Instance
+        description -> The random generator
+        format -> No apply
+        options -> No apply
+
+    events : Integer
+        description -> Number of events
+        format -> No apply
+        options -> No apply
+
+    day : Integer
+        description -> Day since the first generated day
+        format -> No apply
+        options -> No apply
+
+    songs_df : Pandas Dataframe
+        description -> The songs, as returned by 'generate_songs'
+        format -> No apply
+        options -> No apply
+
+    users_df : Pandas Dataframe
+        description -> The users, as returned by 'generate_users'
+        format -> No apply
+        options -> No apply
+
+    match_rate : Float
+        description -> Share of the NextSong events that play a song of
+            the catalog
+        format -> No apply
+        options -> [0, 1]
+
+    next_song_rate : Float
+        description -> Share of the events with the NextSong action
+        format -> No apply
+        options -> [0, 1]
+
+    Returns
+    -------
+    events_df : Pandas Dataframe
+        description -> The events, sorted by timestamp
+        format -> Attributes of the log files
+        options -> No apply
+    """
+    user_index = generator.integers(0, len(users_df), events)
+    events_df = users_df.iloc[user_index].reset_index(drop=True)
+
+    is_next_song = generator.random(events) < next_song_rate
+    is_match = is_next_song & (generator.random(events) < match_rate)
+    song_index = generator.integers(0, len(songs_df), events)
+    missed_index = generator.integers(0, 10 * len(songs_df) + 1, events)
+
+    events_df["page"] = np.where(
+        is_next_song,
+        "NextSong",
+        generator.choice(OTHER_PAGES, events)
+    )
+    events_df["song"] = np.where(
+        is_match,
+        songs_df["title"].to_numpy()[song_index],
+        np.char.add("Missed song ", missed_index.astype(str))
+    )
+    events_df["artist"] = songs_df["artist_name"].to_numpy()[song_index]
+    events_df["length"] = np.where(
+        is_match,
+        songs_df["duration"].to_numpy()[song_index],
+        np.round(generator.uniform(60, 600, events), 5)
+    )
+    for column in ("song", "artist", "length"):
+        events_df[column] = events_df[column].where(is_next_song, None)
+
+    events_df["auth"] = "Logged In"
+    events_df["itemInSession"] = generator.integers(0, 100, events)
+    events_df["method"] = np.where(is_next_song, "PUT", "GET")
+    events_df["sessionId"] = (
+        day * 10_000 + events_df["userId"].astype(int) % 10_000 + 1
+    )
+    events_df["status"] = 200
+    events_df["ts"] = np.sort(
+        START_MS + day * DAY_MS + generator.integers(0, DAY_MS, events)
+    )
+
+    columns = [
+        "artist", "auth", "firstName", "gender", "itemInSession",
+        "lastName", "length", "level", "location", "method", "page",
+        "registration", "sessionId", "song", "status", "ts", "userAgent",
+        "userId"
+    ]
+
+    return events_df[columns]
+
+def write_log_files(
+    generator,
+    events,
+    days,
+    songs_df,
+    users_df,
+    output,
+    match_rate,
+    next_song_rate
+):
+    """Write one log file per day, in the Udacity directories layout.
+
+    The events are generated and written day by day, so the memory used
+    depends on the events of one day.
+
+    Parameters
+    ----------
+    generator : Numpy Generator Instance
+        description -> The random generator
+        format -> No apply
+        options -> No apply
+
+    events : Integer
+        description -> Total number of events
+        format -> No apply
+        options -> No apply
+
+    days : Integer
+        description -> Number of days (log files)
+        format -> No apply
+        options -> No apply
+
+    songs_df : Pandas Dataframe
+        description -> The songs, as returned by 'generate_songs'
+        format -> No apply
+        options -> No apply
+
+    users_df : Pandas Dataframe
+        description -> The users, as returned by 'generate_users'
+        format -> No apply
+        options -> No apply
+
+    output : String
+        description -> The dataset root directory
+        format -> No apply
+        options -> No apply
+
+    match_rate : Float
+        description -> Share of the NextSong events that play a song of
+            the catalog
+        format -> No apply
+        options -> [0, 1]
+
+    next_song_rate : Float
+        description -> Share of the events with the NextSong action
+        format -> No apply
+        options -> [0, 1]
+    """
+    for day in range(days):
+        day_events = events // days + (day < events % days)
+        date = pd.to_datetime(START_MS + day * DAY_MS, unit="ms")
+        directory = os.path.join(
+            output, "log_data", f"{date:%Y}", f"{date:%m}"
+        )
+        os.makedirs(directory, exist_ok=True)
+        events_df = generate_events(
+            generator,
+            day_events,
+            day,
+            songs_df,
+            users_df,
+            match_rate,
+            next_song_rate
+        )
+        events_df.to_json(
+            os.path.join(directory, f"{date:%Y-%m-%d}-events.json"),
+            orient="records",
+            lines=True
+        )
+
+def parse_arguments(argv=None):
+    """Read the generator options from the command line.
+
+    Parameters
+    ----------
+    argv : String List
+        description -> The command line arguments
+        format -> No apply
+        options -> 'None': Use the arguments given to the script.
+
+    Returns
+    -------
+    args : argparse.Namespace
+        description -> The parsed options
+        format -> No apply
+        options -> No apply
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", default="data_bench")
+    parser.add_argument("--songs", type=int, default=10_000)
+    parser.add_argument("--artists", type=int, default=None)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--events", type=int, default=10_000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument(
+        "--match-rate",
+        type=float,
+        default=0.3,
+        help="Share of the NextSong events that play a catalog song."
+    )
+    parser.add_argument(
+        "--next-song-rate",
+        type=float,
+        default=0.8,
+        help="Share of the events with the NextSong action."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Generate the datasets.
+
+    * Generate the songs catalog and write the song files.
+    * Generate the users.
+    * Generate and write the log files day by day.
+    """
+    args = parse_arguments(argv)
+    generator = np.random.default_rng(args.seed)
+    artists = args.artists or max(args.songs // 2, 1)
+
+    songs_df = generate_songs(generator, args.songs, artists)
+    write_song_files(songs_df, args.output)
+    users_df = generate_users(generator, args.users)
+    write_log_files(
+        generator,
+        args.events,
+        args.days,
+        songs_df,
+        users_df,
+        args.output,
+        args.match_rate,
+        args.next_song_rate
+    )
+    print(
+        f"{args.songs:,} songs and {args.events:,} events written in "
+        f"'{args.output}'"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark and regression check of the 'Queries' SQL builders.
+
+Each dataframe builder of 'sql_queries.Queries' ('artist_table_insert',
+'song_table_insert', 'time_table_insert', 'user_table_insert',
+'songplay_table_insert' and 'song_select') is executed over synthetic
+records prepared as the 'values' engine does (single-quotes tagged and
+null values as 'nan') at several sizes, measuring:
+
+    * 'seconds': Best wall time of the repetitions.
+    * 'rows_per_second': Throughput of the best repetition.
+    * 'peak_bytes': Peak memory allocated by one execution.
+    * 'sql_bytes': Size of the generated SQL statement.
+    * 'sha256': Hash of the generated SQL statement.
+
+The results are compared with a stored baseline: the run fails if the
+generated SQL changes (size or hash), so an optimization must keep the
+same output, or if the throughput falls below the baseline by more
+than the tolerance. The throughput depends on the machine, so the
+baseline must be stored on the machine that checks it; after an
+intended change of the output, store the new baseline with
+'--update-baseline'.
+
+    python -m benchmarks.sql_builders
+    python -m benchmarks.sql_builders --rows 1 100 --tolerance 0.5
+    python -m benchmarks.sql_builders --update-baseline
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Propietary imports
+import loaders
+import sql_queries
+
+ROW_COUNTS = (1, 100, 5_000, 50_000)
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "sql_builders_baseline.json"
+)
+
+# Minimum time measured by builder and size, the repetitions are
+# increased until the sum of their times reaches it
+MIN_SECONDS = 0.2
+
+def synthetic_text(generator, prefix, rows, distinct):
+    """Generate strings, some of them with single-quotes.
+
+    Parameters
+    ----------
+    generator : numpy.random.Generator Instance
+        description -> The random generator
+        format -> No apply
+        options -> No apply
+
+    prefix : String
+        description -> Prefix of the strings
+        format -> No apply
+        options -> No apply
+
+    rows : Integer
+        description -> Number of strings
+        format -> No apply
+        options -> No apply
+
+    distinct : Integer
+        description -> Number of distinct strings
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    text : String List
+        description -> The strings
+        format -> No apply
+        options -> No apply
+    """
+    values = generator.integers(0, max(distinct, 1), rows)
+
+    return [
+        f"{prefix} O'Neil {value}" if value % 7 == 0 else f"{prefix} {value}"
+        for value in values
+    ]
+
+def synthetic_frames(rows, seed=0):
+    """Generate the input dataframe of each builder.
+
+    The dataframes have the columns expected by the builders, with
+    null values in the optional attributes.
+
+    Parameters
+    ----------
+    rows : Integer
+        description -> Records of each dataframe
+        format -> No apply
+        options -> No apply
+
+    seed : Integer
+        description -> Seed of the random generator, the same seed
+            generates the same records
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    frames : Dictionary
+        description -> The dataframe of each builder
+        format -> {<builder name>: Pandas Dataframe}
+        options -> No apply
+    """
+    generator = np.random.default_rng(seed)
+    ids = np.arange(rows)
+    latitude = generator.uniform(-90, 90, rows).round(5)
+    latitude[generator.random(rows) < 0.5] = np.nan
+    seconds = 1_541_030_400 + np.sort(
+        generator.integers(0, 30 * 86_400, rows)
+    )
+    start_time = pd.Series(pd.to_datetime(seconds, unit='s'))
+    duration = generator.uniform(30, 600, rows).round(5)
+    song_id = np.array([f"SO{value:016d}" for value in ids], dtype=object)
+    song_id[generator.random(rows) < 0.9] = np.nan
+
+    frames = {
+        "artist_table_insert": pd.DataFrame({
+            "artist_id": [f"AR{value:016d}" for value in ids],
+            "artist_name": synthetic_text(generator, "Artist", rows, rows),
+            "artist_location": synthetic_text(
+                generator, "City", rows, 100
+            ),
+            "artist_latitude": latitude,
+            "artist_longitude": generator.uniform(-180, 180, rows).round(5)
+        }),
+        "song_table_insert": pd.DataFrame({
+            "song_id": [f"SO{value:016d}" for value in ids],
+            "title": synthetic_text(generator, "Song", rows, rows),
+            "artist_id": [
+                f"AR{value:016d}" for value in generator.integers(
+                    0, rows, rows
+                )
+            ],
+            "year": generator.integers(0, 2019, rows),
+            "duration": duration
+        }),
+        "time_table_insert": pd.DataFrame({
+            "start_time": start_time.dt.strftime('%Y-%m-%dT%H:%M:%S'),
+            "hour": start_time.dt.hour,
+            "day": start_time.dt.day,
+            "week": start_time.dt.isocalendar()["week"].astype("int64"),
+            "month": start_time.dt.month,
+            "year": start_time.dt.year,
+            "weekday": start_time.dt.weekday + 1
+        }),
+        "user_table_insert": pd.DataFrame({
+            "user_id": [str(value) for value in ids],
+            "first_name": synthetic_text(generator, "First", rows, 500),
+            "last_name": synthetic_text(generator, "Last", rows, 500),
+            "gender": generator.choice(["F", "M"], rows),
+            "level": generator.choice(["free", "paid"], rows)
+        }),
+        "songplay_table_insert": pd.DataFrame({
+            "start_time": start_time.dt.strftime('%Y-%m-%dT%H:%M:%S'),
+            "user_id": generator.integers(1, 100, rows).astype(str),
+            "level": generator.choice(["free", "paid"], rows),
+            "song_id": song_id,
+            "artist_id": np.where(
+                pd.isna(song_id), None, "AR0000000000000001"
+            ),
+            "session_id": generator.integers(1, 1_000, rows),
+            "location": synthetic_text(generator, "City", rows, 100),
+            "user_agent": synthetic_text(
+                generator, "Mozilla/5.0 (Windows NT 6.1)", rows, 20
+            )
+        }),
+        "song_select": pd.DataFrame({
+            "idx": ids,
+            "song": synthetic_text(generator, "Song", rows, rows),
+            "artist": synthetic_text(generator, "Artist", rows, rows),
+            "length": duration
+        })
+    }
+
+    return {
+        name: values_frame(dataframe) for name, dataframe in frames.items()
+    }
+
+def values_frame(dataframe):
+    """Prepare a dataframe as the 'values' engine does.
+
+    The single-quotes are tagged ('loaders.single_quote_converter') and
+    the null values are replaced by the 'nan' marker.
+
+    Parameters
+    ----------
+    dataframe : Pandas Dataframe
+        description -> The records
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    dataframe : Pandas Dataframe
+        description -> The records ready for the builders
+        format -> No apply
+        options -> No apply
+    """
+    for column in dataframe.select_dtypes(include=["object", "string"]):
+        dataframe[column] = dataframe[column].map(
+            lambda value: loaders.single_quote_converter(value)
+            if isinstance(value, str) else value
+        )
+    if dataframe.isna().values.any():
+        dataframe = dataframe.where(dataframe.notna(), 'nan')
+
+    return dataframe
+
+def measure(builder, dataframe, repeat):
+    """Measure a builder over a dataframe.
+
+    Parameters
+    ----------
+    builder : Function
+        description -> The 'Queries' builder
+        format -> No apply
+        options -> No apply
+
+    dataframe : Pandas Dataframe
+        description -> The builder input
+        format -> No apply
+        options -> No apply
+
+    repeat : Integer
+        description -> Minimum repetitions, increased until the
+            measured time reaches 'MIN_SECONDS'
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    result : Dictionary
+        description -> The measures of the builder
+        format -> {
+            "seconds": <best wall time>,
+            "rows_per_second": <throughput>,
+            "peak_bytes": <peak memory allocated>,
+            "sql_bytes": <statement size>,
+            "sha256": <statement hash>
+        }
+        options -> No apply
+    """
+    tracemalloc.start()
+    query = builder(dataframe=dataframe)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    while len(times) < repeat or sum(times) < MIN_SECONDS:
+        start = time.perf_counter()
+        builder(dataframe=dataframe)
+        times.append(time.perf_counter() - start)
+    seconds = min(times)
+    encoded = query.encode("utf-8")
+
+    return {
+        "seconds": round(seconds, 6),
+        "rows_per_second": round(len(dataframe) / seconds, 1),
+        "peak_bytes": peak_bytes,
+        "sql_bytes": len(encoded),
+        "sha256": hashlib.sha256(encoded).hexdigest()
+    }
+
+def compare(results, baseline, tolerance):
+    """Compare the results with the baseline.
+
+    Parameters
+    ----------
+    results : Dictionary
+        description -> The measures of this run
+        format -> {<builder name>: {<rows>: <measures>}}
+        options -> No apply
+
+    baseline : Dictionary
+        description -> The stored measures, same format of 'results'
+        format -> No apply
+        options -> No apply
+
+    tolerance : Float
+        description -> Allowed throughput loss, as a fraction of the
+            baseline throughput
+        format -> No apply
+        options -> [0, 1)
+
+    Returns
+    -------
+    failures : String List
+        description -> The description of each regression
+        format -> No apply
+        options -> Empty if there are no regressions.
+    """
+    failures = []
+    for name, sizes in results.items():
+        for rows, result in sizes.items():
+            expected = baseline.get(name, {}).get(rows)
+            if expected is None:
+                print(f"{name} x {rows}: not in the baseline, skipped.")
+                continue
+            if result["sha256"] != expected["sha256"]:
+                failures.append(
+                    f"{name} x {rows}: generated SQL changed "
+                    f"({expected['sql_bytes']} -> {result['sql_bytes']} "
+                    "bytes)"
+                )
+            minimum = expected["rows_per_second"] * (1 - tolerance)
+            if result["rows_per_second"] < minimum:
+                failures.append(
+                    f"{name} x {rows}: throughput "
+                    f"{result['rows_per_second']:,.0f} rows/s is below "
+                    f"{minimum:,.0f} rows/s (baseline "
+                    f"{expected['rows_per_second']:,.0f} rows/s)"
+                )
+
+    return failures
+
+def parse_arguments(argv=None):
+    """Read the benchmark options from the command line.
+
+    Parameters
+    ----------
+    argv : String List
+        description -> The command line arguments
+        format -> No apply
+        options -> 'None': Use the arguments given to the script.
+
+    Returns
+    -------
+    args : argparse.Namespace
+        description -> The parsed options
+        format -> No apply
+        options -> No apply
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=list(ROW_COUNTS)
+    )
+    parser.add_argument(
+        "--builders",
+        nargs="+",
+        default=None,
+        help="Builders to measure, all of them by default."
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.4,
+        help="Allowed throughput loss against the baseline."
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store the results as the new baseline instead of checking."
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Save the results of the run in this JSON file."
+    )
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Execute the benchmark.
+
+    * Generate the synthetic records of each size.
+    * Measure each builder over each size.
+    * Store the baseline, or compare the results with it and exit with
+      an error status if there are regressions.
+    """
+    args = parse_arguments(argv)
+    results = {}
+    for rows in args.rows:
+        frames = synthetic_frames(rows, args.seed)
+        for name, dataframe in frames.items():
+            if args.builders is not None and name not in args.builders:
+                continue
+            builder = getattr(sql_queries.Queries, name)
+            result = measure(builder, dataframe, args.repeat)
+            results.setdefault(name, {})[str(rows)] = result
+            print(
+                f"{name:<22} {rows:>7,} rows "
+                f"{result['seconds'] * 1_000:10.3f} ms "
+                f"{result['rows_per_second']:>12,.0f} rows/s "
+                f"{result['peak_bytes'] / 2**20:8.2f} MiB peak "
+                f"{result['sql_bytes']:>11,} SQL bytes"
+            )
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if args.update_baseline:
+        baseline = {"python": platform.python_version(), "builders": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+            baseline["python"] = platform.python_version()
+        for name, sizes in results.items():
+            baseline["builders"].setdefault(name, {}).update(sizes)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=4)
+        print(f"Baseline saved in '{args.baseline}'")
+        return
+
+    if not os.path.exists(args.baseline):
+        sys.exit(
+            f"Baseline '{args.baseline}' not found, "
+            "create it with '--update-baseline'."
+        )
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    failures = compare(results, baseline["builders"], args.tolerance)
+    if failures:
+        print("\nRegressions against the baseline:")
+        for failure in failures:
+            print(f"    * {failure}")
+        sys.exit(1)
+    print("\nNo regressions against the baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the time records generation.
+
+Compares the row by row generation used before ('legacy_time_records')
+with the vectorized generation 'etl.time_records' over synthetic log
+timestamps, checks both outputs are the same and shows the speedup.
+
+    python -m benchmarks.time_dimension --events 300000
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import argparse
+import time
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Propietary imports
+import etl
+
+def legacy_time_records(timestamps):
+    """Generate the time records row by row (previous implementation).
+
+    Parameters
+    ----------
+    timestamps : Pandas Series
+        description -> The log timestamps
+        format -> Milliseconds since epoch
+        options -> No apply
+
+    Returns
+    -------
+    time_df : Pandas Dataframe
+        description -> The time records
+        format -> Headers: [
+            "start_time",
+            "hour",
+            "day",
+            "week",
+            "month",
+            "year",
+            "weekday"
+        ]
+        options -> No apply
+    """
+    timestamps = pd.to_datetime(timestamps, unit='ms')
+    time_data = list(
+        map(
+            lambda item: [
+                item.strftime('%Y-%m-%dT%H:%M:%S'),
+                item.hour,
+                item.day,
+                item.week,
+                item.month,
+                item.year,
+                item.weekday() + 1
+            ],
+            timestamps.copy()
+        )
+    )
+    column_labels = [
+        'start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'
+    ]
+    time_list_dict = [dict(zip(column_labels, row)) for row in time_data]
+    time_df = pd.DataFrame(time_list_dict)
+    time_df = time_df.drop_duplicates()
+    time_df = time_df.reset_index(drop=True)
+    time_df = time_df[column_labels]
+
+    return time_df
+
+def synthetic_timestamps(events, seed=0):
+    """Generate log timestamps with repeated seconds.
+
+    Parameters
+    ----------
+    events : Integer
+        description -> Number of timestamps
+        format -> No apply
+        options -> No apply
+
+    seed : Integer
+        description -> Seed of the random generator
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    timestamps : Pandas Series
+        description -> Timestamps over one month (November 2018)
+        format -> Milliseconds since epoch
+        options -> No apply
+    """
+    generator = np.random.default_rng(seed)
+    start = 1_541_030_400_000
+    timestamps = start + generator.integers(0, 30 * 86_400_000, events)
+
+    return pd.Series(np.sort(timestamps), name="ts")
+
+def best_time(func, timestamps, repeat):
+    """Best wall time in seconds of 'func' over 'repeat' executions."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(timestamps)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def main():
+    """Execute the benchmark.
+
+    * Generate the synthetic timestamps.
+    * Check the legacy and vectorized outputs are the same.
+    * Time both implementations and show the speedup.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=300_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    timestamps = synthetic_timestamps(args.events)
+    pd.testing.assert_frame_equal(
+        legacy_time_records(timestamps),
+        etl.time_records(timestamps),
+        check_dtype=False
+    )
+
+    legacy = best_time(legacy_time_records, timestamps, args.repeat)
+    vectorized = best_time(etl.time_records, timestamps, args.repeat)
+    print(f"events:     {args.events:,}")
+    print(f"legacy:     {legacy:.4f} s")
+    print(f"vectorized: {vectorized:.4f} s")
+    print(f"speedup:    {legacy / vectorized:.1f}x")
+
+if __name__ == "__main__":
+    main()
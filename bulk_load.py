@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Bulk-load profile of the Sparkify's database.
+
+The foreign keys check each inserted record against the referenced
+table, for an initial backfill the foreign keys are dropped before the
+load and added again at the end:
+
+    * The keys are added as 'NOT VALID', so adding them does not check
+      the loaded records.
+    * Each key is validated with a single set-based pass inside a
+      savepoint.
+    * If the validation fails, the savepoint is rolled back, the key is
+      kept as 'NOT VALID' and the records that violate it are counted
+      and reported.
+
+A partitioned table does not accept 'NOT VALID' keys, its keys are
+added (and checked) inside a savepoint, the keys with violations are
+not added and reported.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+# None
+
+# Third-party imports
+import psycopg2
+
+# Propietary imports
+import sql_queries
+
+# Savepoint of the key being validated
+VALIDATE_SAVEPOINT = "validate_foreign_key"
+
+def drop_foreign_keys(cur):
+    """Drop the foreign keys of 'sql_queries.FOREIGN_KEYS' if they exist.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+    """
+    for name in sql_queries.FOREIGN_KEYS:
+        cur.execute(sql_queries.Queries.foreign_key_drop(name))
+
+def restore_foreign_keys(cur, partitioned_tables=()):
+    """Add again the foreign keys and validate them.
+
+    * For each foreign key of 'sql_queries.FOREIGN_KEYS':
+        * Drop the key if it exists and add it as 'NOT VALID'.
+        * Validate the key inside a savepoint.
+        * If the validation fails, roll back to the savepoint and count
+          the records that violate the key.
+    * The keys of partitioned tables are added (and checked) inside a
+      savepoint, if they fail the violations are counted.
+
+    The records are scanned once by key, the violations are only
+    counted for the keys that fail.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    partitioned_tables : String Tuple
+        description -> The partitioned tables
+        format -> No apply
+        options -> e.g. ('songplay',)
+
+    Returns
+    -------
+    violations : Dictionary
+        description -> Number of records that violate each key, the
+            keys with violations are kept as 'NOT VALID' (or not added
+            in partitioned tables)
+        format -> {<foreign key name>: <records>}
+        options -> No apply
+    """
+    sql = sql_queries.Queries
+    violations = {}
+    for name, key in sql_queries.FOREIGN_KEYS.items():
+        cur.execute(sql.foreign_key_drop(name))
+        if key["table"] in partitioned_tables:
+            check = sql.foreign_key_add(name)
+        else:
+            cur.execute(sql.foreign_key_add(name, valid=False))
+            check = sql.foreign_key_validate(name)
+
+        cur.execute(f"SAVEPOINT {VALIDATE_SAVEPOINT};")
+        try:
+            cur.execute(check)
+        except psycopg2.IntegrityError:
+            cur.execute(f"ROLLBACK TO SAVEPOINT {VALIDATE_SAVEPOINT};")
+            cur.execute(sql.foreign_key_violations(name))
+            violations[name] = int(cur.fetchone()[0])
+        else:
+            violations[name] = 0
+        cur.execute(f"RELEASE SAVEPOINT {VALIDATE_SAVEPOINT};")
+
+    return violations
+
+def print_violations(violations, partitioned_tables=()):
+    """Print the report of 'restore_foreign_keys'.
+
+    Parameters
+    ----------
+    violations : Dictionary
+        description -> Number of records that violate each key
+        format -> {<foreign key name>: <records>}
+        options -> No apply
+
+    partitioned_tables : String Tuple
+        description -> The partitioned tables given to
+            'restore_foreign_keys'
+        format -> No apply
+        options -> No apply
+    """
+    print("\nForeign keys validation:")
+    for name, records in violations.items():
+        table = sql_queries.FOREIGN_KEYS[name]["table"]
+        if records and table in partitioned_tables:
+            print(f"    {name}: {records} records violate the key, NOT ADDED")
+        elif records:
+            print(f"    {name}: {records} records violate the key, NOT VALID")
+        else:
+            print(f"    {name}: valid")
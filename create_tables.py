@@ -8,12 +8,15 @@ Mantaniner: Rolando Gonzalez
 Version: 1.0.0
 """
 # Standard library imports
+import argparse
 import traceback
 
 # Third-party imports
 import psycopg2
 
 # Propietary imports
+import bulk_load
+import database
 import sql_queries
 
 def create_database():
@@ -35,15 +38,12 @@ def create_database():
         format -> No apply
         options -> No apply
     """
-    # Connect to the database, pay attention to the credentials!
-    # TODO: Verify all the fields and insert password.
+    # Connect to the database, the credentials are read from
+    # 'database.cfg' or the environment (see 'database.py')
+    settings = database.load_settings()
     try:
-        conn = psycopg2.connect(
-            user="admin",
-            password="<password>",
-            host="localhost",
-            port="5432",
-            dbname="data_modeling_postgres_01"
+        conn = database.connect(
+            settings, dbname=settings["maintenance_dbname"]
         )
         conn.set_session(autocommit=True)
         cur = conn.cursor()
@@ -55,24 +55,45 @@ def create_database():
         print(f"Complete log error:\n{message}\n")
 
     # Create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb;")
+    dbname = database.database_name(settings)
+    cur.execute(f"DROP DATABASE IF EXISTS \"{dbname}\";")
     cur.execute(
-        "CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0;"
+        f"CREATE DATABASE \"{dbname}\" WITH ENCODING 'utf8' "
+        "TEMPLATE template0;"
     )
 
     # close connection to default database
     conn.close()
 
-    # Connect to 'sparkifydb' database, becareful with the credentials!
+    # Connect to 'sparkifydb' database
+    return connect_database(settings)
+
+def connect_database(settings=None):
+    """Connects to the existing 'sparkifydb' database.
+
+    Parameters
+    ----------
+    settings : Dictionary
+        description -> The connection settings
+        format -> As returned by 'database.load_settings'
+        options -> 'None': Read the settings again.
+
+    Returns
+    -------
+    cur : Instance
+        description -> psycopg2 instance 'sparkifydb' cursor
+        format -> No apply
+        options -> No apply
+
+    conn : Instance
+        description -> psycopg2 instance 'sparkifydb' connection
+        format -> No apply
+        options -> No apply
+    """
+    # Connect to 'sparkifydb' database, the credentials are read from
+    # 'database.cfg' or the environment (see 'database.py')
     try:
-        # TODO: Verify all the fields and insert password.
-        conn = psycopg2.connect(
-            user="admin",
-            password="<password>",
-            host="localhost",
-            port="5432",
-            dbname="sparkifydb"
-        )
+        conn = database.connect(settings)
         cur = conn.cursor()
 
     except psycopg2.Error as error:
@@ -107,7 +128,7 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, indexes=True, partitioned=False):
     """ Creat the tables if they no exist.
 
     Each table is created using the queries in the
@@ -125,25 +146,147 @@ def create_tables(cur, conn):
         description -> psycopg2 instance 'sparkifydb' connection
         format -> No apply
         options -> No apply
+
+    indexes : bool
+        description -> Create the lookup indexes with the tables
+        format -> No apply
+        options -> 'False': Skip the queries of 'create_index_queries',
+            build them after the initial load with 'create_indexes'.
+
+    partitioned : bool
+        description -> Create the table 'songplay' partitioned by month
+            of 'start_time', the queries of
+            'create_partitioned_table_queries' are used
+        format -> No apply
+        options -> No apply
     """
     sql = sql_queries.Queries()
-    for query in sql.create_table_queries:
+    queries = sql.create_table_queries
+    if partitioned:
+        queries = sql.create_partitioned_table_queries
+    for query in queries:
+        if not indexes and query in sql.create_index_queries:
+            continue
         cur.execute(query)
         conn.commit()
 
+def create_indexes(cur, conn):
+    """Create the lookup indexes if they no exist.
+
+    Each index is created using the queries in the
+    `create_index_queries` list, then the planner statistics are
+    updated, so the loaded tables use the new indexes.
+
+    Parameters
+    ----------
+    cur : Instance
+        description -> psycopg2 instance 'sparkifydb' cursor
+        format -> No apply
+        options -> No apply
+
+    conn : Instance
+        description -> psycopg2 instance 'sparkifydb' connection
+        format -> No apply
+        options -> No apply
+    """
+    sql = sql_queries.Queries()
+    for query in sql.create_index_queries:
+        cur.execute(query)
+        conn.commit()
+    cur.execute("ANALYZE;")
+    conn.commit()
+
+def parse_arguments(argv=None):
+    """Read the script options from the command line.
+
+    Parameters
+    ----------
+    argv : String List
+        description -> The command line arguments
+        format -> No apply
+        options -> 'None': Use the arguments given to the script.
+
+    Returns
+    -------
+    args : argparse.Namespace
+        description -> The parsed options
+        format -> No apply
+        options -> No apply
+    """
+    parser = argparse.ArgumentParser(
+        description="Create the Sparkify's database and tables"
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        help=(
+            "Create the tables without the lookup indexes, build them "
+            "with '--indexes-only' after the initial load."
+        )
+    )
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help=(
+            "Create the tables without the foreign keys, use it with "
+            "'python etl.py --bulk-load' to add and validate them after "
+            "the initial load."
+        )
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help=(
+            "Create the table 'songplay' partitioned by month of "
+            "'start_time', the ETL pipeline creates the partition of "
+            "each new month."
+        )
+    )
+    group.add_argument(
+        "--indexes-only",
+        action="store_true",
+        help=(
+            "Create the lookup indexes in the existing database, the "
+            "database and the tables are kept."
+        )
+    )
+
+    return parser.parse_args(argv)
+
 def main():
     """ Pipeline execution.
 
-    * Drop (if exists) and Create the sparkify database.
-    * Establish connection with the sparkify database and get
-      cursor to it.
-    * Drop all the tables if they exist.
-    * Create all the tables needed if they no exist.
+    * Read the script options.
+    * If only the indexes are required, connect to the sparkify
+      database and create the lookup indexes.
+    * Otherwise:
+        * Drop (if exists) and Create the sparkify database.
+        * Establish connection with the sparkify database and get
+          cursor to it.
+        * Drop all the tables if they exist.
+        * Create all the tables needed if they no exist, the lookup
+          indexes are skipped if they are deferred and the table
+          'songplay' is partitioned by month if it is required.
+        * Drop the foreign keys, if the bulk-load profile is used.
     * Close the connection.
     """
-    cur, conn = create_database()
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    args = parse_arguments()
+    if args.indexes_only:
+        cur, conn = connect_database()
+        create_indexes(cur, conn)
+    else:
+        cur, conn = create_database()
+        drop_tables(cur, conn)
+        create_tables(
+            cur,
+            conn,
+            indexes=not args.defer_indexes,
+            partitioned=args.partitioned
+        )
+        if args.bulk_load:
+            bulk_load.drop_foreign_keys(cur)
+            conn.commit()
     conn.close()
 
 if __name__ == "__main__":
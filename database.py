@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""Connections to the Sparkify's database.
+
+The connection settings are read from the file 'database.cfg' (see
+'database.cfg.example') and the environment variables, the variables
+take precedence over the file:
+
+    * 'SPARKIFY_DB_CONFIG': Location of the configuration file.
+    * 'SPARKIFY_DSN': libpq connection string, e.g.
+      'host=localhost port=5432 user=admin dbname=sparkifydb'.
+    * 'SPARKIFY_POOL_SIZE': Maximum number of pooled connections.
+    * 'SPARKIFY_SYNCHRONOUS_COMMIT', 'SPARKIFY_WORK_MEM' and
+      'SPARKIFY_STATEMENT_TIMEOUT': Session settings of each
+      connection.
+
+The connections are handed out by a thread-safe pool, the session
+settings are sent once when each connection is opened, so the stages
+of the pipeline share the connections without reconnecting.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import configparser
+import contextlib
+import os
+
+# Third-party imports
+import psycopg2
+from psycopg2 import extensions
+from psycopg2 import pool
+
+# Propietary imports
+# None
+
+CONFIG_FILE = "database.cfg"
+
+# Settings used when they are not given by the file or the environment
+DEFAULT_SETTINGS = {
+    "dsn": (
+        "host=localhost port=5432 user=admin password=<password> "
+        "dbname=sparkifydb"
+    ),
+    "maintenance_dbname": "data_modeling_postgres_01",
+    "pool_size": 4,
+    "session": {
+        "synchronous_commit": "",
+        "work_mem": "",
+        "statement_timeout": ""
+    }
+}
+
+# Environment variables of each setting
+ENVIRONMENT_VARIABLES = {
+    "dsn": "SPARKIFY_DSN",
+    "maintenance_dbname": "SPARKIFY_MAINTENANCE_DBNAME",
+    "pool_size": "SPARKIFY_POOL_SIZE",
+    "synchronous_commit": "SPARKIFY_SYNCHRONOUS_COMMIT",
+    "work_mem": "SPARKIFY_WORK_MEM",
+    "statement_timeout": "SPARKIFY_STATEMENT_TIMEOUT"
+}
+
+def load_settings(path=None):
+    """Read the connection settings from the file and the environment.
+
+    * Start from the default settings.
+    * Update them with the file sections '[postgresql]', '[pool]' and
+      '[session]', if the file exists.
+    * Update them with the environment variables.
+
+    Parameters
+    ----------
+    path : String
+        description -> Location of the configuration file
+        format -> No apply
+        options -> 'None': Use 'SPARKIFY_DB_CONFIG' or 'database.cfg'.
+
+    Returns
+    -------
+    settings : Dictionary
+        description -> The connection settings
+        format -> {
+            "dsn": <libpq connection string>,
+            "maintenance_dbname": <database used to create sparkifydb>,
+            "pool_size": <maximum pooled connections>,
+            "session": {<setting>: <value>}
+        }
+        options -> No apply
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    session = dict(DEFAULT_SETTINGS["session"])
+
+    path = path or os.environ.get("SPARKIFY_DB_CONFIG", CONFIG_FILE)
+    config = configparser.ConfigParser(interpolation=None)
+    if config.read(path):
+        if config.has_section("postgresql"):
+            postgresql = config["postgresql"]
+            settings["dsn"] = extensions.make_dsn(**{
+                key: value
+                for key, value in postgresql.items()
+                if key != "maintenance_dbname"
+            })
+            settings["maintenance_dbname"] = postgresql.get(
+                "maintenance_dbname", settings["maintenance_dbname"]
+            )
+        if config.has_section("pool"):
+            settings["pool_size"] = config["pool"].getint(
+                "size", settings["pool_size"]
+            )
+        if config.has_section("session"):
+            session.update(config["session"])
+
+    for key, variable in ENVIRONMENT_VARIABLES.items():
+        value = os.environ.get(variable)
+        if value is None:
+            continue
+        if key in session:
+            session[key] = value
+        elif key == "pool_size":
+            settings[key] = int(value)
+        else:
+            settings[key] = value
+    settings["session"] = session
+
+    return settings
+
+def session_options(session):
+    """Build the libpq 'options' that tune each new session.
+
+    Parameters
+    ----------
+    session : Dictionary
+        description -> The session settings, the empty values keep the
+            server defaults
+        format -> {<setting>: <value>}
+        options -> No apply
+
+    Returns
+    -------
+    options : String
+        description -> The command-line options sent at connection
+        format -> '-c <setting>=<value> ...'
+        options -> No apply
+    """
+    return " ".join(
+        f"-c {key}={value}" for key, value in session.items() if value
+    )
+
+def database_name(settings):
+    """Name of the database of the DSN.
+
+    Parameters
+    ----------
+    settings : Dictionary
+        description -> The connection settings
+        format -> As returned by 'load_settings'
+        options -> No apply
+
+    Returns
+    -------
+    dbname : String
+        description -> The database name
+        format -> No apply
+        options -> 'sparkifydb': The DSN has no database.
+    """
+    return extensions.parse_dsn(settings["dsn"]).get("dbname", "sparkifydb")
+
+def connect(settings=None, dbname=None, connection_factory=None):
+    """Open a single connection, out of the pool.
+
+    Parameters
+    ----------
+    settings : Dictionary
+        description -> The connection settings
+        format -> As returned by 'load_settings'
+        options -> 'None': Use 'load_settings()'.
+
+    dbname : String
+        description -> The database to connect to
+        format -> No apply
+        options -> 'None': The database of the DSN.
+
+    connection_factory : Class
+        description -> The class of the connection
+        format -> No apply
+        options -> {
+            'None': psycopg2 connection,
+            metrics.MetricsConnection: Measure the statements
+        }
+
+    Returns
+    -------
+    conn : PostgreSQL Connection Instance
+        description -> The open connection
+        format -> No apply
+        options -> No apply
+    """
+    settings = settings or load_settings()
+    kwargs = {}
+    if dbname is not None:
+        kwargs["dbname"] = dbname
+    options = session_options(settings["session"])
+    if options:
+        kwargs["options"] = options
+    if connection_factory is not None:
+        kwargs["connection_factory"] = connection_factory
+
+    return psycopg2.connect(settings["dsn"], **kwargs)
+
+class ConnectionPool():
+    """Thread-safe pool of connections to the Sparkify's database.
+
+    Attributes
+    ----------
+    settings : Dictionary
+        description -> The connection settings
+        format -> As returned by 'load_settings'
+        options -> No apply
+
+    Methods
+    -------
+    getconn : Method
+        Take a connection from the pool.
+
+    putconn : Method
+        Return a connection to the pool.
+
+    connection : Method
+        Context manager that takes and returns a connection.
+
+    closeall : Method
+        Close all the connections of the pool.
+    """
+    def __init__(self, settings=None, connection_factory=None):
+        self.settings = settings or load_settings()
+        kwargs = {}
+        options = session_options(self.settings["session"])
+        if options:
+            kwargs["options"] = options
+        if connection_factory is not None:
+            kwargs["connection_factory"] = connection_factory
+        self._pool = pool.ThreadedConnectionPool(
+            1, max(self.settings["pool_size"], 1),
+            self.settings["dsn"],
+            **kwargs
+        )
+
+    def getconn(self):
+        """Take a connection from the pool.
+
+        Returns
+        -------
+        conn : PostgreSQL Connection Instance
+            description -> A connection with the session settings
+            format -> No apply
+            options -> No apply
+        """
+        return self._pool.getconn()
+
+    def putconn(self, conn):
+        """Return a connection to the pool.
+
+        The open transaction of the connection is rolled back, so the
+        next user receives a clean session.
+
+        Parameters
+        ----------
+        conn : PostgreSQL Connection Instance
+            description -> A connection taken with 'getconn'
+            format -> No apply
+            options -> No apply
+        """
+        if not conn.closed:
+            conn.rollback()
+        self._pool.putconn(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Take a connection from the pool and return it at the end.
+
+        Yields
+        ------
+        conn : PostgreSQL Connection Instance
+            description -> A connection with the session settings
+            format -> No apply
+            options -> No apply
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Close all the connections of the pool."""
+        self._pool.closeall()
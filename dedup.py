@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+"""Deduplication state of the log records shared between chunks and files.
+
+When a log file is processed by chunks, the records already sent to
+the database by a previous chunk are dropped from the next chunks, so
+the result is the same as processing the whole file at once
+('LogDedupState'):
+
+    * 'time': One record per second since epoch.
+    * 'users': The last record of each user, a user record is sent
+      again only if it changed.
+    * 'songplay': Duplicated records are sent only once.
+
+A record can only repeat a record of the same second, so the state of
+each chunk only keeps the seconds and songplays from the first second
+of the chunk ('LogDedupState.advance'). The log events are ordered by
+time, the state holds the records of about one chunk and the memory is
+set by the chunk size, not by the file size. The users are bounded as
+the run cache users.
+
+The 'time' and 'users' records are also repeated between the log files
+of a run, the run cache ('RunDedupCache') drops the records already
+sent by previous files, so each upsert of a dimension record reaches
+the database only if the record is new or changed. The cache memory is
+bounded, the least recently seen start times and users are forgotten
+first, a forgotten record is sent again, which is harmless because the
+records are upserted.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import collections
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Propietary imports
+import metrics
+
+# Bounds of the run cache, about 16 bytes by second and 200 bytes by user
+DEFAULT_MAX_SECONDS = 5_000_000
+DEFAULT_MAX_USERS = 500_000
+
+# Start times registered before they are merged into the sorted array
+PENDING_SECONDS = 65_536
+
+class LogDedupState():
+    """Records already sent to the database by previous chunks.
+
+    Attributes
+    ----------
+    max_users : Integer
+        description -> Maximum users kept, the least recently seen are
+            forgotten first
+        format -> No apply
+        options -> No apply
+
+    seconds : Dictionary
+        description -> The start times sent to the table 'time' since
+            the first second of the current chunk, in the order sent
+        format -> {<seconds since epoch>: None}
+        options -> No apply
+
+    users : collections.OrderedDict
+        description -> The last record sent to the table 'users' of
+            each user, from the least to the most recently seen
+        format -> {<user_id>: (<user record values>)}
+        options -> No apply
+
+    songplays : Dictionary
+        description -> Hashes of the records sent to the table
+            'songplay' since the first second of the current chunk, by
+            start time in the order sent
+        format -> {<'YYYY-MM-DDTHH:MM:SS'>: Set of 64-bit integers}
+        options -> No apply
+
+    Methods
+    -------
+    advance : Method
+        Forget the records before the first second of a chunk.
+
+    new_seconds : Method
+        Filter the start times not sent yet.
+
+    new_users : Method
+        Filter the user records new or changed.
+
+    new_songplays : Method
+        Filter the songplays records not sent yet.
+    """
+    def __init__(self, max_users=DEFAULT_MAX_USERS):
+        self.max_users = max_users
+        self.seconds = {}
+        self.users = collections.OrderedDict()
+        self.songplays = {}
+
+    def advance(self, first_second):
+        """Forget the records before the first second of a chunk.
+
+        The records of the chunk can not repeat them. The records are
+        forgotten from the oldest sent, up to the first record not
+        older than the chunk, so with unordered events some older
+        records may be kept longer.
+
+        Parameters
+        ----------
+        first_second : Integer
+            description -> The first start time of the chunk
+            format -> Seconds since epoch
+            options -> No apply
+        """
+        first_time = str(np.datetime64(int(first_second), "s"))
+        for records, first in (
+            (self.seconds, first_second),
+            (self.songplays, first_time)
+        ):
+            while records:
+                oldest = next(iter(records))
+                if oldest >= first:
+                    break
+                del records[oldest]
+
+    def new_seconds(self, seconds):
+        """Filter the start times not sent yet and register them.
+
+        Parameters
+        ----------
+        seconds : Numpy Array
+            description -> Unique start times
+            format -> Seconds since epoch
+            options -> No apply
+
+        Returns
+        -------
+        seconds : Numpy Array
+            description -> The start times not sent yet
+            format -> Seconds since epoch
+            options -> No apply
+        """
+        mask = np.fromiter(
+            (second not in self.seconds for second in seconds.tolist()),
+            dtype=bool,
+            count=len(seconds)
+        )
+        seconds = seconds[mask]
+        self.seconds.update(dict.fromkeys(seconds.tolist()))
+
+        return seconds
+
+    def new_users(self, user_df):
+        """Filter the user records new or changed and register them.
+
+        Parameters
+        ----------
+        user_df : Pandas Dataframe
+            description -> User records, one per user
+            format -> Headers: [
+                "userId",
+                "firstName",
+                "lastName",
+                "gender",
+                "level"
+            ]
+            options -> No apply
+
+        Returns
+        -------
+        user_df : Pandas Dataframe
+            description -> The user records new or changed
+            format -> Same headers of the given dataframe
+            options -> No apply
+        """
+        rows = list(user_df.itertuples(index=False, name=None))
+        mask = [self.users.get(row[0]) != row for row in rows]
+        for row in rows:
+            self.users[row[0]] = row
+            self.users.move_to_end(row[0])
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+
+        return user_df[mask]
+
+    def new_songplays(self, songplays_df):
+        """Filter the songplays records not sent yet and register them.
+
+        Parameters
+        ----------
+        songplays_df : Pandas Dataframe
+            description -> Songplays records without duplicates
+            format -> The start time is the column "ts"
+                ('YYYY-MM-DDTHH:MM:SS')
+            options -> No apply
+
+        Returns
+        -------
+        songplays_df : Pandas Dataframe
+            description -> The songplays records not sent yet
+            format -> Same headers of the given dataframe
+            options -> No apply
+        """
+        hashes = pd.util.hash_pandas_object(songplays_df, index=False)
+        mask = []
+        for start_time, value in zip(
+            songplays_df["ts"].tolist(), hashes.tolist()
+        ):
+            sent = self.songplays.setdefault(start_time, set())
+            mask.append(value not in sent)
+            sent.add(value)
+
+        return songplays_df[mask]
+
+class RunDedupCache():
+    """Dimension records already sent to the database during the run.
+
+    Attributes
+    ----------
+    max_seconds : Integer
+        description -> Maximum start times kept, the least recently
+            seen are forgotten first
+        format -> No apply
+        options -> No apply
+
+    max_users : Integer
+        description -> Maximum users kept, the least recently seen are
+            forgotten first
+        format -> No apply
+        options -> No apply
+
+    seconds : Numpy Array
+        description -> The start times sent to the table 'time', sorted
+        format -> Seconds since epoch, 'int64'
+        options -> No apply
+
+    last_seen : Numpy Array
+        description -> The call of 'new_seconds' that last saw each
+            start time of 'seconds'
+        format -> 'int64'
+        options -> No apply
+
+    users : collections.OrderedDict
+        description -> The last record sent to the table 'users' of
+            each user, from the least to the most recently seen
+        format -> {<user_id>: (<user record values>)}
+        options -> No apply
+
+    skipped : Dictionary
+        description -> Records dropped because they were already sent
+        format -> {"time": <records>, "users": <records>}
+        options -> No apply
+
+    Methods
+    -------
+    new_seconds : Method
+        Filter the start times not sent yet.
+
+    new_users : Method
+        Filter the user records new or changed.
+
+    filter : Method
+        Drop the time and user records already sent of a file.
+
+    forget : Method
+        Forget some records sent, e.g. after they are rejected.
+
+    clear : Method
+        Forget the records sent, e.g. after they are rolled back.
+    """
+    def __init__(
+        self,
+        max_seconds=DEFAULT_MAX_SECONDS,
+        max_users=DEFAULT_MAX_USERS
+    ):
+        self.max_seconds = max_seconds
+        self.max_users = max_users
+        self.seconds = np.empty(0, dtype="int64")
+        self.last_seen = np.empty(0, dtype="int64")
+        self.users = collections.OrderedDict()
+        self.skipped = {"time": 0, "users": 0}
+        self._calls = 0
+        self._pending = np.empty(0, dtype="int64")
+        self._pending_seen = np.empty(0, dtype="int64")
+
+    def new_seconds(self, seconds):
+        """Filter the start times not sent yet and register them.
+
+        * Search the start times in the sorted array and in the pending
+          start times, the start times found are marked as seen by this
+          call.
+        * Add the new start times to the pending start times.
+        * Merge the pending start times into the sorted array with a
+          single sort when they reach 'PENDING_SECONDS' (or an eighth
+          of 'max_seconds'), only the 'max_seconds' most recently seen
+          are kept.
+
+        The sorted array is only copied by the merges, the cache may
+        hold up to an eighth more start times than 'max_seconds' before
+        the next merge. The recency is measured by call, e.g. by log
+        file, the start times last seen by the same call are forgotten
+        in any order.
+
+        Parameters
+        ----------
+        seconds : Numpy Array
+            description -> Unique start times
+            format -> Seconds since epoch
+            options -> No apply
+
+        Returns
+        -------
+        mask : Numpy Array
+            description -> 'True' for the start times not sent yet
+            format -> bool
+            options -> No apply
+        """
+        self._calls += 1
+        seconds = np.asarray(seconds, dtype="int64")
+        known = np.zeros(len(seconds), dtype=bool)
+        for sorted_seconds, last_seen in (
+            (self.seconds, self.last_seen),
+            (self._pending, self._pending_seen)
+        ):
+            positions = np.searchsorted(sorted_seconds, seconds)
+            found = positions < len(sorted_seconds)
+            found[found] = sorted_seconds[positions[found]] == seconds[found]
+            last_seen[positions[found]] = self._calls
+            known |= found
+        mask = ~known
+
+        new_seconds = seconds[mask]
+        if len(new_seconds):
+            pending = np.concatenate([self._pending, new_seconds])
+            order = np.argsort(pending, kind="stable")
+            self._pending = pending[order]
+            self._pending_seen = np.concatenate([
+                self._pending_seen,
+                np.full(len(new_seconds), self._calls, dtype="int64")
+            ])[order]
+            if len(self._pending) >= min(
+                PENDING_SECONDS, max(1, self.max_seconds // 8)
+            ):
+                self._merge_pending()
+        self.skipped["time"] += int(known.sum())
+
+        return mask
+
+    def _merge_pending(self):
+        """Merge the pending start times, forgetting the least recent."""
+        seconds = np.concatenate([self.seconds, self._pending])
+        last_seen = np.concatenate([self.last_seen, self._pending_seen])
+        if len(seconds) > self.max_seconds:
+            # keep the most recently seen, in their order
+            forgotten = len(seconds) - self.max_seconds
+            threshold = np.partition(last_seen, forgotten)[forgotten]
+            keep = last_seen > threshold
+            ties = np.flatnonzero(last_seen == threshold)
+            keep[ties[:self.max_seconds - int(keep.sum())]] = True
+            seconds = seconds[keep]
+            last_seen = last_seen[keep]
+        # both arrays are sorted, the stable sort merges the two runs
+        order = np.argsort(seconds, kind="stable")
+        self.seconds = seconds[order]
+        self.last_seen = last_seen[order]
+        self._pending = np.empty(0, dtype="int64")
+        self._pending_seen = np.empty(0, dtype="int64")
+
+    def new_users(self, user_df):
+        """Filter the user records new or changed and register them.
+
+        Parameters
+        ----------
+        user_df : Pandas Dataframe
+            description -> User records, one per user
+            format -> The user ID is the first column
+            options -> No apply
+
+        Returns
+        -------
+        user_df : Pandas Dataframe
+            description -> The user records new or changed
+            format -> Same headers of the given dataframe
+            options -> No apply
+        """
+        mask = []
+        for row in user_df.itertuples(index=False, name=None):
+            user_id = row[0]
+            new = self.users.get(user_id) != row
+            self.users[user_id] = row
+            self.users.move_to_end(user_id)
+            mask.append(new)
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+        self.skipped["users"] += mask.count(False)
+
+        return user_df[mask]
+
+    def filter(self, log_data):
+        """Drop the time and user records already sent of a file.
+
+        Parameters
+        ----------
+        log_data : Dictionary
+            description -> The records to load by table
+            format -> {
+                "time": Pandas Dataframe,
+                "users": Pandas Dataframe,
+                "songplay": Pandas Dataframe
+            }
+            options -> No apply
+
+        Returns
+        -------
+        log_data : Dictionary
+            description -> The records to load, the time and user
+                records are new or changed
+            format -> Same keys of the given dictionary
+            options -> No apply
+        """
+        time_df = log_data["time"]
+        user_df = log_data["users"]
+        rows_in = len(time_df) + len(user_df)
+        with metrics.stage("dedup:run", rows_in=rows_in) as stage:
+            seconds = start_seconds(time_df)
+            log_data = dict(log_data)
+            log_data["time"] = time_df[self.new_seconds(seconds)]
+            log_data["users"] = self.new_users(user_df)
+            stage.rows_out = len(log_data["time"]) + len(log_data["users"])
+
+        return log_data
+
+    def forget(self, time_df=None, user_df=None):
+        """Forget some time and user records sent.
+
+        The records rejected by the quarantine are not in the database,
+        the next files send them again.
+
+        Parameters
+        ----------
+        time_df : Pandas Dataframe
+            description -> Time records to forget
+            format -> Headers of the 'time' records
+            options -> 'None': Keep the start times.
+
+        user_df : Pandas Dataframe
+            description -> User records to forget
+            format -> The user ID is the first column
+            options -> 'None': Keep the users.
+        """
+        if time_df is not None and not time_df.empty:
+            seconds = start_seconds(time_df)
+            keep = ~np.isin(self.seconds, seconds)
+            self.seconds = self.seconds[keep]
+            self.last_seen = self.last_seen[keep]
+            keep = ~np.isin(self._pending, seconds)
+            self._pending = self._pending[keep]
+            self._pending_seen = self._pending_seen[keep]
+        if user_df is not None:
+            for user_id in user_df.iloc[:, 0]:
+                self.users.pop(user_id, None)
+
+    def clear(self):
+        """Forget the time and user records sent.
+
+        The records of a file rolled back are not in the database, the
+        next files send their records again.
+        """
+        self.seconds = np.empty(0, dtype="int64")
+        self.last_seen = np.empty(0, dtype="int64")
+        self.users = collections.OrderedDict()
+        self._pending = np.empty(0, dtype="int64")
+        self._pending_seen = np.empty(0, dtype="int64")
+
+def start_seconds(time_df):
+    """Start times of the time records as seconds since epoch.
+
+    Parameters
+    ----------
+    time_df : Pandas Dataframe
+        description -> Time records
+        format -> Headers of the 'time' records
+        options -> No apply
+
+    Returns
+    -------
+    seconds : Numpy Array
+        description -> The start time of each record
+        format -> Seconds since epoch, 'int64'
+        options -> No apply
+    """
+    return pd.to_datetime(
+        time_df["start_time"], format="%Y-%m-%dT%H:%M:%S"
+    ).to_numpy(dtype="datetime64[s]").astype("int64")
@@ -5,73 +5,176 @@ Mantaniner: Rolando Gonzalez
 Version: 1.0.0
 """
 # Standard library imports
+import argparse
+import collections
 import glob
+import itertools
 import os
-import re
 import sys
+from concurrent import futures
 
 # Third-party imports
-import psycopg2
+import numpy as np
 import pandas as pd
 
 # Propietary imports
+import async_pipeline
+import batching
+import bulk_load
+import database
+import dedup
+import loaders
+import lookup
+import manifest as ingest_manifest
+import metrics
+import parse_cache
+import partitions as songplay_partitions
+import profiling
+import quarantine
+import rollups as songplay_rollups
 import sql_queries
+import transactions
 
-def single_quote_converter(sentence):
-    """Handle single-quote character, insert a tag identifier instead.
+# Columns of the song files used by the artist and song records
+SONG_FILE_COLUMNS = [
+    "artist_id",
+    "artist_name",
+    "artist_location",
+    "artist_latitude",
+    "artist_longitude",
+    "song_id",
+    "title",
+    "year",
+    "duration"
+]
 
-    From a given string, change all the single-quote characters (') to
-    the following tag:
+@metrics.instrument("transform:song_file")
+def transform_song_file(filepath):
+    """Read a song JSON file and prepare the artist and song records.
 
-        <single_quote_tag>
+    * Read the song JSON file and store data in a dataframe, from the
+      parse cache if it is enabled ('parse_cache.read_json').
+    * Define the attributes to use for artist records.
+    * Define the attributes to use for songs records.
+
+    The function does not use the database, so it can be executed in
+    a worker process.
+
+    Parameters
+    ----------
+    filepath : String
+        description -> The JSON file location as a full path.
+        format -> '<root_path>/data_modeling_postgresql_deu_01/data/
+                   song_data/A/<AB>/<ABC>/<json_file>.json'
+        options -> No apply
+
+    Returns
+    -------
+    song_data : Dictionary
+        description -> The records to load by table
+        format -> {"artists": Pandas Dataframe, "songs": Pandas Dataframe}
+        options -> No apply
+    """
+    # open song file
+    with metrics.stage("read_json"):
+        songs_df = parse_cache.read_json(filepath, SONG_FILE_COLUMNS)
+
+    # artist records
+    columns = [
+        "artist_id",
+        "artist_name",
+        "artist_location",
+        "artist_latitude",
+        "artist_longitude"
+    ]
+    artist_data = songs_df[columns].copy()
+
+    # song records
+    columns = ["song_id", "title", "artist_id", "year", "duration"]
+    song_data = songs_df[columns].copy()
 
-    The SQL statements written in Python and loaded by Pandas usually
-    adds double-quote in attributes of type string if a single-quote
-    appears in a row, the problem of including a double-quote in a SQL
-    statement is that a word between double quotes are interpreted as
-    a column instead a value.
+    return {"artists": artist_data, "songs": song_data}
 
-    To avoid this issue, the single quotes are substituted by the
-    single-quote tag.
+@metrics.instrument("load_song_data")
+def load_song_data(
+    cur,
+    song_data,
+    conn=None,
+    engine=loaders.DEFAULT_ENGINE,
+    lookup_index=None
+):
+    """Load the records prepared by 'transform_song_file'.
 
-    When inserting the tagged word into a SQL generator like
-    'sql_queries.Queries()song_table_insert(dataframe=df, verbose=True)'
-    the build-in method use a regex to replace the tag to the required
-    double single-quote that can be accepted in a SQL INSERT statement.
+    * Load the artist records into table 'artists' with the given
+      engine.
+    * Load the song records into table 'songs' with the given engine.
+    * Add the records to the in-memory index of songs, if it is used.
 
     Parameters
     ----------
-    setence : String
-        description -> A sentence to process to serach single-quotes,
-            if a single-quote is found, it is substituted by the
-            single-quote tag '<single_quote_tag>'
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
         format -> No apply
         options -> No apply
 
+    song_data : Dictionary
+        description -> The records to load by table
+        format -> {"artists": Pandas Dataframe, "songs": Pandas Dataframe}
+        options -> No apply
+
+    conn : PostgreSQL Connection Instance
+        description -> The connection active to the 'sparkify' database
+        format -> No apply
+        options -> 'None': On this method, the connection is not
+            required.
+
+    engine : String
+        description -> The load engine used to insert the records
+        format -> No apply
+        options -> {
+            'copy': COPY into a staging table and merge (default),
+            'execute_values': Records sent as bound parameters,
+            'values': Multi-row 'INSERT ... VALUES' statement
+        }
+
+    lookup_index : lookup.SongLookupIndex Instance
+        description -> In-memory index of the songs and artists
+        format -> No apply
+        options -> 'None': The song IDs and artist IDs are searched
+            with SQL statements.
+
     Returns
     -------
-    sentence : String
-        description -> Sentence filtered of single-quote characters
-        format -> No apply
+    row_counts : Dictionary
+        description -> Number of records of the file by table
+        format -> {"artists": <records>, "songs": <records>}
         options -> No apply
     """
-    sentence = re.sub(r'\'', r'<single_quote_tag>', sentence)
+    del conn
+    # insert artist record
+    loaders.load_dataframe(cur, song_data["artists"], "artists", engine)
 
-    return sentence
+    # insert song record
+    loaders.load_dataframe(cur, song_data["songs"], "songs", engine)
+
+    if lookup_index is not None:
+        lookup_index.update(song_data)
 
-def process_song_file(cur, filepath, conn=None):
+    return record_counts(song_data)
+
+@metrics.instrument("process_song_file")
+def process_song_file(
+    cur,
+    filepath,
+    conn=None,
+    engine=loaders.DEFAULT_ENGINE,
+    lookup_index=None
+):
     """For each song JSON file, process and INSERT records.
 
-    * Initialize the Queries() instance.
-    * Read the song JSON file and store data in a dataframe.
-    * Define the attributes to use for artist records.
-    * Filter string attributes of single-quotes.
-    * Create the query from the dataframe.
-    * Execute query to insert the artist records into table 'artists'.
-    * Define the attributes to use for songs records.
-    * Filter string attributes of single-quotes.
-    * Create the query from the dataframe.
-    * Execute query to insert the song records into table 'songs'.
+    * Prepare the artist and song records ('transform_song_file').
+    * Load the records into the tables 'artists' and 'songs'
+      ('load_song_data').
 
     Parameters
     ----------
@@ -91,169 +194,205 @@ def process_song_file(cur, filepath, conn=None):
         format -> No apply
         options -> 'None': On this method, the connection is not
             required.
+
+    engine : String
+        description -> The load engine used to insert the records
+        format -> No apply
+        options -> {
+            'copy': COPY into a staging table and merge (default),
+            'execute_values': Records sent as bound parameters,
+            'values': Multi-row 'INSERT ... VALUES' statement
+        }
+
+    lookup_index : lookup.SongLookupIndex Instance
+        description -> In-memory index of the songs and artists
+        format -> No apply
+        options -> 'None': The song IDs and artist IDs are searched
+            with SQL statements.
+
+    Returns
+    -------
+    row_counts : Dictionary
+        description -> Number of records of the file by table
+        format -> {"artists": <records>, "songs": <records>}
+        options -> No apply
     """
-    del conn
-    sql = sql_queries.Queries()
-    # open song file
-    songs_df = pd.read_json(filepath, lines=True)
+    song_data = transform_song_file(filepath)
 
-    # insert artist record
-    columns = [
-        "artist_id",
-        "artist_name",
-        "artist_location",
-        "artist_latitude",
-        "artist_longitude"
-    ]
-    artist_data = songs_df[columns].copy()
-    artist_data["artist_name"] = artist_data["artist_name"].map(
-        single_quote_converter, na_action='ignore'
-    )
-    artist_data["artist_location"] = artist_data["artist_location"].map(
-        single_quote_converter, na_action='ignore'
-    )
-    query = sql.artist_table_insert(dataframe=artist_data)
-    cur.execute(query)
+    return load_song_data(cur, song_data, conn, engine, lookup_index)
 
-    # insert song record
-    columns = ["song_id", "title", "artist_id", "year", "duration"]
-    song_data = songs_df[columns].copy()
-    song_data["title"] = song_data["title"].map(
-            single_quote_converter, na_action='ignore'
-    )
-    query = sql.song_table_insert(dataframe=song_data)
-    cur.execute(query)
+@metrics.instrument("transform:time_records")
+def time_records(timestamps, dedup_state=None):
+    """Generate the time records from the log timestamps.
 
-def process_log_file(cur, filepath, conn=None):
-    """For each log JSON file, process and INSERT records.
+    * Drop duplicates of the timestamps, in seconds since epoch (the
+      'time' table stores the start time in seconds), and the seconds
+      registered in the deduplication state.
+    * Convert the unique timestamps to datetime.
+    * Derive the attributes with vectorized operations over the whole
+      column, the week is the ISO week and the weekday starts at '1'
+      on Monday.
+
+    Parameters
+    ----------
+    timestamps : Pandas Series
+        description -> The log timestamps
+        format -> Milliseconds since epoch
+        options -> No apply
+
+    dedup_state : dedup.LogDedupState Instance
+        description -> The records already prepared by previous calls
+        format -> No apply
+        options -> 'None': Deduplicate only the given timestamps.
+
+    Returns
+    -------
+    time_df : Pandas Dataframe
+        description -> The time records, one per unique second, in the
+            order of the first occurrence
+        format -> Headers: [
+            "start_time",
+            "hour",
+            "day",
+            "week",
+            "month",
+            "year",
+            "weekday"
+        ]
+        options -> No apply
+    """
+    seconds = pd.unique(timestamps.to_numpy(dtype="int64") // 1_000)
+    if dedup_state is not None:
+        seconds = dedup_state.new_seconds(seconds)
+    start_time = pd.Series(pd.to_datetime(seconds, unit='s'))
+
+    time_df = pd.DataFrame({
+        "start_time": np.datetime_as_string(
+            start_time.to_numpy(dtype="datetime64[s]"), unit='s'
+        ),
+        "hour": start_time.dt.hour,
+        "day": start_time.dt.day,
+        "week": start_time.dt.isocalendar()["week"],
+        "month": start_time.dt.month,
+        "year": start_time.dt.year,
+        "weekday": start_time.dt.weekday + 1
+    })
+    time_df = time_df.astype({
+        "hour": "int64",
+        "day": "int64",
+        "week": "int64",
+        "month": "int64",
+        "year": "int64",
+        "weekday": "int64"
+    })
+
+    return time_df
+
+@metrics.instrument("transform:log_file")
+def transform_log_file(filepath):
+    """Read a log JSON file and prepare the time, user and songplays records.
 
-    * Initialize the Queries() instance.
-    * Read the log JSON file and store data in a dataframe.
+    * Read the log JSON file and store data in a dataframe, from the
+      parse cache if it is enabled ('parse_cache.read_json').
+    * Prepare the records of the dataframe ('transform_log_frame').
+
+    The function does not use the database, so it can be executed in
+    a worker process.
+
+    Parameters
+    ----------
+    filepath : String
+        description -> The JSON file location as a full path.
+        format -> '<root_path>/data_modeling_postgresql_deu_01/data/
+                   log_data/<YYYY>/<MM>/<json_file_name>.json'
+        options -> No apply
+
+    Returns
+    -------
+    log_data : Dictionary
+        description -> The records to load by table, the songplays
+            records still have the song title, artist name and song
+            length instead the song ID and artist ID
+        format -> {
+            "time": Pandas Dataframe,
+            "users": Pandas Dataframe,
+            "songplay": Pandas Dataframe
+        }
+        options -> No apply
+    """
+    # open log file
+    with metrics.stage("read_json"):
+        logs_df = parse_cache.read_json(filepath)
+
+    return transform_log_frame(logs_df)
+
+@metrics.instrument("transform:log_frame")
+def transform_log_frame(logs_df, dedup_state=None):
+    """Prepare the time, user and songplays records of log events.
+
+    * Filter the events by NextSong action.
+    * Generate the time records from the timestamps ('time_records').
     * Convert column of datetime into human-readble format.
-    * Create a list of values with data generated from the datetime.
-    * Define attributes names.
-    * Generate a dataframe from list and dictionaries.
-    * Drop duplicates.
-    * Reorder attributes in the dataframe, order is important, the SQL
-      query generator required it.
-    * Insert time records by batches to the table 'time':
-        * Each batch sends up to 5,000 records.
-        * Create the batch query SQL statement from the dataframe.
-        * Execute the query and commit to the database.
     * Define the attributes to use for user records.
     * Create the users dataframe
-    * Filter string attributes of single-quotes.
-    * Insert users records by batches to the table 'users':
-        * Each batch sends up to 5,000 records.
-        * Create the batch query SQL statement from the dataframe.
-        * Execute the query and commit to the database.
     * Define the attributes to use for songplay records.
     * Generate the songplays dataframe.
     * Convert attribute of datetime into human-readble format.
-    * Filter string attributes of single-quotes.
     * Create index attribute to control the order of records.
-    * Use a SQL statement to change song title and artist name, using
-      additionally the song duration and index to retrieve the
-      corresponding song id and artist id.
-    * Insert the results in the dataframe, if the song and artist is
-      missed, insert a null value instead.
-    * Drop the columns related to song duration and index order.
-    * Insert songplays records by batches to the table 'songplays':
-        * Each batch sends up to 5,000 records.
-        * Create the batch query SQL statement from the dataframe.
-        * Execute the query and commit to the database.
+
+    With a deduplication state, the records already prepared by
+    previous calls (e.g. previous chunks of the same file) are dropped,
+    the state forgets the records before the first second of the
+    events ('dedup.LogDedupState.advance').
 
     Parameters
     ----------
-    cur : PostgreSQL Cursor Instance
-        description -> The cursor required to execute build-in queries.
+    logs_df : Pandas Dataframe
+        description -> The log events, as read from a log JSON file
         format -> No apply
         options -> No apply
 
-    filepath : String
-        description -> The JSON file location as a full path.
-        format -> '<root_path>/data_modeling_postgresql_deu_01/data/
-                   song_data/A/<AB>/<ABC>/<json_file_name>.json'
-        options -> No apply
-
-    conn : PostgreSQL Connection Instance
-        description -> The connection active to the 'sparkifydb' database
+    dedup_state : dedup.LogDedupState Instance
+        description -> The records already prepared by previous calls
         format -> No apply
-        options -> On this method, the connection is required, None
-            value is not allowed.
-    """
-    sql = sql_queries.Queries()
-    # open log file
-    logs_df = pd.read_json(filepath, lines=True)
+        options -> 'None': Deduplicate only the given events.
 
+    Returns
+    -------
+    log_data : Dictionary
+        description -> The records to load by table, the songplays
+            records still have the song title, artist name and song
+            length instead the song ID and artist ID
+        format -> {
+            "time": Pandas Dataframe,
+            "users": Pandas Dataframe,
+            "songplay": Pandas Dataframe
+        }
+        options -> No apply
+    """
     # filter by NextSong action
-    logs_df = logs_df[logs_df["page"] == 'NextSong']
+    logs_df = logs_df[logs_df["page"] == 'NextSong'].copy()
+    if dedup_state is not None and len(logs_df):
+        dedup_state.advance(int(logs_df["ts"].min()) // 1_000)
+
+    # time data records
+    time_df = time_records(logs_df["ts"], dedup_state)
 
     # convert timestamp column to datetime
     logs_df["ts"] = pd.to_datetime(logs_df["ts"], unit='ms')
 
-    # insert time data records
-    time_data = list(
-        map(
-            lambda item: [
-                item.strftime('%Y-%m-%dT%H:%M:%S'),
-                item.hour,
-                item.day,
-                item.week,
-                item.month,
-                item.year,
-                item.weekday() + 1
-            ],
-            logs_df["ts"].copy()
-        )
-    )
-    column_labels = [
-        'start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'
-    ]
-    time_list_dict = [dict(zip(column_labels, row)) for row in time_data]
-    time_df = pd.DataFrame(time_list_dict)
-    time_df = time_df.drop_duplicates()
-    time_df = time_df.reset_index(drop=True)
-    time_df = time_df[column_labels]
-
-    # Insert time records by batch queries.
-    start_index = 0
-    end_index = time_df.shape[0]
-    batch_size = 5_000
-    for index in range(start_index, end_index, batch_size):
-        print(f"\nSend 'time' records batch from idx '{index}'...")
-        query = sql.time_table_insert(
-            dataframe=time_df.iloc[index:index + batch_size]
-        )
-        cur.execute(query)
-        conn.commit()
-
-    # load user table
-    columns = ["userId", "firstName", "lastName", "gender", "level"]
-    user_df = logs_df[columns].copy()
-    user_df["firstName"] = user_df["firstName"].map(
-        single_quote_converter, na_action='ignore'
-    )
-    user_df["lastName"] = user_df["lastName"].map(
-        single_quote_converter, na_action='ignore'
-    )
-    user_df["gender"] = user_df["gender"].str.upper()
-    user_df["userId"] = user_df["userId"].astype(str)
-    user_df = user_df.drop_duplicates()
-    user_df = user_df.drop_duplicates(subset='userId', keep='last')
-    user_df = user_df.reset_index(drop=True)
-
-    # Insert user records by batch queries.
-    start_index = 0
-    end_index = user_df.shape[0]
-    batch_size = 5_000
-    for index in range(start_index, end_index, batch_size):
-        print(f"Send 'users' records batch from idx '{index}'...")
-        query = sql.user_table_insert(
-            dataframe=user_df.iloc[index:index + batch_size]
-        )
-        cur.execute(query)
-        conn.commit()
+    # user records
+    with metrics.stage("transform:users", rows_in=len(logs_df)) as stage:
+        columns = ["userId", "firstName", "lastName", "gender", "level"]
+        user_df = logs_df[columns].copy()
+        user_df["gender"] = user_df["gender"].str.upper()
+        user_df["userId"] = user_df["userId"].astype(str)
+        user_df = user_df.drop_duplicates()
+        user_df = user_df.drop_duplicates(subset='userId', keep='last')
+        if dedup_state is not None:
+            user_df = dedup_state.new_users(user_df)
+        user_df = user_df.reset_index(drop=True)
+        stage.rows_out = len(user_df)
 
     # Prepare df
     columns = [
@@ -272,66 +411,99 @@ def process_log_file(cur, filepath, conn=None):
 
     # Format timestamp tp be upload in the database
     songplays_df["ts"] = songplays_df["ts"].dt.strftime('%Y-%m-%dT%H:%M:%S')
-
-    # Apply filtering of single quotes
-    songplays_df["song"] = songplays_df["song"].map(
-        single_quote_converter, na_action='ignore'
-    )
-    songplays_df["artist"] = songplays_df["artist"].map(
-        single_quote_converter, na_action='ignore'
-    )
-    songplays_df["location"] = songplays_df["location"].map(
-        single_quote_converter, na_action='ignore'
-    )
     songplays_df = songplays_df.drop_duplicates()
+    if dedup_state is not None:
+        songplays_df = dedup_state.new_songplays(songplays_df)
     songplays_df = songplays_df.reset_index(drop=True)
     songplays_df = songplays_df.reset_index(level=0)
 
+    return {"time": time_df, "users": user_df, "songplay": songplays_df}
+
+@metrics.instrument("resolve_song_ids")
+def resolve_song_ids(cur, songplays_df, lookup_index=None):
+    """Replace the song title and artist name by the song and artist IDs.
+
+    * Use a SQL statement to change song title and artist name, using
+      additionally the song duration and index to retrieve the
+      corresponding song id and artist id, the records are sent as
+      bound parameters. If the in-memory index of songs is used, the
+      IDs are found with a merge in memory instead.
+    * Insert the results in the dataframe, if the song and artist is
+      missed, insert a null value instead.
+    * Drop the columns related to song duration and index order.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    songplays_df : Pandas Dataframe
+        description -> The songplays records prepared by
+            'transform_log_frame'
+        format -> No apply
+        options -> No apply
+
+    lookup_index : lookup.SongLookupIndex Instance
+        description -> In-memory index of the songs and artists
+        format -> No apply
+        options -> 'None': The song IDs and artist IDs are searched
+            with SQL statements.
+
+    Returns
+    -------
+    songplays_df : Pandas Dataframe
+        description -> The songplays records ready to load
+        format -> Columns ordered as 'sql_queries.TABLE_SPECS["songplay"]'
+        options -> No apply
+    """
     # Insert song_id and artist_id into the dataframe
-    start_index = 0
-    end_index = songplays_df.shape[0]
-    batch_size = 5_000
     columns_in = ["index", "song", "artist", "length"]
     columns_out = ["song", "artist"]
-    for index in range(start_index, end_index, batch_size):
-        print(f"Get 'song_id' and 'artist_id' on batch from idx '{index}'...")
-        query = sql.song_select(
-            dataframe=songplays_df[columns_in].iloc[index:index + batch_size]
+    for batch_df in batching.batches("lookup", songplays_df[columns_in]):
+        if lookup_index is None or lookup_index.overflow:
+            ids_df = loaders.select_song_ids(cur, batch_df)
+        else:
+            ids_df = lookup_index.resolve(batch_df)
+        songplays_df.loc[ids_df.index, columns_out] = (
+            ids_df[columns_out].values
         )
-        temp_df = pd.read_sql(query, conn)
-        songplays_df.loc[index:index + temp_df.shape[0], columns_out] = temp_df
-
-    songplays_df[columns_out] = songplays_df[columns_out].astype(str)
-    songplays_df[columns_out[0]] = songplays_df[columns_out[0]].map(
-        lambda value: value if value != 'None' else 'nan'
-    )
-    songplays_df[columns_out[1]] = songplays_df[columns_out[1]].map(
-        lambda value: value if value != 'None' else 'nan'
-    )
-    songplays_df = songplays_df.drop(columns=['index', 'length'])
 
-    # Insert songplays records by batch queries
-    start_index = 0
-    end_index = songplays_df.shape[0]
-    batch_size = 5_000
-    for index in range(start_index, end_index, batch_size):
-        print(f"Send 'songplays' records batch from idx '{index}'...")
-        query = sql.songplay_table_insert(
-            dataframe=songplays_df.iloc[index:index + batch_size]
-        )
-        cur.execute(query)
-        conn.commit()
+    return songplays_df.drop(columns=['index', 'length'])
 
-def process_data(cur, conn, filepath, func):
-    """Read datasts directory an execute process to insert records.
+@metrics.instrument("write_log_data")
+def write_log_data(
+    cur,
+    log_data,
+    conn=None,
+    engine=loaders.DEFAULT_ENGINE,
+    run_cache=None,
+    partitions=None,
+    batch_commit=True
+):
+    """Load the time, user and songplays records with resolved song IDs.
 
-    * Get the list of JSON files in the given 'filepath'.
-    * Shows the total number of files found.
-    * Iterate each file name.
-        * Use the function given in 'func' and the current file path to
-          process JSON data and execute INSERT statements.
-        * Commit the SQL statements to INSERY records into Sparkify's
-          database
+    * Drop the time and user records already sent by previous files of
+      the run, if a run cache is given. The records rejected by the
+      quarantine are forgotten by the run cache after their load.
+    * Insert time records by batches to the table 'time':
+        * Each batch sends up to 5,000 records, or the records of its
+          adaptive batch size ('batching.batches').
+        * Load the batch with the given engine.
+        * Commit to the database, if the batches are committed.
+    * Insert users records by batches to the table 'users':
+        * Each batch sends up to 5,000 records, or the records of its
+          adaptive batch size ('batching.batches').
+        * Load the batch with the given engine.
+        * Commit to the database, if the batches are committed.
+    * If 'songplay' is partitioned, create the partitions of the new
+      months and sort the songplays records by start time.
+    * Insert songplays records by batches to the table 'songplays':
+        * Each batch sends up to 5,000 records, or the records of its
+          adaptive batch size ('batching.batches').
+        * Load the batch with the given engine.
+        * Commit to the database, if the batches are committed.
 
     Parameters
     ----------
@@ -340,70 +512,1502 @@ def process_data(cur, conn, filepath, func):
         format -> No apply
         options -> No apply
 
+    log_data : Dictionary
+        description -> The records to load by table, the songplays
+            records already have the song ID and artist ID
+            ('resolve_song_ids')
+        format -> {
+            "time": Pandas Dataframe,
+            "users": Pandas Dataframe,
+            "songplay": Pandas Dataframe
+        }
+        options -> No apply
+
     conn : PostgreSQL Connection Instance
-    description -> The connection active to the 'sparkifydb' database
-    format -> No apply
-    options -> No apply
+        description -> The connection active to the 'sparkifydb' database
+        format -> No apply
+        options -> On this method, the connection is required, None
+            value is not allowed.
 
-    filepath : String
-        description -> The path to specific data
+    engine : String
+        description -> The load engine used to insert the records
         format -> No apply
         options -> {
-            'data/song_data': To get song JSON file names,
-            ''data/log_data': To get logs JSON file names
+            'copy': COPY into a staging table and merge (default),
+            'execute_values': Records sent as bound parameters,
+            'values': Multi-row 'INSERT ... VALUES' statement
         }
 
-    func : Functiom
-        description -> The required function to process specific JSON
-            file
+    run_cache : dedup.RunDedupCache Instance
+        description -> The time and user records sent during the run
         format -> No apply
-        options -> {
-            process_song_file: Use it to process the song JSON files,
-            process_log_file: Use it to process the logs JSON files
-        }
+        options -> 'None': Send all the given records.
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay'
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    batch_commit : bool
+        description -> Commit each batch of records
+        format -> No apply
+        options -> 'False': The commit is done by the caller
+            ('transactions.FileTransactions').
+
+    Returns
+    -------
+    row_counts : Dictionary
+        description -> Number of records of the file by table
+        format -> {"time": <records>, "users": <records>,
+                   "songplay": <records>}
+        options -> No apply
     """
-    # get all files matching extension from directory
-    all_files = []
-    for root, _, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for file_name in files :
-            all_files.append(os.path.abspath(file_name))
+    if run_cache is not None:
+        log_data = run_cache.filter(log_data)
+    row_counts = record_counts(log_data)
+    time_df = log_data["time"]
+    user_df = log_data["users"]
+    songplays_df = log_data["songplay"]
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    # Insert time records by batch queries.
+    for batch_df in batching.batches("time", time_df):
+        loaders.load_dataframe(cur, batch_df, "time", engine)
+        if batch_commit:
+            conn.commit()
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile, conn)
-        conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+    # Insert user records by batch queries.
+    for batch_df in batching.batches("users", user_df):
+        loaders.load_dataframe(cur, batch_df, "users", engine)
+        if batch_commit:
+            conn.commit()
 
-def main():
-    """Main to execute complete ETL pipeline.
+    # The rejected records are sent again by the next files
+    if run_cache is not None:
+        run_cache.forget(
+            quarantine.pop_rejected("time"), quarantine.pop_rejected("users")
+        )
 
-    * Open connection to the Sparkify's database.
-    * Create the SQL cursor instance.
-    * Process and insert song JSON files.
-    * Process and insert logs JSON files.
-    * Create a query to retrieve records with complete data from the
-      'songplays' table.
-    * Execute and commit the query to print the total number of records
-      with complete data.
-    * Print the loaded data.
-    * Close connection.
-    """
-    conn = psycopg2.connect(
-        user="admin",
-        password="<password>",
-        host="localhost",
-        port="5432",
-        dbname="sparkifydb"
-    )
-    cur = conn.cursor()
+    # Route the songplays records to the monthly partitions
+    if partitions is not None:
+        partitions.ensure(cur, songplays_df.iloc[:, 0])
+        songplays_df = partitions.sort(songplays_df)
+
+    # Insert songplays records by batch queries
+    for batch_df in batching.batches("songplay", songplays_df):
+        loaders.load_dataframe(cur, batch_df, "songplay", engine)
+        if batch_commit:
+            conn.commit()
+
+    return row_counts
+
+def load_log_data(
+    cur,
+    log_data,
+    conn=None,
+    engine=loaders.DEFAULT_ENGINE,
+    lookup_index=None,
+    run_cache=None,
+    partitions=None,
+    batch_commit=True
+):
+    """Load the records prepared by 'transform_log_file'.
+
+    * Find the song IDs and artist IDs of the songplays records
+      ('resolve_song_ids').
+    * Insert the time, user and songplays records by batches
+      ('write_log_data').
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    log_data : Dictionary
+        description -> The records to load by table
+        format -> {
+            "time": Pandas Dataframe,
+            "users": Pandas Dataframe,
+            "songplay": Pandas Dataframe
+        }
+        options -> No apply
+
+    conn : PostgreSQL Connection Instance
+        description -> The connection active to the 'sparkifydb' database
+        format -> No apply
+        options -> On this method, the connection is required, None
+            value is not allowed.
+
+    engine : String
+        description -> The load engine used to insert the records
+        format -> No apply
+        options -> {
+            'copy': COPY into a staging table and merge (default),
+            'execute_values': Records sent as bound parameters,
+            'values': Multi-row 'INSERT ... VALUES' statement
+        }
+
+    lookup_index : lookup.SongLookupIndex Instance
+        description -> In-memory index of the songs and artists
+        format -> No apply
+        options -> 'None': The song IDs and artist IDs are searched
+            with SQL statements.
+
+    run_cache : dedup.RunDedupCache Instance
+        description -> The time and user records sent during the run
+        format -> No apply
+        options -> 'None': Send all the given records.
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay'
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    batch_commit : bool
+        description -> Commit each batch of records
+        format -> No apply
+        options -> 'False': The commit is done by the caller.
+
+    Returns
+    -------
+    row_counts : Dictionary
+        description -> Number of records of the file by table
+        format -> {"time": <records>, "users": <records>,
+                   "songplay": <records>}
+        options -> No apply
+    """
+    log_data = dict(log_data)
+    log_data["songplay"] = resolve_song_ids(
+        cur, log_data["songplay"], lookup_index
+    )
+
+    return write_log_data(
+        cur, log_data, conn, engine, run_cache, partitions, batch_commit
+    )
+
+@metrics.instrument("process_log_file")
+def process_log_file(
+    cur,
+    filepath,
+    conn=None,
+    engine=loaders.DEFAULT_ENGINE,
+    lookup_index=None,
+    chunk_size=None,
+    run_cache=None,
+    partitions=None,
+    batch_commit=True
+):
+    """For each log JSON file, process and INSERT records.
+
+    * Prepare the time, user and songplays records
+      ('transform_log_file').
+    * Load the records into the tables 'time', 'users' and 'songplay'
+      ('load_log_data').
+
+    With a chunk size, the file is read and loaded by chunks of events,
+    the duplicated records between chunks are dropped, so the memory
+    used depends on the chunk size instead the file size.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    filepath : String
+        description -> The JSON file location as a full path.
+        format -> '<root_path>/data_modeling_postgresql_deu_01/data/
+                   log_data/<YYYY>/<MM>/<json_file_name>.json'
+        options -> No apply
+
+    conn : PostgreSQL Connection Instance
+        description -> The connection active to the 'sparkifydb' database
+        format -> No apply
+        options -> On this method, the connection is required, None
+            value is not allowed.
+
+    engine : String
+        description -> The load engine used to insert the records
+        format -> No apply
+        options -> {
+            'copy': COPY into a staging table and merge (default),
+            'execute_values': Records sent as bound parameters,
+            'values': Multi-row 'INSERT ... VALUES' statement
+        }
+
+    lookup_index : lookup.SongLookupIndex Instance
+        description -> In-memory index of the songs and artists
+        format -> No apply
+        options -> 'None': The song IDs and artist IDs are searched
+            with SQL statements.
+
+    chunk_size : Integer
+        description -> Number of events read and loaded at once
+        format -> No apply
+        options -> 'None': Read and load the whole file at once.
+
+    run_cache : dedup.RunDedupCache Instance
+        description -> The time and user records sent during the run,
+            the records sent by previous files are dropped
+        format -> No apply
+        options -> 'None': Send all the records of the file.
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay', the
+            partitions of new months are created
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    batch_commit : bool
+        description -> Commit each batch of records
+        format -> No apply
+        options -> 'False': The commit is done by the caller.
+
+    Returns
+    -------
+    row_counts : Dictionary
+        description -> Number of records of the file by table
+        format -> {"time": <records>, "users": <records>,
+                   "songplay": <records>}
+        options -> No apply
+    """
+    if chunk_size is None:
+        log_data = transform_log_file(filepath)
+
+        return load_log_data(
+            cur,
+            log_data,
+            conn,
+            engine,
+            lookup_index,
+            run_cache,
+            partitions,
+            batch_commit
+        )
+
+    # read and load the log file by chunks
+    row_counts = {"time": 0, "users": 0, "songplay": 0}
+    dedup_state = dedup.LogDedupState()
+    with pd.read_json(filepath, lines=True, chunksize=chunk_size) as reader:
+        for logs_df in reader:
+            log_data = transform_log_frame(logs_df, dedup_state)
+            del logs_df
+            chunk_counts = load_log_data(
+                cur,
+                log_data,
+                conn,
+                engine,
+                lookup_index,
+                run_cache,
+                partitions,
+                batch_commit
+            )
+            for table, records in chunk_counts.items():
+                row_counts[table] += records
+
+    return row_counts
+
+# Log events attributes kept in the table 'staging_events'
+STAGING_EVENT_COLUMNS = {
+    "ts": "ts",
+    "userId": "user_id",
+    "firstName": "first_name",
+    "lastName": "last_name",
+    "gender": "gender",
+    "level": "level",
+    "song": "song",
+    "artist": "artist",
+    "length": "length",
+    "sessionId": "session_id",
+    "location": "location",
+    "userAgent": "user_agent"
+}
+
+def staging_event_records(logs_df):
+    """Prepare the raw NextSong events to load into 'staging_events'.
+
+    * Filter the events by NextSong action.
+    * Keep and rename the attributes of the table 'staging_events'.
+
+    Parameters
+    ----------
+    logs_df : Pandas Dataframe
+        description -> The log events, as read from a log JSON file
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    events_df : Pandas Dataframe
+        description -> The NextSong events
+        format -> Columns ordered as
+            'sql_queries.TABLE_SPECS["staging_events"]'
+        options -> No apply
+    """
+    events_df = logs_df.loc[
+        logs_df["page"] == 'NextSong', list(STAGING_EVENT_COLUMNS)
+    ]
+    events_df = events_df.rename(columns=STAGING_EVENT_COLUMNS)
+    events_df["user_id"] = events_df["user_id"].astype(str)
+
+    return events_df
+
+@metrics.instrument("transform:log_events")
+def transform_log_events(filepath):
+    """Read a log JSON file and prepare the raw NextSong events.
+
+    The function does not use the database, so it can be executed in
+    a worker process.
+
+    Parameters
+    ----------
+    filepath : String
+        description -> The JSON file location as a full path.
+        format -> '<root_path>/data_modeling_postgresql_deu_01/data/
+                   log_data/<YYYY>/<MM>/<json_file_name>.json'
+        options -> No apply
+
+    Returns
+    -------
+    log_data : Dictionary
+        description -> The events to load into 'staging_events'
+        format -> {"staging_events": Pandas Dataframe}
+        options -> No apply
+    """
+    logs_df = parse_cache.read_json(filepath)
+
+    return {"staging_events": staging_event_records(logs_df)}
+
+@metrics.instrument("merge_staged_events")
+def merge_staged_events(cur, partitions=None):
+    """Insert the records of the staged events into the tables.
+
+    The time, user and songplays records are generated by set-based
+    'INSERT ... SELECT' statements executed in the server, the song IDs
+    and artist IDs are found in the songplays statement. If 'songplay'
+    is partitioned, the partitions of the new months are created first.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay'
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    Returns
+    -------
+    row_counts : Dictionary
+        description -> Number of records inserted or updated by table
+        format -> {"time": <records>, "users": <records>,
+                   "songplay": <records>}
+        options -> No apply
+    """
+    sql = sql_queries.Queries()
+    if partitions is not None:
+        partitions.ensure_staged(cur)
+    row_counts = {}
+    for table, query in (
+        ("time", sql.time_table_insert_from_staging()),
+        ("users", sql.user_table_insert_from_staging()),
+        ("songplay", sql.songplay_table_insert_from_staging())
+    ):
+        cur.execute(query)
+        row_counts[table] = max(cur.rowcount, 0)
+
+    return row_counts
+
+def load_staged_log_data(cur, log_data, conn=None, partitions=None):
+    """Load the events prepared by 'transform_log_events'.
+
+    * Create the table 'staging_events' if it does not exist and empty
+      it.
+    * Stream the events into the table with 'COPY FROM STDIN'.
+    * Insert the time, user and songplays records with set-based
+      statements ('merge_staged_events').
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    log_data : Dictionary
+        description -> The events to load
+        format -> {"staging_events": Pandas Dataframe}
+        options -> No apply
+
+    conn : PostgreSQL Connection Instance
+        description -> The connection active to the 'sparkifydb' database
+        format -> No apply
+        options -> The commit is done by the caller.
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay'
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    Returns
+    -------
+    row_counts : Dictionary
+        description -> Number of records inserted or updated by table
+        format -> {"time": <records>, "users": <records>,
+                   "songplay": <records>}
+        options -> No apply
+    """
+    sql = sql_queries.Queries()
+    cur.execute(sql.staging_events_table_create)
+    cur.execute(sql.staging_events_truncate())
+    loaders.load_dataframe(
+        cur, log_data["staging_events"], "staging_events", engine="copy"
+    )
+
+    return merge_staged_events(cur, partitions)
+
+@metrics.instrument("process_log_file_staged")
+def process_log_file_staged(
+    cur,
+    filepath,
+    conn=None,
+    chunk_size=None,
+    partitions=None
+):
+    """For each log JSON file, stage the events and INSERT records.
+
+    * Create the table 'staging_events' if it does not exist and empty
+      it.
+    * Read the NextSong events and stream them into the table, by
+      chunks if a chunk size is given.
+    * Insert the time, user and songplays records with set-based
+      statements ('merge_staged_events').
+
+    The events of all the chunks are staged before the records are
+    inserted, so the result does not depend on the chunk size.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    filepath : String
+        description -> The JSON file location as a full path.
+        format -> '<root_path>/data_modeling_postgresql_deu_01/data/
+                   log_data/<YYYY>/<MM>/<json_file_name>.json'
+        options -> No apply
+
+    conn : PostgreSQL Connection Instance
+        description -> The connection active to the 'sparkifydb' database
+        format -> No apply
+        options -> The commit is done by the caller.
+
+    chunk_size : Integer
+        description -> Number of events read and staged at once
+        format -> No apply
+        options -> 'None': Read and stage the whole file at once.
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay'
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    Returns
+    -------
+    row_counts : Dictionary
+        description -> Number of records inserted or updated by table
+        format -> {"time": <records>, "users": <records>,
+                   "songplay": <records>}
+        options -> No apply
+    """
+    if chunk_size is None:
+        log_data = transform_log_events(filepath)
+
+        return load_staged_log_data(cur, log_data, conn, partitions)
+
+    sql = sql_queries.Queries()
+    cur.execute(sql.staging_events_table_create)
+    cur.execute(sql.staging_events_truncate())
+    with pd.read_json(filepath, lines=True, chunksize=chunk_size) as reader:
+        for logs_df in reader:
+            loaders.load_dataframe(
+                cur,
+                staging_event_records(logs_df),
+                "staging_events",
+                engine="copy"
+            )
+
+    return merge_staged_events(cur, partitions)
+
+# Stages of each file process, the transform stage is executed by the
+# worker processes and the load stage by the writer connection.
+FILE_STAGES = {
+    process_song_file: (transform_song_file, load_song_data),
+    process_log_file: (transform_log_file, load_log_data),
+    process_log_file_staged: (transform_log_events, load_staged_log_data)
+}
+
+# Key attributes used to deduplicate the buffered song files records
+SONG_BUFFER_KEYS = {"artists": "artist_id", "songs": "song_id"}
+
+def transform_files(all_files, transform, workers):
+    """Execute the transform stage of the files in worker processes.
+
+    The files are submitted to a pool of processes, keeping at most two
+    files per worker in flight to cap the memory used by the prepared
+    records, and the results are returned in the same order of the
+    given files, so the load order is deterministic.
+
+    Parameters
+    ----------
+    all_files : String List
+        description -> The JSON files location as full paths
+        format -> No apply
+        options -> No apply
+
+    transform : Function
+        description -> The transform stage of the files
+        format -> No apply
+        options -> {transform_song_file, transform_log_file}
+
+    workers : Integer
+        description -> Number of worker processes
+        format -> No apply
+        options -> No apply
+
+    Yields
+    ------
+    datafile : String
+        description -> The JSON file location as full path
+        format -> No apply
+        options -> No apply
+
+    data : Dictionary
+        description -> The records returned by 'transform' for the file
+        format -> No apply
+        options -> No apply
+    """
+    files = iter(all_files)
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque(
+            (datafile, executor.submit(transform, datafile))
+            for datafile in itertools.islice(files, workers * 2)
+        )
+        while pending:
+            datafile, future = pending.popleft()
+            data = future.result()
+            next_file = next(files, None)
+            if next_file is not None:
+                pending.append(
+                    (next_file, executor.submit(transform, next_file))
+                )
+            yield datafile, data
+
+def profile_transform(all_files, transform):
+    """Transform the files in the current process, profiling each one.
+
+    Parameters
+    ----------
+    all_files : String List
+        description -> The JSON files location as full paths
+        format -> No apply
+        options -> No apply
+
+    transform : Function
+        description -> The transform stage of 'FILE_STAGES'
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    transformed : Generator
+        description -> The records of each file, in the files order
+        format -> (<file_path>, Dictionary)
+        options -> No apply
+    """
+    for datafile in all_files:
+        with profiling.profile_file(datafile):
+            data = transform(datafile)
+        yield datafile, data
+
+def record_counts(data):
+    """Number of records by table of a transformed file.
+
+    Parameters
+    ----------
+    data : Dictionary
+        description -> The records by table
+        format -> {<table>: Pandas Dataframe}
+        options -> No apply
+
+    Returns
+    -------
+    row_counts : Dictionary
+        description -> Number of records by table
+        format -> {<table>: <records>}
+        options -> No apply
+    """
+    return {
+        table: int(dataframe.shape[0]) for table, dataframe in data.items()
+    }
+
+def reset_run_state(
+    cur,
+    lookup_index=None,
+    run_cache=None,
+    partitions=None,
+    **kwargs
+):
+    """Discard the in-memory state of the records rolled back.
+
+    * Load again the in-memory index of songs, the songs of the file
+      rolled back are not in the database.
+    * Forget the time and user records sent during the run.
+    * Retrieve again the monthly partitions of 'songplay'.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    lookup_index : lookup.SongLookupIndex Instance
+        description -> In-memory index of the songs and artists
+        format -> No apply
+        options -> 'None': The index is not used.
+
+    run_cache : dedup.RunDedupCache Instance
+        description -> The time and user records sent during the run
+        format -> No apply
+        options -> 'None': The cache is not used.
+
+    partitions : partitions.SongplayPartitions Instance
+        description -> The monthly partitions of 'songplay'
+        format -> No apply
+        options -> 'None': The table 'songplay' is not partitioned.
+
+    kwargs : Keyword Arguments
+        description -> The other options given to the process function,
+            they do not keep state
+        format -> No apply
+        options -> No apply
+    """
+    if lookup_index is not None:
+        lookup_index.reload(cur)
+    if run_cache is not None:
+        run_cache.clear()
+    if partitions is not None:
+        partitions.reload(cur)
+
+def list_files(filepath):
+    """Get the JSON files of a datasets directory.
+
+    Parameters
+    ----------
+    filepath : String
+        description -> The path to specific data
+        format -> No apply
+        options -> {
+            'data/song_data': To get song JSON file names,
+            ''data/log_data': To get logs JSON file names
+        }
+
+    Returns
+    -------
+    all_files : String List
+        description -> The JSON files location as full paths
+        format -> No apply
+        options -> No apply
+    """
+    all_files = []
+    for root, _, files in os.walk(filepath):
+        files = glob.glob(os.path.join(root,'*.json'))
+        for file_name in files :
+            all_files.append(os.path.abspath(file_name))
+
+    return all_files
+
+@metrics.instrument("process_data")
+def process_data(
+    cur,
+    conn,
+    filepath,
+    func,
+    workers=1,
+    buffer=None,
+    manifest=None,
+    rollups=False,
+    commit_policy=None,
+    **kwargs
+):
+    """Read datasts directory an execute process to insert records.
+
+    * Get the list of JSON files in the given 'filepath'.
+    * Shows the total number of files found.
+    * Iterate each file name.
+        * Use the function given in 'func' and the current file path to
+          process JSON data and execute INSERT statements.
+        * Commit the SQL statements to INSERY records into Sparkify's
+          database
+
+    With more than one worker, the files are read and transformed in
+    worker processes ('transform_files') and the current connection
+    loads the prepared records in the files order.
+
+    With a buffer, the records of many files are collected and loaded
+    together each time the buffer is full, the commit is done after
+    each load instead after each file.
+
+    With a manifest, only the new or changed files are processed and
+    each file is recorded in the manifest in the same transaction that
+    commits its records. The songplays of the previous load of a
+    changed file are deleted before it is processed again
+    ('rebuild_changed_rollups').
+
+    The files are committed as the commit policy requires, with the
+    policies that keep many files in a transaction each file (or
+    buffered load) is isolated with a savepoint: if it fails, only its
+    records are rolled back, the in-memory state is discarded
+    ('reset_run_state') and the next files are processed.
+
+    With the rollups, the songplays of each commit are added to the
+    rollup tables of 'songplay' in the same transaction.
+
+    With the profiling enabled ('profiling.enable'), the selected files
+    are profiled in the current process: the whole file processing, or
+    only the load if the files are transformed by workers.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    conn : PostgreSQL Connection Instance
+    description -> The connection active to the 'sparkifydb' database
+    format -> No apply
+    options -> No apply
+
+    filepath : String
+        description -> The path to specific data
+        format -> No apply
+        options -> {
+            'data/song_data': To get song JSON file names,
+            ''data/log_data': To get logs JSON file names
+        }
+
+    func : Functiom
+        description -> The required function to process specific JSON
+            file
+        format -> No apply
+        options -> {
+            process_song_file: Use it to process the song JSON files,
+            process_log_file: Use it to process the logs JSON files,
+            process_log_file_staged: Use it to process the logs JSON
+                files in the server
+        }
+
+    workers : Integer
+        description -> Number of worker processes used to read and
+            transform the files
+        format -> No apply
+        options -> '1': Process the files in the current process.
+
+    buffer : loaders.RecordBuffer Instance
+        description -> Buffer to collect the records of many files
+            before loading them
+        format -> No apply
+        options -> {
+            'None': Load the records of each file,
+            RecordBuffer(SONG_BUFFER_KEYS): Use it with
+                'process_song_file'
+        }
+
+    manifest : manifest.IngestManifest Instance
+        description -> The manifest of the ingested files
+        format -> No apply
+        options -> 'None': Process all the files.
+
+    rollups : bool
+        description -> Refresh the rollups of 'songplay' in each commit
+        format -> No apply
+        options -> No apply
+
+    commit_policy : transactions.CommitPolicy Instance
+        description -> When the loaded files are committed
+        format -> No apply
+        options -> 'None': Commit each file ('batch').
+
+    kwargs : Keyword Arguments
+        description -> Extra options given to 'func' for each file
+        format -> No apply
+        options -> {
+            engine: The load engine used to insert the records,
+            lookup_index: The in-memory index of songs,
+            chunk_size: Events read at once from each log file,
+            run_cache: The time and user records sent during the run,
+            partitions: The monthly partitions of 'songplay',
+            batch_commit: Commit each batch of records
+        }
+
+    Returns
+    -------
+    failed : String List
+        description -> The files rolled back
+        format -> No apply
+        options -> No apply
+    """
+    # get all files matching extension from directory
+    all_files = list_files(filepath)
+
+    # get total number of files found
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    # skip the files already ingested
+    if manifest is not None:
+        all_files = manifest.pending_files(cur, all_files)
+        rebuild_changed_rollups(cur, manifest, rollups)
+        conn.commit()
+        print('{} new or changed files to process.'.format(len(all_files)))
+    num_files = len(all_files)
+
+    # iterate over files and process, each file inside a savepoint
+    file_transactions = transactions.FileTransactions(
+        conn,
+        commit_policy,
+        manifest=manifest,
+        rollups=rollups,
+        on_rollback=lambda cur: reset_run_state(cur, **kwargs)
+    )
+    if workers > 1 or buffer is not None:
+        transform, load = FILE_STAGES[func]
+        if workers > 1:
+            transformed = transform_files(all_files, transform, workers)
+        else:
+            transformed = profile_transform(all_files, transform)
+        buffered_files = []
+        for i, (datafile, data) in enumerate(transformed, 1):
+            if buffer is None:
+                with file_transactions.isolate([datafile]) as row_counts:
+                    with profiling.profile_file(datafile):
+                        row_counts[datafile] = load(
+                            cur, data, conn, **kwargs
+                        )
+            else:
+                buffer.add(data)
+                buffered_files.append((datafile, record_counts(data)))
+                if buffer.is_full():
+                    load_buffer(
+                        file_transactions,
+                        buffered_files,
+                        load,
+                        cur,
+                        buffer.pop(),
+                        conn,
+                        **kwargs
+                    )
+                    buffered_files = []
+            print('{}/{} files processed.'.format(i, num_files))
+
+        if buffer is not None and buffer.rows:
+            load_buffer(
+                file_transactions,
+                buffered_files,
+                load,
+                cur,
+                buffer.pop(),
+                conn,
+                **kwargs
+            )
+    else:
+        for i, datafile in enumerate(all_files, 1):
+            with file_transactions.isolate([datafile]) as row_counts:
+                with profiling.profile_file(datafile):
+                    row_counts[datafile] = func(
+                        cur, datafile, conn, **kwargs
+                    )
+            print('{}/{} files processed.'.format(i, num_files))
+    file_transactions.close()
+
+    return file_transactions.failed
+
+def rebuild_changed_rollups(cur, manifest, rollups=False):
+    """Report the deleted songplays of the changed files.
+
+    The previous songplays of the changed files are deleted by
+    'manifest.IngestManifest.pending_files', the rollups of 'songplay'
+    only add songplays, so they are rebuilt in the same transaction if
+    they are maintained.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    manifest : manifest.IngestManifest Instance
+        description -> The manifest of the ingested files
+        format -> No apply
+        options -> No apply
+
+    rollups : bool
+        description -> The rollups of 'songplay' are maintained
+        format -> No apply
+        options -> No apply
+    """
+    if not manifest.deleted_songplays:
+        return
+
+    print(
+        f"{manifest.deleted_songplays} songplays of changed files were "
+        "deleted before loading them again."
+    )
+    manifest.deleted_songplays = 0
+    if rollups:
+        songplay_rollups.rebuild(cur)
+        print("The rollups of 'songplay' were rebuilt.")
+
+def load_buffer(file_transactions, buffered_files, load, *args, **kwargs):
+    """Load the records of many files inside one savepoint.
+
+    Parameters
+    ----------
+    file_transactions : transactions.FileTransactions Instance
+        description -> The savepoints and commits of the files
+        format -> No apply
+        options -> No apply
+
+    buffered_files : Tuple List
+        description -> The buffered files and their number of records
+            by table
+        format -> [(<file_path>, {<table>: <records>})]
+        options -> No apply
+
+    load : Function
+        description -> The load stage of 'FILE_STAGES'
+        format -> No apply
+        options -> No apply
+
+    args, kwargs : Arguments
+        description -> The arguments of 'load'
+        format -> No apply
+        options -> No apply
+    """
+    datafiles = [datafile for datafile, _ in buffered_files]
+    with file_transactions.isolate(datafiles) as row_counts:
+        load(*args, **kwargs)
+        row_counts.update(buffered_files)
+
+def parse_arguments(argv=None):
+    """Read the ETL pipeline options from the command line.
+
+    Parameters
+    ----------
+    argv : String List
+        description -> The command line arguments
+        format -> No apply
+        options -> 'None': Use the arguments given to the script.
+
+    Returns
+    -------
+    args : argparse.Namespace
+        description -> The parsed options
+        format -> No apply
+        options -> No apply
+    """
+    parser = argparse.ArgumentParser(description="Sparkify's ETL pipeline")
+    parser.add_argument(
+        "--engine",
+        choices=loaders.LOAD_ENGINES,
+        default=loaders.DEFAULT_ENGINE,
+        help="Engine used to load the records into the tables."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes used to read and transform the files."
+    )
+    parser.add_argument(
+        "--song-batch-rows",
+        type=int,
+        default=0,
+        help=(
+            "Load the song files records in batches up to this number "
+            "of artist and song records, '0' loads each file."
+        )
+    )
+    parser.add_argument(
+        "--song-batch-bytes",
+        type=int,
+        default=16 * 2**20,
+        help="Approximate size in bytes of each song files batch."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help=(
+            "Read and load each log file by chunks of this number of "
+            "events, the log files are processed without workers."
+        )
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Process only the new or changed files, recorded in the "
+            "table 'ingest_manifest', the tables are not required to be "
+            "created again."
+        )
+    )
+    parser.add_argument(
+        "--lookup",
+        choices=("sql", "memory"),
+        default="sql",
+        help=(
+            "Find the song IDs and artist IDs with SQL statements or with "
+            "an in-memory index of the songs."
+        )
+    )
+    parser.add_argument(
+        "--lookup-max-bytes",
+        type=int,
+        default=512 * 2**20,
+        help=(
+            "Memory limit of the in-memory index of songs, the SQL "
+            "statements are used when the songs do not fit."
+        )
+    )
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help=(
+            "Drop the foreign keys before the load, then add them again "
+            "and validate them with a single pass per key, the keys "
+            "with violations are reported and kept as 'NOT VALID'."
+        )
+    )
+    parser.add_argument(
+        "--pipeline",
+        choices=("sync", "async"),
+        default="sync",
+        help=(
+            "Process the log files stage by stage or with the asyncio "
+            "pipeline, which reads and transforms the next file while "
+            "the current one is written."
+        )
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=2,
+        help=(
+            "Files (or chunks) waiting between two stages of the "
+            "asyncio pipeline."
+        )
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        default=None,
+        help=(
+            "Append the metrics of each stage (wall time, records, SQL "
+            "bytes, server time, statements and commits) to this JSON "
+            "lines file."
+        )
+    )
+    parser.add_argument(
+        "--metrics-summary",
+        action="store_true",
+        help="Print the metrics aggregated by stage at the end of the run."
+    )
+    parser.add_argument(
+        "--log-mode",
+        choices=("client", "staging"),
+        default="client",
+        help=(
+            "Prepare the log files records in the client or stage the "
+            "raw events in the table 'staging_events' and insert the "
+            "records with set-based statements in the server."
+        )
+    )
+    parser.add_argument(
+        "--no-run-dedup",
+        action="store_true",
+        help=(
+            "Send the time and user records of each log file even if a "
+            "previous file of the run already sent them."
+        )
+    )
+    parser.add_argument(
+        "--dedup-max-seconds",
+        type=int,
+        default=dedup.DEFAULT_MAX_SECONDS,
+        help="Start times kept by the run-wide deduplication cache."
+    )
+    parser.add_argument(
+        "--dedup-max-users",
+        type=int,
+        default=dedup.DEFAULT_MAX_USERS,
+        help="Users kept by the run-wide deduplication cache."
+    )
+    parser.add_argument(
+        "--commit-policy",
+        default="batch",
+        help=(
+            "When the loaded files are committed: 'batch' commits each "
+            "batch of records and each file, 'files:N' every N files, "
+            "'bytes:B' when the files reach about B bytes and 'run' "
+            "once for the song files and once for the log files; the "
+            "last three isolate each file with a savepoint."
+        )
+    )
+    parser.add_argument(
+        "--quarantine",
+        action="store_true",
+        help=(
+            "Split the batches rejected by the tables constraints until "
+            "the failing records are isolated, write them with their "
+            "error in the table 'load_rejects' and load the rest."
+        )
+    )
+    parser.add_argument(
+        "--quarantine-jsonl",
+        default=None,
+        help=(
+            "Write the rejected records in this JSON lines file instead "
+            "of the table 'load_rejects', it enables the quarantine."
+        )
+    )
+    parser.add_argument(
+        "--quarantine-max-rejects",
+        type=int,
+        default=quarantine.DEFAULT_MAX_REJECTS,
+        help="Rejected records allowed, the next error stops the run."
+    )
+    parser.add_argument(
+        "--parse-cache",
+        default=None,
+        help=(
+            "Directory of the columnar cache of the parsed JSON files, "
+            "the unchanged files are read from the cache instead of "
+            "parsed again."
+        )
+    )
+    parser.add_argument(
+        "--parse-cache-max-bytes",
+        type=int,
+        default=parse_cache.DEFAULT_MAX_BYTES,
+        help=(
+            "Maximum size in bytes of the parse cache, the least "
+            "recently used files are removed."
+        )
+    )
+    parser.add_argument(
+        "--adaptive-batches",
+        action="store_true",
+        help=(
+            "Adapt the records of each batch by table to the target "
+            "payload size and the measured batch time, instead of "
+            f"{batching.FIXED_BATCH_ROWS:,} records."
+        )
+    )
+    parser.add_argument(
+        "--batch-target-bytes",
+        type=int,
+        default=batching.DEFAULT_TARGET_BYTES,
+        help="Approximate payload size in bytes of each adaptive batch."
+    )
+    parser.add_argument(
+        "--batch-target-seconds",
+        type=float,
+        default=batching.DEFAULT_TARGET_SECONDS,
+        help="Approximate time in seconds of each adaptive batch."
+    )
+    parser.add_argument(
+        "--batch-min-rows",
+        type=int,
+        default=batching.DEFAULT_MIN_ROWS,
+        help="Minimum records of each adaptive batch."
+    )
+    parser.add_argument(
+        "--batch-max-rows",
+        type=int,
+        default=batching.DEFAULT_MAX_ROWS,
+        help="Maximum records of each adaptive batch."
+    )
+    parser.add_argument(
+        "--rollups",
+        action="store_true",
+        help=(
+            "Add the songplays of each commit to the rollup tables of "
+            "'songplay' (see 'rollups.py'), the tables are created if "
+            "they do not exist."
+        )
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help=(
+            "Write the CPU (cProfile) and memory (tracemalloc) profiles "
+            "by stage of the selected files in this directory."
+        )
+    )
+    parser.add_argument(
+        "--profile-files",
+        nargs="+",
+        default=[],
+        help="Shell patterns of the files always profiled."
+    )
+    parser.add_argument(
+        "--profile-sample-rate",
+        type=float,
+        default=0.0,
+        help="Probability to profile each one of the other files."
+    )
+    parser.add_argument(
+        "--profile-slowest",
+        type=int,
+        default=0,
+        help=(
+            "Keep only the profiles of the N slowest profiled files, "
+            "written at the end of the run (0 writes all of them). "
+            "Without '--profile-files' or '--profile-sample-rate' every "
+            "file is profiled."
+        )
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=25,
+        help="Allocation sites written by stage."
+    )
+
+    args = parser.parse_args(argv)
+    if args.pipeline == "async" and args.log_mode == "staging":
+        parser.error("the asyncio pipeline requires '--log-mode client'")
+    if args.pipeline == "async" and args.profile_dir is not None:
+        parser.error("the profiling requires '--pipeline sync'")
+    try:
+        args.commit_policy = transactions.CommitPolicy.parse(
+            args.commit_policy
+        )
+    except ValueError as error:
+        parser.error(str(error))
+    if not 0 < args.batch_min_rows <= args.batch_max_rows:
+        parser.error(
+            "the adaptive batches require "
+            "0 < --batch-min-rows <= --batch-max-rows"
+        )
+
+    return args
+
+def main():
+    """Main to execute complete ETL pipeline.
+
+    * Read the pipeline options and enable the metrics, the profiling,
+      the adaptive batches and the parse cache, if they are required.
+    * Take a connection to the Sparkify's database from the pool, the
+      connection settings are read by 'database.load_settings'.
+    * Create the SQL cursor instance.
+    * Load the manifest of ingested files, if the run is incremental.
+    * Load the in-memory index of songs, if it is used.
+    * Detect the monthly partitions of 'songplay', if it is
+      partitioned the partition of each new month is created.
+    * Create the rollup tables of 'songplay', if they are maintained.
+    * Enable the quarantine of the rejected records, if it is
+      required.
+    * The files are committed as the commit policy requires
+      ('transactions.CommitPolicy'), the files rolled back are
+      printed at the end.
+    * Drop the foreign keys, if the bulk-load profile is used.
+    * Process and insert song JSON files.
+    * Process and insert logs JSON files, the log files are processed
+      once all the song files are loaded, so the song IDs and artist
+      IDs can be found. If the log files are read by chunks, they are
+      processed without workers. In staging mode the raw events are
+      loaded into 'staging_events' and the records are inserted in
+      the server. With the asyncio pipeline the stages of different
+      log files overlap ('async_pipeline.process_log_files'). In client
+      mode the time and user records already sent by previous files
+      are skipped ('dedup.RunDedupCache'). With the rollups, each
+      commit adds its songplays to the rollup tables.
+    * Add again and validate the foreign keys, if the bulk-load
+      profile is used.
+    * Create a query to retrieve records with complete data from the
+      'songplays' table.
+    * Execute and commit the query to print the total number of records
+      with complete data.
+    * Print the loaded data.
+    * Return the connection and close the pool.
+    * Write the slowest profiles, if they are required.
+    * Print the batch sizes settled on, if the batches are adaptive.
+    * Print the metrics summary, if it is required.
+    """
+    args = parse_arguments()
+    song_buffer = None
+    if args.song_batch_rows > 0:
+        song_buffer = loaders.RecordBuffer(
+            SONG_BUFFER_KEYS,
+            max_rows=args.song_batch_rows,
+            max_bytes=args.song_batch_bytes
+        )
+
+    connection_factory = None
+    if args.metrics_jsonl is not None or args.metrics_summary:
+        metrics.enable(args.metrics_jsonl, summary=args.metrics_summary)
+        connection_factory = metrics.MetricsConnection
+    if args.profile_dir is not None:
+        profiling.enable(
+            args.profile_dir,
+            sample_rate=args.profile_sample_rate,
+            slowest=args.profile_slowest,
+            patterns=args.profile_files,
+            top=args.profile_top
+        )
+    if args.parse_cache is not None:
+        parse_cache.enable(
+            args.parse_cache, max_bytes=args.parse_cache_max_bytes
+        )
+    if args.adaptive_batches:
+        batching.enable(
+            target_bytes=args.batch_target_bytes,
+            target_seconds=args.batch_target_seconds,
+            min_rows=args.batch_min_rows,
+            max_rows=args.batch_max_rows
+        )
+
+    db_pool = database.ConnectionPool(connection_factory=connection_factory)
+    conn = db_pool.getconn()
+    cur = conn.cursor()
+
+    manifest = None
+    if args.incremental:
+        manifest = ingest_manifest.IngestManifest.load(cur)
+        conn.commit()
+
+    lookup_index = None
+    if args.lookup == "memory":
+        lookup_index = lookup.SongLookupIndex.load(
+            cur, max_bytes=args.lookup_max_bytes
+        )
+        if lookup_index is None:
+            print("The songs do not fit in memory, using SQL lookup.")
+
+    # monthly partitions of 'songplay', if it is partitioned
+    partitions = songplay_partitions.SongplayPartitions.load(cur)
+    conn.commit()
+    partitioned_tables = () if partitions is None else ("songplay",)
+
+    if args.rollups:
+        songplay_rollups.create_tables(cur)
+        conn.commit()
+
+    rejects = None
+    if args.quarantine or args.quarantine_jsonl is not None:
+        rejects = quarantine.enable(
+            cur,
+            path=args.quarantine_jsonl,
+            max_rejects=args.quarantine_max_rejects
+        )
+        conn.commit()
+
+    if args.bulk_load:
+        bulk_load.drop_foreign_keys(cur)
+        conn.commit()
+
+    try:
+        failed = process_data(
+            cur,
+            conn,
+            filepath='data/song_data',
+            func=process_song_file,
+            workers=args.workers,
+            buffer=song_buffer,
+            manifest=manifest,
+            commit_policy=args.commit_policy,
+            engine=args.engine,
+            lookup_index=lookup_index
+        )
+        if args.log_mode == "staging":
+            log_func = process_log_file_staged
+            log_kwargs = {"partitions": partitions}
+        else:
+            log_func = process_log_file
+            log_kwargs = {
+                "engine": args.engine,
+                "lookup_index": lookup_index,
+                "partitions": partitions,
+                # with a manifest a file is never committed partially
+                "batch_commit": (
+                    args.commit_policy.batch_commits and manifest is None
+                )
+            }
+            if not args.no_run_dedup:
+                log_kwargs["run_cache"] = dedup.RunDedupCache(
+                    max_seconds=args.dedup_max_seconds,
+                    max_users=args.dedup_max_users
+                )
+        if args.chunk_size is not None:
+            log_kwargs["chunk_size"] = args.chunk_size
+        if args.pipeline == "async":
+            failed += async_pipeline.process_log_files(
+                cur,
+                conn,
+                filepath='data/log_data',
+                db_pool=db_pool,
+                manifest=manifest,
+                queue_size=args.queue_size,
+                rollups=args.rollups,
+                commit_policy=args.commit_policy,
+                **log_kwargs
+            )
+        else:
+            failed += process_data(
+                cur,
+                conn,
+                filepath='data/log_data',
+                func=log_func,
+                workers=args.workers if args.chunk_size is None else 1,
+                manifest=manifest,
+                rollups=args.rollups,
+                commit_policy=args.commit_policy,
+                **log_kwargs
+            )
+        if "run_cache" in log_kwargs:
+            skipped = log_kwargs["run_cache"].skipped
+            print(
+                f"{skipped['time']} time and {skipped['users']} user "
+                "records already sent by previous files were skipped."
+            )
+        if failed:
+            print(f"{len(failed)} files were rolled back:")
+            for datafile in failed:
+                print(f"    {datafile}")
+        if rejects is not None:
+            for table, records in rejects.rejected.items():
+                print(f"{records} '{table}' records were rejected.")
+    finally:
+        # add the foreign keys again, even if the load failed
+        if args.bulk_load:
+            conn.rollback()
+            violations = bulk_load.restore_foreign_keys(
+                cur, partitioned_tables
+            )
+            conn.commit()
+            bulk_load.print_violations(violations, partitioned_tables)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
     query = (
         "SELECT *\n"
         "FROM songplay s\n"
@@ -419,7 +2023,22 @@ def main():
     print(songplay_with_ids)
     # Well, now runs faster than I expected XD
 
-    conn.close()
+    cur.close()
+    db_pool.putconn(conn)
+    db_pool.closeall()
+    if batching.enabled():
+        print("Adaptive batch sizes:")
+        for table, state in batching.report().items():
+            print(
+                f"    {table}: {state['rows']} records by batch "
+                f"({state['row_bytes']} bytes by record, "
+                f"{state['batches']} batches, {state['mean_s']} s each)"
+            )
+    batching.close()
+    parse_cache.close()
+    quarantine.close()
+    profiling.close()
+    metrics.close()
     sys.exit()
 
 if __name__ == "__main__":
@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""Load engines used to send dataframes into the Sparkify's tables.
+
+The engines receive a dataframe with the columns in the same order
+defined in 'sql_queries.TABLE_SPECS' and load it into the given table:
+
+    * 'copy': Streams the records with 'COPY FROM STDIN' into a
+      temporary staging table, then merges them into the table keeping
+      the 'ON CONFLICT ... DO UPDATE' behavior (default engine).
+    * 'execute_values': Sends the records as bound parameters in pages
+      with 'psycopg2.extras.execute_values', the psycopg2 adapters
+      handle the quoting and null values.
+    * 'values': Renders a multi-row 'INSERT ... VALUES' statement with
+      the 'sql_queries.Queries' builders (fallback engine).
+
+The upserts rewrite only the records that changed, each load returns
+the records inserted, updated and unchanged. With the quarantine
+enabled ('quarantine.enable'), the records rejected by the tables
+constraints are isolated and the rest of the batch is loaded.
+
+The search of song IDs and artist IDs ('select_song_ids') also sends
+the records as bound parameters.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import io
+import re
+
+# Third-party imports
+import pandas as pd
+from psycopg2 import extras
+
+# Propietary imports
+import metrics
+import quarantine
+import sql_queries
+
+LOAD_ENGINES = ("copy", "execute_values", "values")
+DEFAULT_ENGINE = "copy"
+
+# Records sent by each statement of 'execute_values'
+PAGE_SIZE = 1_000
+
+# 'Queries' builders used by the 'values' engine
+VALUES_BUILDERS = {
+    "time": sql_queries.Queries.time_table_insert,
+    "users": sql_queries.Queries.user_table_insert,
+    "artists": sql_queries.Queries.artist_table_insert,
+    "songs": sql_queries.Queries.song_table_insert,
+    "songplay": sql_queries.Queries.songplay_table_insert
+}
+
+def single_quote_converter(sentence):
+    """Handle single-quote character, insert a tag identifier instead.
+
+    From a given string, change all the single-quote characters (') to
+    the following tag:
+
+        <single_quote_tag>
+
+    The SQL statements written in Python and loaded by Pandas usually
+    adds double-quote in attributes of type string if a single-quote
+    appears in a row, the problem of including a double-quote in a SQL
+    statement is that a word between double quotes are interpreted as
+    a column instead a value.
+
+    To avoid this issue, the single quotes are substituted by the
+    single-quote tag.
+
+    When inserting the tagged word into a SQL generator like
+    'sql_queries.Queries()song_table_insert(dataframe=df, verbose=True)'
+    the build-in method use a regex to replace the tag to the required
+    double single-quote that can be accepted in a SQL INSERT statement.
+
+    Parameters
+    ----------
+    setence : String
+        description -> A sentence to process to serach single-quotes,
+            if a single-quote is found, it is substituted by the
+            single-quote tag '<single_quote_tag>'
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    sentence : String
+        description -> Sentence filtered of single-quote characters
+        format -> No apply
+        options -> No apply
+    """
+    sentence = re.sub(r'\'', r'<single_quote_tag>', sentence)
+
+    return sentence
+
+def dataframe_records(dataframe):
+    """Convert a dataframe into records accepted by the psycopg2 adapters.
+
+    The values are converted to Python built-in types and the null
+    values ('NaN', 'NaT', 'None') to 'None', so they are sent as NULL.
+
+    Parameters
+    ----------
+    dataframe : Pandas Dataframe
+        description -> The records to convert
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    records : Tuple List
+        description -> One tuple per row, in the columns order
+        format -> No apply
+        options -> No apply
+    """
+    dataframe = dataframe.astype(object)
+    dataframe = dataframe.where(dataframe.notna(), None)
+
+    return list(dataframe.itertuples(index=False, name=None))
+
+def copy_dataframe(cur, dataframe, table):
+    """Load a dataframe into a table using 'COPY FROM STDIN'.
+
+    * Serialize the dataframe to CSV in memory, null values are written
+      with the '\\N' marker.
+    * If the table has a conflict target:
+        * Create (or empty) the session staging table.
+        * Stream the records into the staging table.
+        * Merge the staging records into the table.
+    * Otherwise stream the records directly into the table.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    dataframe : Pandas Dataframe
+        description -> The records to load
+        format -> Columns ordered as 'sql_queries.TABLE_SPECS[table]'
+        options -> No apply
+
+    table : String
+        description -> The name of the target table
+        format -> No apply
+        options -> {'time', 'users', 'artists', 'songs', 'songplay'}
+
+    Returns
+    -------
+    written : Tuple
+        description -> The records inserted and updated
+        format -> (<inserted>, <updated>)
+        options -> No apply
+    """
+    sql = sql_queries.Queries()
+    buffer = io.StringIO()
+    dataframe.to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
+
+    if not sql_queries.TABLE_SPECS[table]["conflict"]:
+        cur.copy_expert(sql.copy_from_stdin(table), buffer)
+
+        return len(dataframe), 0
+
+    cur.execute(sql.staging_table_create(table))
+    cur.copy_expert(sql.copy_from_stdin(table, staging=True), buffer)
+    cur.execute(
+        sql_queries.upsert_counts_query(sql.staging_table_merge(table))
+    )
+    inserted, updated = cur.fetchone()
+
+    return inserted, updated
+
+def execute_values_dataframe(cur, dataframe, table, page_size=PAGE_SIZE):
+    """Load a dataframe into a table sending the records as parameters.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    dataframe : Pandas Dataframe
+        description -> The records to load
+        format -> Columns ordered as 'sql_queries.TABLE_SPECS[table]'
+        options -> No apply
+
+    table : String
+        description -> The name of the target table
+        format -> No apply
+        options -> {'time', 'users', 'artists', 'songs', 'songplay'}
+
+    page_size : Integer
+        description -> Records sent by each statement
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    written : Tuple
+        description -> The records inserted and updated
+        format -> (<inserted>, <updated>)
+        options -> No apply
+    """
+    query = sql_queries.Queries.table_insert_template(table)
+    if not sql_queries.TABLE_SPECS[table]["conflict"]:
+        extras.execute_values(
+            cur, query, dataframe_records(dataframe), page_size=page_size
+        )
+
+        return len(dataframe), 0
+
+    # one record with the counts by page
+    pages = extras.execute_values(
+        cur,
+        sql_queries.upsert_counts_query(query),
+        dataframe_records(dataframe),
+        page_size=page_size,
+        fetch=True
+    )
+
+    return (
+        sum(inserted for inserted, _ in pages),
+        sum(updated for _, updated in pages)
+    )
+
+def values_dataframe(cur, dataframe, table):
+    """Load a dataframe into a table using a multi-row INSERT statement.
+
+    * Filter string attributes of single-quotes.
+    * Convert null values to the 'nan' marker replaced by the builders.
+    * Create the query from the dataframe with the 'Queries' builder.
+    * Execute the query.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    dataframe : Pandas Dataframe
+        description -> The records to load
+        format -> Columns ordered as 'sql_queries.TABLE_SPECS[table]'
+        options -> No apply
+
+    table : String
+        description -> The name of the target table
+        format -> No apply
+        options -> {'time', 'users', 'artists', 'songs', 'songplay'}
+
+    Returns
+    -------
+    written : Tuple
+        description -> The records inserted and updated
+        format -> (<inserted>, <updated>)
+        options -> No apply
+    """
+    dataframe = dataframe.copy()
+    for column in dataframe.select_dtypes(include=["object", "string"]):
+        dataframe[column] = dataframe[column].map(
+            lambda value: single_quote_converter(value)
+            if isinstance(value, str) else value
+        )
+    if dataframe.isna().values.any():
+        dataframe = dataframe.where(dataframe.notna(), 'nan')
+
+    query = VALUES_BUILDERS[table](dataframe=dataframe)
+    if not sql_queries.TABLE_SPECS[table]["conflict"]:
+        cur.execute(query)
+
+        return len(dataframe), 0
+
+    cur.execute(sql_queries.upsert_counts_query(query))
+    inserted, updated = cur.fetchone()
+
+    return inserted, updated
+
+def load_dataframe(cur, dataframe, table, engine=DEFAULT_ENGINE):
+    """Load a dataframe into a table with the given engine.
+
+    If the quarantine is enabled, the batch is loaded inside a
+    savepoint and the failing records are rejected ('quarantine.load').
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    dataframe : Pandas Dataframe
+        description -> The records to load
+        format -> Columns ordered as 'sql_queries.TABLE_SPECS[table]'
+        options -> No apply
+
+    table : String
+        description -> The name of the target table
+        format -> No apply
+        options -> {'time', 'users', 'artists', 'songs', 'songplay'}
+
+    engine : String
+        description -> The load engine to use
+        format -> No apply
+        options -> {
+            'copy': COPY into a staging table and merge (default),
+            'execute_values': Records sent as bound parameters,
+            'values': Multi-row 'INSERT ... VALUES' statement
+        }
+
+    Returns
+    -------
+    upserts : Dictionary
+        description -> The records inserted, updated and unchanged (the
+            existing records equal to the given ones), the rejected
+            records are not included
+        format -> {"inserted": <records>, "updated": <records>,
+                   "unchanged": <records>}
+        options -> No apply
+    """
+    if dataframe.empty:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+
+    if engine == "copy":
+        engine_load = copy_dataframe
+    elif engine == "execute_values":
+        engine_load = execute_values_dataframe
+    elif engine == "values":
+        engine_load = values_dataframe
+    else:
+        raise ValueError(
+            f"Unknown load engine '{engine}', use one of {LOAD_ENGINES}"
+        )
+
+    with metrics.stage(f"load:{table}", rows_in=len(dataframe)) as record:
+        if quarantine.enabled():
+            inserted, updated, rejected = quarantine.load(
+                cur,
+                dataframe,
+                table,
+                lambda part: engine_load(cur, part, table)
+            )
+        else:
+            inserted, updated = engine_load(cur, dataframe, table)
+            rejected = 0
+        upserts = {
+            "inserted": inserted,
+            "updated": updated,
+            "unchanged": len(dataframe) - inserted - updated - rejected
+        }
+        record.rows_out = inserted + updated
+        record.upserts = upserts
+
+    return upserts
+
+def select_song_ids(cur, dataframe, page_size=PAGE_SIZE):
+    """Find the song IDs and artist IDs of the given songplays records.
+
+    The records are sent as bound parameters in pages, the songs are
+    searched by title, artist name and song length.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    dataframe : Pandas Dataframe
+        description -> The songplays records to search
+        format -> Headers: ["index", "song", "artist", "length"]
+        options -> No apply
+
+    page_size : Integer
+        description -> Records sent by each statement
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    ids_df : Pandas Dataframe
+        description -> The song ID and artist ID found for each record,
+            'None' if the song is missed
+        format -> Index: "index", Headers: ["song", "artist"]
+        options -> No apply
+    """
+    query, template = sql_queries.Queries.song_select_template()
+    with metrics.stage("lookup:sql", rows_in=len(dataframe)) as record:
+        rows = extras.execute_values(
+            cur,
+            query,
+            dataframe_records(dataframe),
+            template=template,
+            page_size=page_size,
+            fetch=True
+        )
+        ids_df = pd.DataFrame(rows, columns=["index", "song", "artist"])
+        # the lowest song ID of each record is the first one
+        ids_df = ids_df.drop_duplicates(subset="index")
+        ids_df = ids_df.set_index("index")
+        record.rows_out = len(ids_df)
+
+    return ids_df
+
+class RecordBuffer():
+    """Buffer of records collected from many files before loading them.
+
+    The records of each table are deduplicated in memory by the table
+    key, the last record received for a key replaces the previous one,
+    the same result of loading the files one by one with the upsert
+    statements.
+
+    Attributes
+    ----------
+    keys : Dictionary
+        description -> The key attribute of each buffered table
+        format -> {<table>: <key attribute>}
+        options -> No apply
+
+    max_rows : Integer
+        description -> Buffered records that make the buffer full
+        format -> No apply
+        options -> No apply
+
+    max_bytes : Integer
+        description -> Approximate size in bytes of the buffered values
+            that make the buffer full
+        format -> No apply
+        options -> No apply
+
+    rows : Integer
+        description -> Number of buffered records
+        format -> No apply
+        options -> No apply
+
+    size : Integer
+        description -> Approximate size in bytes of the buffered values
+        format -> No apply
+        options -> No apply
+
+    Methods
+    -------
+    add : Method
+        Add the records of one file to the buffer.
+
+    is_full : Method
+        Check if the buffer reached the rows or bytes limit.
+
+    pop : Method
+        Return the buffered records as dataframes and empty the buffer.
+    """
+    def __init__(self, keys, max_rows=10_000, max_bytes=16 * 2**20):
+        self.keys = keys
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.size = 0
+        self._columns = {}
+        self._records = {table: {} for table in keys}
+
+    def add(self, data):
+        """Add the records of one file to the buffer.
+
+        Parameters
+        ----------
+        data : Dictionary
+            description -> The records of the file by table
+            format -> {<table>: Pandas Dataframe}
+            options -> No apply
+        """
+        for table, key in self.keys.items():
+            dataframe = data[table]
+            self._columns.setdefault(table, list(dataframe.columns))
+            records = self._records[table]
+            position = dataframe.columns.get_loc(key)
+            for row in dataframe.itertuples(index=False, name=None):
+                if row[position] not in records:
+                    self.rows += 1
+                    self.size += sum(len(str(value)) for value in row)
+                records[row[position]] = row
+
+    def is_full(self):
+        """Check if the buffer reached the rows or bytes limit.
+
+        Returns
+        -------
+        full : bool
+            description -> 'True' if the buffer must be loaded
+            format -> No apply
+            options -> No apply
+        """
+        return self.rows >= self.max_rows or self.size >= self.max_bytes
+
+    def pop(self):
+        """Return the buffered records as dataframes and empty the buffer.
+
+        Returns
+        -------
+        data : Dictionary
+            description -> The buffered records by table
+            format -> {<table>: Pandas Dataframe}
+            options -> No apply
+        """
+        data = {
+            table: pd.DataFrame(
+                list(records.values()),
+                columns=self._columns.get(table)
+            )
+            for table, records in self._records.items()
+        }
+        self.rows = 0
+        self.size = 0
+        self._records = {table: {} for table in self.keys}
+
+        return data
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""In-memory index to find the song IDs and artist IDs of songplays.
+
+The index keeps the songs and artists in memory, it is loaded once per
+run with a single query and updated with the records of each song file
+loaded, so the songplays records are resolved with a merge in memory
+instead of a SQL search per batch.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import decimal
+
+# Third-party imports
+import pandas as pd
+
+# Propietary imports
+import metrics
+import sql_queries
+
+# Approximate memory used by each song in the index, without the text
+# attributes (dictionaries entries, tuples, numbers and the dataframe
+# used by the merge).
+ROW_BYTES = 400
+
+# Decimal places of the 'songs.duration' attribute
+DURATION_SCALE = sql_queries.DURATION_SCALE
+
+# Last decimal place kept of the durations
+DURATION_QUANTUM = decimal.Decimal(1).scaleb(-DURATION_SCALE)
+
+class SongLookupIndex():
+    """Songs and artists kept in memory to find song IDs and artist IDs.
+
+    The songs are searched by title, artist name and duration, the same
+    attributes used by the 'song_select' queries; the duration is
+    compared rounded to the scale of the 'songs.duration' attribute, as
+    PostgreSQL rounds it ('round_duration').
+
+    Attributes
+    ----------
+    max_bytes : Integer
+        description -> Memory limit of the index, when the estimated
+            size is greater the index overflows
+        format -> No apply
+        options -> No apply
+
+    overflow : bool
+        description -> 'True' if the index reached the memory limit, in
+            this case the index is empty and the SQL search must be
+            used instead
+        format -> No apply
+        options -> No apply
+
+    Methods
+    -------
+    load : Class Method
+        Create the index with all the songs in the database, if the
+        estimated size fits in the memory limit.
+
+    estimated_bytes : Method
+        Approximate memory used by the index.
+
+    update : Method
+        Add the records of loaded song files to the index.
+
+    reload : Method
+        Replace the index with the songs in the database.
+
+    resolve : Method
+        Find the song IDs and artist IDs of songplays records.
+    """
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.overflow = False
+        self._artists = {}
+        self._songs = {}
+        self._text_bytes = 0
+        self._frame = None
+
+    @classmethod
+    def load(cls, cur, max_bytes=512 * 2**20):
+        """Create the index with all the songs in the database.
+
+        * Estimate the memory required with the songs count and the size
+          of the text attributes.
+        * If the estimation fits in the memory limit, retrieve all the
+          songs and artists with a single query.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        max_bytes : Integer
+            description -> Memory limit of the index
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        index : SongLookupIndex Instance
+            description -> The loaded index
+            format -> No apply
+            options -> 'None': The songs catalog does not fit in the
+                memory limit, use the SQL search instead.
+        """
+        sql = sql_queries.Queries()
+        cur.execute(sql.song_lookup_size())
+        songs, text_bytes = cur.fetchone()
+        if songs * ROW_BYTES + int(text_bytes) > max_bytes:
+            return None
+
+        index = cls(max_bytes=max_bytes)
+        cur.execute(sql.song_lookup_select())
+        for song_id, title, duration, artist_id, name in cur.fetchall():
+            if artist_id is not None:
+                index._artists[artist_id] = name
+            index._add_song(song_id, title, artist_id, duration)
+
+        return index
+
+    def estimated_bytes(self):
+        """Approximate memory used by the index.
+
+        Returns
+        -------
+        size : Integer
+            description -> Estimated size in bytes
+            format -> No apply
+            options -> No apply
+        """
+        return len(self._songs) * ROW_BYTES + self._text_bytes
+
+    def reload(self, cur):
+        """Replace the index with the songs in the database.
+
+        The songs of a file rolled back are added by 'update' but they
+        are not in the database, the index is loaded again.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+        """
+        index = self.load(cur, self.max_bytes)
+        if index is None:
+            index = type(self)(self.max_bytes)
+            index.overflow = True
+        self.__dict__.update(index.__dict__)
+
+    def update(self, song_data):
+        """Add the records of loaded song files to the index.
+
+        Parameters
+        ----------
+        song_data : Dictionary
+            description -> The records loaded by table, as returned by
+                'etl.transform_song_file'
+            format -> {
+                "artists": Pandas Dataframe,
+                "songs": Pandas Dataframe
+            }
+            options -> No apply
+        """
+        if self.overflow:
+            return
+
+        artists_df = song_data["artists"]
+        for artist_id, name in zip(
+            artists_df["artist_id"], artists_df["artist_name"]
+        ):
+            self._artists[artist_id] = None if pd.isna(name) else name
+        self._frame = None
+
+        songs_df = song_data["songs"]
+        for song_id, title, artist_id, duration in zip(
+            songs_df["song_id"],
+            songs_df["title"],
+            songs_df["artist_id"],
+            songs_df["duration"]
+        ):
+            self._add_song(song_id, title, artist_id, duration)
+
+        if self.estimated_bytes() > self.max_bytes:
+            self.overflow = True
+            self._artists = {}
+            self._songs = {}
+            self._text_bytes = 0
+            self._frame = None
+
+    def resolve(self, dataframe):
+        """Find the song IDs and artist IDs of songplays records.
+
+        Parameters
+        ----------
+        dataframe : Pandas Dataframe
+            description -> The songplays records to search
+            format -> Headers: ["index", "song", "artist", "length"]
+            options -> No apply
+
+        Returns
+        -------
+        ids_df : Pandas Dataframe
+            description -> The song ID and artist ID found for each
+                record, 'None' if the song is missed
+            format -> Index: "index", Headers: ["song", "artist"]
+            options -> No apply
+        """
+        with metrics.stage("lookup:memory", rows_in=len(dataframe)) as record:
+            records = dataframe[["index", "song", "artist"]].copy()
+            lengths = dataframe["length"].astype(float)
+            records["duration"] = lengths.map(
+                {length: round_duration(length) for length in lengths.unique()}
+            ).astype(float)
+            ids_df = records.merge(
+                self._index_frame(),
+                how="left",
+                on=["song", "artist", "duration"]
+            )
+            ids_df = ids_df.set_index("index")[["song_id", "artist_id"]]
+            ids_df.columns = ["song", "artist"]
+            ids_df = ids_df.astype(object)
+            ids_df = ids_df.where(ids_df.notna(), None)
+            record.rows_out = len(ids_df)
+
+        return ids_df
+
+    def _add_song(self, song_id, title, artist_id, duration):
+        """Add or replace a song of the index."""
+        if song_id not in self._songs:
+            self._text_bytes += len(str(title)) + len(str(song_id))
+        duration = round_duration(duration)
+        self._songs[song_id] = (title, artist_id, duration)
+        self._frame = None
+
+    def _index_frame(self):
+        """Build (once per update) the dataframe used by the merge."""
+        if self._frame is None:
+            frame = pd.DataFrame(
+                [
+                    (title, self._artists.get(artist_id), duration,
+                     song_id, artist_id)
+                    for song_id, (title, artist_id, duration)
+                    in self._songs.items()
+                ],
+                columns=["song", "artist", "duration", "song_id", "artist_id"]
+            )
+            frame = frame.dropna(subset=["song", "artist", "duration"])
+            frame["duration"] = frame["duration"].astype(float)
+            # keep the lowest song ID of the songs with the same search
+            self._frame = frame.sort_values("song_id").drop_duplicates(
+                subset=["song", "artist", "duration"]
+            )
+
+        return self._frame
+
+def round_duration(duration):
+    """Round a duration to the scale of the 'songs.duration' attribute.
+
+    The value is rounded from its decimal text, half away from zero, as
+    PostgreSQL rounds the 'numeric' values, so the memory index and the
+    'song_select' queries find the same songs.
+
+    Parameters
+    ----------
+    duration : Float
+        description -> The duration of a song or a songplay length
+        format -> Seconds
+        options -> No apply
+
+    Returns
+    -------
+    duration : Float
+        description -> The rounded duration
+        format -> Seconds
+        options -> 'None': Missing duration.
+    """
+    if pd.isna(duration):
+        return None
+    rounded = decimal.Decimal(repr(float(duration))).quantize(
+        DURATION_QUANTUM, rounding=decimal.ROUND_HALF_UP
+    )
+
+    return float(rounded)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Manifest of the ingested files, used by the incremental ETL runs.
+
+Each ingested file is recorded in the table 'ingest_manifest' with its
+size, modification time, content hash, number of records by table and
+status; the record is written in the same transaction that commits the
+file records, so after a failure the next run continues from the last
+committed file.
+
+The fact table 'songplay' has no natural key, the manifest also records
+the range of 'songplay_id' inserted by each file. Before a changed file
+is processed again its previous songplays are deleted, so they are not
+duplicated. The songplays must be written by a single connection, as
+the ranges of the files do not overlap; the rollups of 'songplay' must
+be rebuilt after songplays are deleted ('python rollups.py refresh
+--rebuild').
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import hashlib
+import json
+import os
+
+# Third-party imports
+# None
+
+# Propietary imports
+import sql_queries
+
+# Bytes read by each step of the content hash
+HASH_CHUNK_SIZE = 2**20
+
+def file_hash(filepath):
+    """SHA-256 hash of the content of a file.
+
+    Parameters
+    ----------
+    filepath : String
+        description -> The file location as a full path
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    digest : String
+        description -> The hexadecimal digest
+        format -> 64 characters
+        options -> No apply
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+class IngestManifest():
+    """Files recorded in the table 'ingest_manifest'.
+
+    A file is processed again only if it is new, if its last status is
+    not 'loaded' or if its content changed; when the size and
+    modification time are the same the content hash is not computed.
+
+    Attributes
+    ----------
+    entries : Dictionary
+        description -> The recorded files
+        format -> {
+            <file_path>: (file_size, file_mtime, content_hash, status,
+                          songplay_first, songplay_last)
+        }
+        options -> No apply
+
+    deleted_songplays : Integer
+        description -> Songplays of the changed files deleted by
+            'pending_files'
+        format -> No apply
+        options -> No apply
+
+    Methods
+    -------
+    load : Class Method
+        Create the manifest with the files recorded in the database.
+
+    pending_files : Method
+        Filter the files that must be processed.
+
+    begin : Method
+        Start the songplays range of the files being loaded.
+
+    end : Method
+        Close the songplays range of the loaded files.
+
+    record : Method
+        Record a processed file.
+    """
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.deleted_songplays = 0
+        self._fingerprints = {}
+        self._songplay_low = None
+        self._songplays = {}
+
+    @classmethod
+    def load(cls, cur):
+        """Create the manifest with the files recorded in the database.
+
+        The table 'ingest_manifest' is created if it does not exist.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        manifest : IngestManifest Instance
+            description -> The loaded manifest
+            format -> No apply
+            options -> No apply
+        """
+        sql = sql_queries.Queries()
+        cur.execute(sql.manifest_table_create)
+        cur.execute(sql.manifest_songplays_add())
+        cur.execute(sql.manifest_select())
+        entries = {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+
+        return cls(entries)
+
+    def pending_files(self, cur, all_files):
+        """Filter the files that must be processed.
+
+        * Skip the loaded files with the same size and modification
+          time.
+        * Compute the content hash of the remaining files, skip the
+          loaded files with the same content and update their
+          modification time.
+        * Delete the songplays inserted by the previous load of the
+          changed files.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        all_files : String List
+            description -> The files location as full paths
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        pending : String List
+            description -> The files to process, in the given order
+            format -> No apply
+            options -> No apply
+        """
+        sql = sql_queries.Queries()
+        pending = []
+        for datafile in all_files:
+            stat = os.stat(datafile)
+            entry = self.entries.get(datafile)
+            loaded = entry is not None and entry[3] == "loaded"
+            if loaded and entry[:2] == (stat.st_size, stat.st_mtime):
+                continue
+
+            content_hash = file_hash(datafile)
+            if loaded and entry[2] == content_hash:
+                cur.execute(sql.manifest_touch(), (stat.st_mtime, datafile))
+                continue
+
+            if entry is not None and entry[4] is not None:
+                cur.execute(sql.songplay_range_delete(), entry[4:6])
+                self.deleted_songplays += cur.rowcount
+            self._fingerprints[datafile] = (
+                stat.st_size, stat.st_mtime, content_hash
+            )
+            pending.append(datafile)
+
+        return pending
+
+    def begin(self, cur):
+        """Start the songplays range of the files being loaded.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+        """
+        cur.execute(sql_queries.Queries.songplay_last_id())
+        self._songplay_low = int(cur.fetchone()[0])
+
+    def end(self, cur, datafiles):
+        """Close the songplays range of the loaded files.
+
+        The songplays inserted since 'begin' are recorded as the range
+        of the files, the files without songplays have no range.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        datafiles : String List
+            description -> The files loaded since 'begin'
+            format -> No apply
+            options -> No apply
+        """
+        cur.execute(sql_queries.Queries.songplay_last_id())
+        songplay_high = int(cur.fetchone()[0])
+        if songplay_high > self._songplay_low:
+            for datafile in datafiles:
+                self._songplays[datafile] = (
+                    self._songplay_low + 1, songplay_high
+                )
+
+    def record(self, cur, datafile, row_counts, status="loaded"):
+        """Record a processed file.
+
+        The record is not committed, it must be committed with the file
+        records.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        datafile : String
+            description -> The file location as a full path, it must be
+                returned by 'pending_files'
+            format -> No apply
+            options -> No apply
+
+        row_counts : Dictionary
+            description -> Number of records of the file by table
+            format -> {<table>: <records>}
+            options -> No apply
+
+        status : String
+            description -> The process result
+            format -> No apply
+            options -> {'loaded', 'failed'}
+        """
+        file_size, file_mtime, content_hash = self._fingerprints[datafile]
+        songplay_first, songplay_last = self._songplays.pop(
+            datafile, (None, None)
+        )
+        cur.execute(
+            sql_queries.Queries.manifest_upsert(),
+            (
+                datafile,
+                file_size,
+                file_mtime,
+                content_hash,
+                json.dumps(row_counts),
+                status,
+                songplay_first,
+                songplay_last
+            )
+        )
+        self.entries[datafile] = (
+            file_size,
+            file_mtime,
+            content_hash,
+            status,
+            songplay_first,
+            songplay_last
+        )
@@ -0,0 +1,633 @@
+# -*- coding: utf-8 -*-
+"""Per-stage metrics of the ETL pipeline.
+
+The stages of the pipeline (file processing, batch loads, SQL builders)
+are measured with the 'stage' context manager or the 'instrument'
+decorator, each stage records:
+
+    * 'wall_s': Wall time in seconds.
+    * 'rows_in' and 'rows_out': Records received and produced.
+    * 'sql_bytes': Bytes of the SQL statements generated or sent
+      (including the 'COPY' payloads).
+    * 'server_s': Time waiting for the server to execute the statements
+      and commits.
+    * 'statements' and 'commits': Statements and commits sent.
+
+The load stages also record the upserted records: 'inserted',
+'updated' and 'unchanged' (existing records equal to the loaded ones).
+
+The statements and commits are measured by the connections created
+with 'MetricsConnection', they are accounted to every open stage of
+the current thread, so the measures of a stage include its inner
+stages.
+
+The metrics are disabled by default, in this case 'stage' returns a
+shared no-op object and the cost is a global variable check. Once
+enabled ('enable'), each finished stage is written as a JSON line
+and/or aggregated in a summary table printed by 'close'. Other tools
+(e.g. 'profiling') follow the stages with 'add_hook'.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import functools
+import json
+import os
+import threading
+import time
+
+# Third-party imports
+import psycopg2.extensions
+
+# Propietary imports
+# None
+
+# Measures of each stage, in the summary table order
+MEASURES = (
+    "wall_s",
+    "rows_in",
+    "rows_out",
+    "sql_bytes",
+    "server_s",
+    "statements",
+    "commits"
+)
+
+# Upserted records, recorded only by the load stages
+UPSERT_MEASURES = ("inserted", "updated", "unchanged")
+
+_recorder = None
+_hooks = []
+_active = False
+_local = threading.local()
+
+class MetricsRecorder():
+    """Destination of the finished stages.
+
+    Attributes
+    ----------
+    path : String
+        description -> Location of the JSON lines file
+        format -> No apply
+        options -> 'None': The stages are not written.
+
+    summary : bool
+        description -> Aggregate the stages by name and print the
+            summary table at the end of the run
+        format -> No apply
+        options -> No apply
+
+    totals : Dictionary
+        description -> The aggregated measures by stage name
+        format -> {<stage>: {"calls": <calls>, <measure>: <total>}}
+        options -> No apply
+
+    Methods
+    -------
+    emit : Method
+        Record a finished stage.
+
+    close : Method
+        Close the file and print the summary table.
+    """
+    def __init__(self, path=None, summary=True):
+        self.path = path
+        self.summary = summary
+        self.totals = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file = open(path, "a") if path else None
+
+    def emit(self, record):
+        """Record a finished stage.
+
+        The stages finished by worker processes are ignored, the worker
+        processes inherit the recorder of the main process.
+
+        Parameters
+        ----------
+        record : Dictionary
+            description -> The measures of the stage
+            format -> {"stage": <name>, <measure>: <value>}
+            options -> No apply
+        """
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+            if self.summary:
+                totals = self.totals.setdefault(
+                    record["stage"],
+                    dict.fromkeys(("calls",) + MEASURES, 0)
+                )
+                totals["calls"] += 1
+                for measure in MEASURES:
+                    totals[measure] += record[measure]
+                for measure in UPSERT_MEASURES:
+                    if measure in record:
+                        totals[measure] = (
+                            totals.get(measure, 0) + record[measure]
+                        )
+
+    def close(self):
+        """Close the file and print the summary table."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.summary and self.totals:
+            print(summary_table(self.totals))
+
+class Stage():
+    """Measures of one execution of a stage.
+
+    Attributes
+    ----------
+    name : String
+        description -> The stage name, the executions with the same
+            name are aggregated in the summary table
+        format -> No apply
+        options -> No apply
+
+    rows_in : Integer
+        description -> Records received by the stage
+        format -> No apply
+        options -> No apply
+
+    rows_out : Integer
+        description -> Records produced by the stage, set inside the
+            'with' block
+        format -> No apply
+        options -> No apply
+
+    sql_bytes, server_s, statements, commits : Number
+        description -> Measures accounted by the connections and the
+            SQL builders while the stage is open
+        format -> No apply
+        options -> No apply
+
+    upserts : Dictionary
+        description -> Records upserted by a load stage, set inside the
+            'with' block
+        format -> {"inserted": <records>, "updated": <records>,
+                   "unchanged": <records>}
+        options -> 'None': The stage does not upsert records.
+    """
+    def __init__(self, name, rows_in=0):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = 0
+        self.sql_bytes = 0
+        self.server_s = 0.0
+        self.statements = 0
+        self.commits = 0
+        self.upserts = None
+        self._start = None
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        for hook in _hooks:
+            hook.enter_stage(self.name)
+        self._start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_s = time.perf_counter() - self._start
+        for hook in reversed(_hooks):
+            hook.exit_stage(self.name)
+        _local.stack.pop()
+        recorder = _recorder
+        if recorder is not None:
+            record = {
+                "stage": self.name,
+                "wall_s": round(wall_s, 6),
+                "rows_in": int(self.rows_in),
+                "rows_out": int(self.rows_out),
+                "sql_bytes": self.sql_bytes,
+                "server_s": round(self.server_s, 6),
+                "statements": self.statements,
+                "commits": self.commits
+            }
+            if self.upserts is not None:
+                record.update(self.upserts)
+            recorder.emit(record)
+
+        return False
+
+class _NullStage():
+    """No-op stage returned while the metrics are disabled."""
+    name = None
+    rows_in = 0
+    rows_out = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+def enable(path=None, summary=True):
+    """Start recording the stages.
+
+    Parameters
+    ----------
+    path : String
+        description -> Location of the JSON lines file, the stages are
+            appended
+        format -> No apply
+        options -> 'None': The stages are not written.
+
+    summary : bool
+        description -> Print the summary table at 'close'
+        format -> No apply
+        options -> No apply
+    """
+    global _recorder, _active
+    _recorder = MetricsRecorder(path, summary)
+    _active = True
+
+def enabled():
+    """'True' if the stages are recorded."""
+    return _recorder is not None
+
+def close():
+    """Stop recording the stages, close the file and print the summary."""
+    global _recorder, _active
+    recorder, _recorder = _recorder, None
+    _active = bool(_hooks)
+    if recorder is not None:
+        recorder.close()
+
+def add_hook(hook):
+    """Notify a hook when each stage starts and finishes.
+
+    The stages are measured while a hook is added, even if the metrics
+    are not recorded.
+
+    Parameters
+    ----------
+    hook : Object
+        description -> The hook, e.g. 'profiling.Profiler'
+        format -> Methods 'enter_stage(<name>)' and
+            'exit_stage(<name>)'
+        options -> No apply
+    """
+    global _active
+    _hooks.append(hook)
+    _active = True
+
+def remove_hook(hook):
+    """Stop notifying a hook added with 'add_hook'.
+
+    Parameters
+    ----------
+    hook : Object
+        description -> The hook to remove
+        format -> No apply
+        options -> No apply
+    """
+    global _active
+    _hooks.remove(hook)
+    _active = _recorder is not None or bool(_hooks)
+
+def stage(name, rows_in=0):
+    """Context manager that measures a stage.
+
+    Parameters
+    ----------
+    name : String
+        description -> The stage name
+        format -> No apply
+        options -> No apply
+
+    rows_in : Integer
+        description -> Records received by the stage
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    stage : Stage Instance
+        description -> The stage to use in a 'with' block, 'rows_out'
+            can be set inside the block
+        format -> No apply
+        options -> A shared no-op stage if the metrics are disabled.
+    """
+    if not _active:
+        return _NULL_STAGE
+
+    return Stage(name, rows_in)
+
+def account(sql_bytes=0, server_s=0.0, statements=0, commits=0):
+    """Add measures to every open stage of the current thread.
+
+    Parameters
+    ----------
+    sql_bytes : Integer
+        description -> Bytes of SQL generated or sent
+        format -> No apply
+        options -> No apply
+
+    server_s : Float
+        description -> Time waiting for the server
+        format -> Seconds
+        options -> No apply
+
+    statements : Integer
+        description -> Statements sent
+        format -> No apply
+        options -> No apply
+
+    commits : Integer
+        description -> Commits sent
+        format -> No apply
+        options -> No apply
+    """
+    for open_stage in getattr(_local, "stack", ()):
+        open_stage.sql_bytes += sql_bytes
+        open_stage.server_s += server_s
+        open_stage.statements += statements
+        open_stage.commits += commits
+
+def row_total(result):
+    """Number of records of a result, as returned by the process stages.
+
+    Parameters
+    ----------
+    result : Object
+        description -> The result of a stage
+        format -> No apply
+        options -> {
+            Dictionary: Records (or dataframes) by table, the records
+                are added,
+            Pandas Dataframe or List: Its length,
+            Other: '0'
+        }
+
+    Returns
+    -------
+    rows : Integer
+        description -> The number of records
+        format -> No apply
+        options -> No apply
+    """
+    if isinstance(result, dict):
+        return sum(
+            value if isinstance(value, int) else row_total(value)
+            for value in result.values()
+        )
+    if hasattr(result, "__len__") and not isinstance(result, str):
+        return len(result)
+
+    return 0
+
+def instrument(name):
+    """Decorator that measures each call of a function as a stage.
+
+    The records of the returned value ('row_total') are set as the
+    'rows_out' measure.
+
+    Parameters
+    ----------
+    name : String
+        description -> The stage name
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    decorator : Function
+        description -> The decorator
+        format -> No apply
+        options -> No apply
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active:
+                return func(*args, **kwargs)
+            with Stage(name) as record:
+                result = func(*args, **kwargs)
+                record.rows_out = row_total(result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+def builder(func):
+    """Decorator that measures a SQL builder of 'sql_queries.Queries'.
+
+    The records of the 'dataframe' argument are the 'rows_in' measure
+    and the size of the generated statement the 'sql_bytes' measure.
+
+    Parameters
+    ----------
+    func : Function
+        description -> The SQL builder
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    wrapper : Function
+        description -> The measured builder
+        format -> No apply
+        options -> No apply
+    """
+    name = f"build:{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _active:
+            return func(*args, **kwargs)
+        dataframe = kwargs.get("dataframe", args[0] if args else None)
+        with Stage(name, rows_in=row_total(dataframe)):
+            query = func(*args, **kwargs)
+            account(sql_bytes=len(query))
+
+        return query
+
+    return wrapper
+
+class MetricsCursor(psycopg2.extensions.cursor):
+    """Cursor that accounts its statements to the open stages.
+
+    Methods
+    -------
+    execute : Method
+        Execute a statement, accounting its bytes and time.
+
+    executemany : Method
+        Execute a statement once by parameters, accounting its time.
+
+    copy_expert : Method
+        Execute a 'COPY' statement, accounting its bytes and time.
+    """
+    def execute(self, query, vars=None):
+        """Execute a statement, accounting its bytes and time.
+
+        The bytes are the statement sent with its bound parameters.
+
+        Parameters
+        ----------
+        query : String
+            description -> The SQL statement
+            format -> No apply
+            options -> No apply
+
+        vars : Tuple or Dictionary
+            description -> The parameters of the statement
+            format -> No apply
+            options -> 'None': Statement without parameters.
+        """
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            account(
+                sql_bytes=len(self.query or b""),
+                server_s=time.perf_counter() - start,
+                statements=1
+            )
+
+    def executemany(self, query, vars_list):
+        """Execute a statement once by parameters, accounting its time.
+
+        Each execution is accounted as a statement.
+
+        Parameters
+        ----------
+        query : String
+            description -> The SQL statement
+            format -> No apply
+            options -> No apply
+
+        vars_list : Iterable
+            description -> The parameters of each execution
+            format -> Tuple or Dictionary
+            options -> No apply
+        """
+        vars_list = list(vars_list)
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            account(
+                server_s=time.perf_counter() - start,
+                statements=len(vars_list)
+            )
+
+    def copy_expert(self, sql, file, size=8192):
+        """Execute a 'COPY' statement, accounting its bytes and time.
+
+        The bytes are the statement and the content of an in-memory
+        file (e.g. 'io.StringIO').
+
+        Parameters
+        ----------
+        sql : String
+            description -> The 'COPY' statement
+            format -> No apply
+            options -> No apply
+
+        file : File-like Object
+            description -> The data read (or written) by the statement
+            format -> No apply
+            options -> No apply
+
+        size : Integer
+            description -> Size of the buffer used to read the file
+            format -> Bytes
+            options -> No apply
+        """
+        payload = file.getvalue() if hasattr(file, "getvalue") else ""
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            account(
+                sql_bytes=len(sql) + len(payload),
+                server_s=time.perf_counter() - start,
+                statements=1
+            )
+
+class MetricsConnection(psycopg2.extensions.connection):
+    """Connection that accounts its statements and commits to the stages.
+
+    The cursors of the connection are 'MetricsCursor' instances.
+
+    Methods
+    -------
+    commit : Method
+        Commit the transaction, accounting its time.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = MetricsCursor
+
+    def commit(self):
+        """Commit the transaction, accounting its time and the commit."""
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            account(server_s=time.perf_counter() - start, commits=1)
+
+def summary_table(totals):
+    """Format the aggregated measures as a text table.
+
+    Parameters
+    ----------
+    totals : Dictionary
+        description -> The aggregated measures by stage name
+        format -> As 'MetricsRecorder.totals'
+        options -> No apply
+
+    Returns
+    -------
+    table : String
+        description -> One row per stage, sorted by wall time
+        format -> No apply
+        options -> No apply
+    """
+    headers = ("stage", "calls") + MEASURES
+    if any("inserted" in values for values in totals.values()):
+        headers += UPSERT_MEASURES
+    rows = [
+        [name] + [
+            "" if measure not in values
+            else f"{values[measure]:.3f}"
+            if isinstance(values[measure], float)
+            else str(values[measure])
+            for measure in headers[1:]
+        ]
+        for name, values in sorted(
+            totals.items(), key=lambda item: -item[1]["wall_s"]
+        )
+    ]
+    widths = [
+        max(len(str(cell)) for cell in column)
+        for column in zip(headers, *rows)
+    ]
+    lines = [
+        "  ".join(
+            cell.ljust(width) if index == 0 else cell.rjust(width)
+            for index, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in [list(headers)] + rows
+    ]
+    lines.insert(1, "-" * len(lines[0]))
+
+    return "\n".join(["", "Stage metrics:"] + lines)
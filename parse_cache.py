@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""On-disk columnar cache of the parsed JSON files.
+
+Each run parses every JSON file of 'data/' again, even if the file did
+not change since the last run. With the parse cache enabled ('enable'),
+the dataframe parsed from each file (optionally projected to the used
+columns) is stored as one NumPy '.npy' file by column:
+
+    <cache>/<entry>/
+        meta.json       File, content hash, columns and their dtypes
+        <N>.npy         Values of the column N
+        <N>.mask.npy    Missing values of the text column N
+
+The entry is named by the file path and the projected columns, it is
+valid while the content hash of the file is the same, so a changed
+file is parsed and stored again. The numeric and datetime columns are
+memory-mapped when they are read, the text columns are stored as
+fixed-width unicode arrays with a mask of the missing values.
+
+The cache size is bounded, the least recently used entries are removed
+when the cache exceeds its maximum size. The files with columns that
+can not be stored (e.g. mixed types) are parsed each time.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Propietary imports
+import metrics
+
+DEFAULT_MAX_BYTES = 2**30
+
+# Kinds of the NumPy dtypes stored as they are
+NUMPY_KINDS = "biufcmM"
+
+META_FILE = "meta.json"
+
+_cache = None
+
+class ParseCache():
+    """Columnar files of the parsed JSON files, with LRU eviction.
+
+    Attributes
+    ----------
+    path : String
+        description -> Location of the cache directory
+        format -> No apply
+        options -> No apply
+
+    max_bytes : Integer
+        description -> Maximum size of the cache
+        format -> Bytes
+        options -> No apply
+
+    hits, misses : Integer
+        description -> Files read from the cache and parsed by this
+            process
+        format -> No apply
+        options -> No apply
+
+    Methods
+    -------
+    read_json : Method
+        Read a JSON lines file from the cache or parse it.
+
+    evict : Method
+        Remove the least recently used entries over the maximum size.
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def read_json(self, filepath, columns=None):
+        """Read a JSON lines file from the cache or parse it.
+
+        Parameters
+        ----------
+        filepath : String
+            description -> The JSON file location as a full path
+            format -> No apply
+            options -> No apply
+
+        columns : String List
+            description -> The columns kept of the parsed dataframe
+            format -> No apply
+            options -> 'None': Keep all the columns.
+
+        Returns
+        -------
+        dataframe : Pandas Dataframe
+            description -> The records of the file, as returned by
+                'pd.read_json(filepath, lines=True)'
+            format -> No apply
+            options -> No apply
+        """
+        with open(filepath, "rb") as file:
+            content = file.read()
+        content_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+        entry = os.path.join(self.path, self._entry_name(filepath, columns))
+
+        dataframe = self._read_entry(entry, content_hash)
+        if dataframe is not None:
+            self.hits += 1
+            return dataframe
+
+        self.misses += 1
+        dataframe = pd.read_json(io.BytesIO(content), lines=True)
+        if columns is not None:
+            dataframe = dataframe[columns]
+        self._write_entry(entry, filepath, content_hash, dataframe)
+
+        return dataframe
+
+    def evict(self):
+        """Remove the least recently used entries over the maximum size."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries:
+            if self._size <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            self._size -= size
+
+    def _entry_name(self, filepath, columns):
+        """Name of the entry of a file and its projected columns."""
+        key = os.path.abspath(filepath)
+        if columns is not None:
+            key += "\0" + "\0".join(columns)
+
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def _entries(self):
+        """Location, size and last use of each entry of the cache."""
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(entry, file))
+                    for file in os.listdir(entry)
+                )
+                last_use = os.path.getmtime(os.path.join(entry, META_FILE))
+            except OSError:
+                # removed or being written by another process
+                continue
+            yield entry, size, last_use
+
+    def _read_entry(self, entry, content_hash):
+        """Read the dataframe of an entry, 'None' if it is not valid."""
+        meta_path = os.path.join(entry, META_FILE)
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+            if meta["content_hash"] != content_hash:
+                return None
+
+            with metrics.stage("parse_cache:read", rows_in=meta["rows"]):
+                data = {}
+                columns = enumerate(meta["columns"])
+                for number, (column, dtype, is_text) in columns:
+                    values = np.load(
+                        os.path.join(entry, f"{number}.npy"), mmap_mode="r"
+                    )
+                    if is_text:
+                        mask = np.load(
+                            os.path.join(entry, f"{number}.mask.npy")
+                        )
+                        values = values.astype(object)
+                        values[mask] = None
+                        values = pd.Series(values, dtype=object)
+                        if dtype != "object":
+                            values = values.astype(dtype)
+                    data[column] = values
+                dataframe = pd.DataFrame(
+                    data, index=pd.RangeIndex(meta["rows"])
+                )
+            # the entry is the most recently used
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            # missing, evicted or incomplete entry
+            return None
+
+        return dataframe
+
+    def _write_entry(self, entry, filepath, content_hash, dataframe):
+        """Store the columns of a dataframe as a new entry."""
+        if not dataframe.index.equals(pd.RangeIndex(len(dataframe))):
+            return
+        columns = []
+        arrays = []
+        for column in dataframe.columns:
+            series = dataframe[column]
+            dtype = series.dtype
+            if isinstance(dtype, np.dtype) and dtype.kind in NUMPY_KINDS:
+                arrays.append((series.to_numpy(), None))
+                columns.append((column, str(dtype), False))
+            else:
+                values = series.to_numpy(dtype=object, copy=True)
+                mask = pd.isna(values)
+                if not all(isinstance(value, str) for value in values[~mask]):
+                    return
+                values[mask] = ""
+                arrays.append((values.astype(str), mask))
+                columns.append((column, str(dtype), True))
+
+        with metrics.stage("parse_cache:write", rows_in=len(dataframe)):
+            temporary = tempfile.mkdtemp(prefix=".tmp-", dir=self.path)
+            try:
+                for number, (values, mask) in enumerate(arrays):
+                    column_path = os.path.join(temporary, str(number))
+                    np.save(f"{column_path}.npy", values)
+                    if mask is not None:
+                        np.save(f"{column_path}.mask.npy", mask)
+                meta = {
+                    "file": os.path.abspath(filepath),
+                    "content_hash": content_hash,
+                    "rows": len(dataframe),
+                    "columns": columns
+                }
+                with open(os.path.join(temporary, META_FILE), "w") as file:
+                    json.dump(meta, file)
+                size = sum(
+                    os.path.getsize(os.path.join(temporary, file))
+                    for file in os.listdir(temporary)
+                )
+                if size > self.max_bytes:
+                    return
+                # replace the entry of a previous content of the file
+                shutil.rmtree(entry, ignore_errors=True)
+                os.rename(temporary, entry)
+            except OSError:
+                # the entry was written by another process
+                return
+            finally:
+                shutil.rmtree(temporary, ignore_errors=True)
+
+        self._size += size
+        if self._size > self.max_bytes:
+            self.evict()
+
+def enable(path, max_bytes=DEFAULT_MAX_BYTES):
+    """Read the JSON files through a 'ParseCache'.
+
+    The worker processes started after this call use the same cache.
+
+    Parameters
+    ----------
+    path : String
+        description -> Location of the cache directory, it is created
+            if it does not exist
+        format -> No apply
+        options -> No apply
+
+    max_bytes : Integer
+        description -> Maximum size of the cache
+        format -> Bytes
+        options -> No apply
+
+    Returns
+    -------
+    cache : ParseCache Instance
+        description -> The enabled cache
+        format -> No apply
+        options -> No apply
+    """
+    global _cache
+    _cache = ParseCache(path, max_bytes)
+
+    return _cache
+
+def enabled():
+    """'True' if the parse cache is enabled."""
+    return _cache is not None
+
+def close():
+    """Parse the JSON files again."""
+    global _cache
+    _cache = None
+
+def read_json(filepath, columns=None):
+    """Read a JSON lines file, from the parse cache if it is enabled.
+
+    Parameters
+    ----------
+    filepath : String
+        description -> The JSON file location as a full path
+        format -> No apply
+        options -> No apply
+
+    columns : String List
+        description -> The columns kept of the parsed dataframe
+        format -> No apply
+        options -> 'None': Keep all the columns.
+
+    Returns
+    -------
+    dataframe : Pandas Dataframe
+        description -> The records of the file
+        format -> No apply
+        options -> No apply
+    """
+    if _cache is not None:
+        return _cache.read_json(filepath, columns)
+
+    dataframe = pd.read_json(filepath, lines=True)
+    if columns is not None:
+        dataframe = dataframe[columns]
+
+    return dataframe
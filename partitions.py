@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Monthly partitions of the fact table 'songplay'.
+
+The table 'songplay' can be created partitioned by month of
+'start_time' ('python create_tables.py --partitioned'). The ETL
+pipeline detects it when the run starts and creates the partition of
+each new month before loading its records, the songplays records are
+sorted by 'start_time', so each batch writes the partitions in order.
+
+Old months can be detached ('ALTER TABLE songplay DETACH PARTITION
+songplay_<YYYY>_<MM>') and archived without rewriting the table, and
+the queries filtered by time only scan the partitions of the months
+required.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+# None
+
+# Third-party imports
+import pandas as pd
+
+# Propietary imports
+import metrics
+import sql_queries
+
+class SongplayPartitions():
+    """Monthly partitions of the table 'songplay' existing in the database.
+
+    Attributes
+    ----------
+    months : Set
+        description -> The months with a partition
+        format -> 'YYYY-MM'
+        options -> No apply
+
+    Methods
+    -------
+    load : Class Method
+        Retrieve the partitions, if the table is partitioned.
+
+    ensure : Method
+        Create the partitions of the months of given start times.
+
+    ensure_staged : Method
+        Create the partitions of the months of the staged events.
+
+    reload : Method
+        Retrieve again the existing partitions.
+
+    sort : Method
+        Sort songplays records by start time.
+    """
+    def __init__(self, months=()):
+        self.months = set(months)
+
+    @classmethod
+    def load(cls, cur):
+        """Retrieve the partitions of 'songplay', if it is partitioned.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        partitions : SongplayPartitions Instance
+            description -> The existing partitions
+            format -> No apply
+            options -> 'None': The table 'songplay' is not partitioned.
+        """
+        cur.execute(sql_queries.Queries.songplay_partitions_select())
+        rows = cur.fetchall()
+        if not rows:
+            return None
+
+        # partitions named 'songplay_<YYYY>_<MM>'
+        months = [
+            f"{name[-7:-3]}-{name[-2:]}"
+            for _, name in rows
+            if name is not None
+        ]
+
+        return cls(months)
+
+    def reload(self, cur):
+        """Retrieve again the partitions existing in the database.
+
+        The partitions created by a file rolled back do not exist, they
+        are created again by the next files.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+        """
+        partitions = self.load(cur)
+        self.months = set() if partitions is None else partitions.months
+
+    def ensure(self, cur, start_times):
+        """Create the partitions of the months of given start times.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        start_times : Pandas Series
+            description -> The start times of songplays records
+            format -> 'YYYY-MM-DDTHH:MM:SS'
+            options -> No apply
+
+        Returns
+        -------
+        created : String List
+            description -> The months of the partitions created
+            format -> 'YYYY-MM'
+            options -> No apply
+        """
+        months = pd.unique(start_times.str.slice(0, 7))
+
+        return self._create(cur, months)
+
+    def ensure_staged(self, cur):
+        """Create the partitions of the months of the staged events.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        created : String List
+            description -> The months of the partitions created
+            format -> 'YYYY-MM'
+            options -> No apply
+        """
+        cur.execute(sql_queries.Queries.staging_events_months())
+        months = [month for month, in cur.fetchall()]
+
+        return self._create(cur, months)
+
+    def _create(self, cur, months):
+        """Create the partitions of the months without partition."""
+        created = sorted(
+            month for month in months if month not in self.months
+        )
+        if not created:
+            return created
+
+        with metrics.stage("partitions:create", rows_in=len(created)):
+            for month in created:
+                cur.execute(
+                    sql_queries.Queries.songplay_partition_create(month)
+                )
+                self.months.add(month)
+
+        return created
+
+    @staticmethod
+    def sort(songplays_df):
+        """Sort songplays records by start time.
+
+        The sort is stable, so the records of the same second keep
+        their order.
+
+        Parameters
+        ----------
+        songplays_df : Pandas Dataframe
+            description -> The songplays records
+            format -> The start time is the first column
+            options -> No apply
+
+        Returns
+        -------
+        songplays_df : Pandas Dataframe
+            description -> The sorted records
+            format -> Same headers of the given dataframe
+            options -> No apply
+        """
+        start_time = songplays_df.columns[0]
+
+        return songplays_df.sort_values(start_time, kind="stable")
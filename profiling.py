@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""Opt-in CPU and memory profiling of the processed files.
+
+The selected files are profiled by stage, the stages are the same
+measured by 'metrics' (e.g. 'transform:log_file' reads the JSON file,
+'transform:time_records', 'transform:users', 'lookup:sql', 'load:time'):
+
+    * CPU: One cProfile per stage, the time of the inner stages is
+      excluded, so each function is accounted to the stage that runs
+      it; the stages are also merged in 'total.pstats'.
+    * Memory: tracemalloc snapshots at the start and the end of each
+      stage, the top allocation sites are accumulated by stage.
+
+A file is profiled if it matches one of the given patterns or, with a
+sampling rate, at random, so the profiling can stay on in production.
+With a number of slowest files, only the profiles of the slowest
+profiled files are kept and written at the end of the run; without
+patterns or sampling rate every file is profiled, so the slowest files
+of the run are kept.
+
+Each profiled file is written in its own directory:
+
+    <output>/<NNNN>-<file name>/
+        <stage>.pstats    cProfile statistics of the stage
+        total.pstats      cProfile statistics of all the stages
+        allocations.txt   Top allocation sites by stage
+        summary.json      File, wall time and stages calls
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import cProfile
+import contextlib
+import fnmatch
+import heapq
+import itertools
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+
+# Third-party imports
+# None
+
+# Propietary imports
+import metrics
+
+# Name of the profile of the code outside the stages
+FILE_STAGE = "file"
+
+_profiler = None
+
+class FileProfile():
+    """CPU and memory profiles of one file, by stage.
+
+    Attributes
+    ----------
+    datafile : String
+        description -> The profiled file
+        format -> No apply
+        options -> No apply
+
+    wall_s : Float
+        description -> Wall time of the file
+        format -> Seconds
+        options -> No apply
+
+    calls : Dictionary
+        description -> Executions of each stage
+        format -> {<stage>: <calls>}
+        options -> No apply
+
+    Methods
+    -------
+    enter_stage : Method
+        Pause the current stage profile and start the given one.
+
+    exit_stage : Method
+        Stop the given stage profile and resume the previous one.
+
+    write : Method
+        Write the profiles in a directory.
+    """
+    def __init__(self, datafile, top=25, memory=True):
+        self.datafile = datafile
+        self.wall_s = 0.0
+        self.calls = {}
+        self._top = top
+        self._memory = memory
+        self._profiles = {}
+        self._allocations = {}
+        self._stack = []
+        self._thread = threading.get_ident()
+
+    def start(self):
+        """Start the profile of the code outside the stages."""
+        self._start = time.perf_counter()
+        self.enter_stage(FILE_STAGE)
+
+    def stop(self):
+        """Stop the profile and measure the wall time."""
+        self.exit_stage(FILE_STAGE)
+        self.wall_s = time.perf_counter() - self._start
+
+    def enter_stage(self, name):
+        """Pause the current stage profile and start the given one.
+
+        Parameters
+        ----------
+        name : String
+            description -> The stage name
+            format -> No apply
+            options -> No apply
+        """
+        if threading.get_ident() != self._thread:
+            return
+        if self._stack:
+            self._profiles[self._stack[-1][0]].disable()
+        snapshot = tracemalloc.take_snapshot() if self._memory else None
+        self._stack.append((name, snapshot))
+        self.calls[name] = self.calls.get(name, 0) + 1
+        profile = self._profiles.setdefault(name, cProfile.Profile())
+        profile.enable()
+
+    def exit_stage(self, name):
+        """Stop the given stage profile and resume the previous one.
+
+        The allocations of the stage (including its inner stages) are
+        accumulated by source line.
+
+        Parameters
+        ----------
+        name : String
+            description -> The stage name
+            format -> No apply
+            options -> No apply
+        """
+        if threading.get_ident() != self._thread or not self._stack:
+            return
+        self._profiles[name].disable()
+        _, start_snapshot = self._stack.pop()
+        if start_snapshot is not None:
+            allocations = self._allocations.setdefault(name, {})
+            differences = tracemalloc.take_snapshot().compare_to(
+                start_snapshot, "lineno"
+            )
+            for difference in differences[:self._top]:
+                site = str(difference.traceback)
+                size, count = allocations.get(site, (0, 0))
+                allocations[site] = (
+                    size + difference.size_diff,
+                    count + difference.count_diff
+                )
+        if self._stack:
+            self._profiles[self._stack[-1][0]].enable()
+
+    def write(self, directory):
+        """Write the profiles in a directory.
+
+        Parameters
+        ----------
+        directory : String
+            description -> The output directory, it is created if it
+                does not exist
+            format -> No apply
+            options -> No apply
+        """
+        os.makedirs(directory, exist_ok=True)
+        total = None
+        for name, profile in self._profiles.items():
+            try:
+                stats = pstats.Stats(profile)
+            except TypeError:
+                # the stage did not execute Python code
+                continue
+            file_name = re.sub(r"[^\w.-]", "_", name)
+            stats.dump_stats(os.path.join(directory, f"{file_name}.pstats"))
+            if total is None:
+                total = stats
+            else:
+                total.add(stats)
+        if total is not None:
+            total.dump_stats(os.path.join(directory, "total.pstats"))
+
+        with open(os.path.join(directory, "allocations.txt"), "w") as file:
+            for name, allocations in self._allocations.items():
+                file.write(f"[{name}]\n")
+                top_sites = sorted(
+                    allocations.items(), key=lambda item: -item[1][0]
+                )[:self._top]
+                for site, (size, count) in top_sites:
+                    file.write(f"{size / 1024:12.1f} KiB {count:9d}  {site}\n")
+                file.write("\n")
+
+        with open(os.path.join(directory, "summary.json"), "w") as file:
+            json.dump(
+                {
+                    "file": self.datafile,
+                    "wall_s": round(self.wall_s, 6),
+                    "stages": self.calls
+                },
+                file,
+                indent=4
+            )
+
+class Profiler():
+    """Selection of the profiled files and destination of the profiles.
+
+    Attributes
+    ----------
+    output : String
+        description -> Directory of the profiles
+        format -> No apply
+        options -> No apply
+
+    sample_rate : Float
+        description -> Probability to profile a file not matched by the
+            patterns
+        format -> No apply
+        options -> [0, 1]
+
+    slowest : Integer
+        description -> Number of slowest profiled files kept
+        format -> No apply
+        options -> '0': Write the profile of each file when it ends.
+
+    patterns : String List
+        description -> Shell patterns of the files always profiled,
+            matched against the full path and the file name
+        format -> No apply
+        options -> No apply
+
+    top : Integer
+        description -> Allocation sites written by stage
+        format -> No apply
+        options -> No apply
+
+    memory : bool
+        description -> Trace the memory allocations
+        format -> No apply
+        options -> No apply
+
+    Methods
+    -------
+    selected : Method
+        Check if a file must be profiled.
+
+    profile_file : Method
+        Context manager that profiles a file, if it is selected.
+
+    enter_stage, exit_stage : Method
+        Hooks of 'metrics' to profile each stage.
+
+    close : Method
+        Write the slowest profiles kept.
+    """
+    def __init__(
+        self,
+        output,
+        sample_rate=0.0,
+        slowest=0,
+        patterns=None,
+        top=25,
+        memory=True,
+        seed=None
+    ):
+        self.output = output
+        self.sample_rate = sample_rate
+        self.slowest = slowest
+        self.patterns = patterns or []
+        self.top = top
+        self.memory = memory
+        self._random = random.Random(seed)
+        self._active = None
+        self._kept = []
+        self._counter = itertools.count(1)
+
+    def selected(self, datafile):
+        """Check if a file must be profiled.
+
+        Parameters
+        ----------
+        datafile : String
+            description -> The file location as full path
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        selected : bool
+            description -> 'True' if the file matches a pattern or it
+                is sampled, or if only the slowest files are selected
+            format -> No apply
+            options -> No apply
+        """
+        if self.slowest and not self.patterns and not self.sample_rate:
+            return True
+        name = os.path.basename(datafile)
+        for pattern in self.patterns:
+            if fnmatch.fnmatch(datafile, pattern):
+                return True
+            if fnmatch.fnmatch(name, pattern):
+                return True
+
+        return self._random.random() < self.sample_rate
+
+    @contextlib.contextmanager
+    def profile_file(self, datafile):
+        """Profile a file, if it is selected.
+
+        Parameters
+        ----------
+        datafile : String
+            description -> The file location as full path
+            format -> No apply
+            options -> No apply
+        """
+        if self._active is not None or not self.selected(datafile):
+            yield
+            return
+
+        profile = FileProfile(datafile, self.top, self.memory)
+        started_tracing = self.memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        self._active = profile
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            self._active = None
+            if started_tracing:
+                tracemalloc.stop()
+            self._keep(profile)
+
+    def enter_stage(self, name):
+        """Hook of 'metrics', start the profile of a stage."""
+        if self._active is not None:
+            self._active.enter_stage(name)
+
+    def exit_stage(self, name):
+        """Hook of 'metrics', stop the profile of a stage."""
+        if self._active is not None:
+            self._active.exit_stage(name)
+
+    def close(self):
+        """Write the slowest profiles kept, the slowest first."""
+        for _, order, profile in sorted(self._kept, reverse=True):
+            self._write(order, profile)
+        self._kept = []
+
+    def _keep(self, profile):
+        """Write the profile, or keep it if it is one of the slowest."""
+        order = next(self._counter)
+        if not self.slowest:
+            self._write(order, profile)
+            return
+
+        item = (profile.wall_s, order, profile)
+        if len(self._kept) < self.slowest:
+            heapq.heappush(self._kept, item)
+        elif item > self._kept[0]:
+            heapq.heapreplace(self._kept, item)
+
+    def _write(self, order, profile):
+        """Write a profile in its own directory."""
+        name = os.path.splitext(os.path.basename(profile.datafile))[0]
+        directory = os.path.join(self.output, f"{order:04d}-{name}")
+        profile.write(directory)
+
+def enable(output, **kwargs):
+    """Start profiling the selected files.
+
+    Parameters
+    ----------
+    output : String
+        description -> Directory of the profiles
+        format -> No apply
+        options -> No apply
+
+    kwargs : Keyword Arguments
+        description -> Options of the profiler
+        format -> No apply
+        options -> {sample_rate, slowest, patterns, top, memory, seed}
+    """
+    global _profiler
+    _profiler = Profiler(output, **kwargs)
+    metrics.add_hook(_profiler)
+
+def close():
+    """Stop profiling and write the slowest profiles kept."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        metrics.remove_hook(profiler)
+        profiler.close()
+
+def profile_file(datafile):
+    """Context manager that profiles a file, if it is selected.
+
+    Parameters
+    ----------
+    datafile : String
+        description -> The file location as full path
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    context : Context Manager
+        description -> The file profile context
+        format -> No apply
+        options -> A no-op context if the profiling is disabled.
+    """
+    if _profiler is None:
+        return contextlib.nullcontext()
+
+    return _profiler.profile_file(datafile)
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Quarantine of the records rejected by the tables constraints.
+
+A single record that violates a constraint (e.g. the 'gender', the
+'session_id > 0' or the latitude and longitude checks) fails the whole
+statement of its batch. With the quarantine enabled, each batch is
+loaded inside a savepoint, if it fails with a data or integrity error:
+
+    * The batch is rolled back to the savepoint and split in halves.
+    * Each half is loaded again, the halves that fail are split again
+      until the failing records are isolated.
+    * Each failing record is written with its error in the dead-letter
+      table 'load_rejects' or in a JSON lines file.
+
+The batches without errors are loaded with a single statement, the
+cost of a failing batch grows with the number of failing records
+(about 2 statements by record and level of the bisection). If the
+rejected records exceed a limit, the error is raised, so a systematic
+failure (e.g. a missing reference of a foreign key) still stops the
+run.
+
+The records rejected into the table are rolled back with their file,
+the records written in the JSON lines file are kept. The rejected
+records are also kept by table until they are taken ('pop_rejected'),
+e.g. to forget them from the run cache of the records sent.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import datetime
+import json
+
+# Third-party imports
+import pandas as pd
+import psycopg2
+
+# Propietary imports
+import metrics
+import sql_queries
+
+# Rejected records that stop the run
+DEFAULT_MAX_REJECTS = 1_000
+
+# Errors caused by the values of a record
+RECORD_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+# Savepoint of the batch being loaded
+BATCH_SAVEPOINT = "load_batch"
+
+_quarantine = None
+
+class Quarantine():
+    """Bisection of the failed batches and destination of the rejects.
+
+    Attributes
+    ----------
+    path : String
+        description -> Location of the JSON lines file of the rejected
+            records
+        format -> No apply
+        options -> 'None': Write them in the table 'load_rejects'.
+
+    max_rejects : Integer
+        description -> Rejected records allowed in the run, the next
+            error is raised
+        format -> No apply
+        options -> No apply
+
+    source : String
+        description -> The files of the records being loaded
+        format -> No apply
+        options -> 'None': Unknown.
+
+    rejected : Dictionary
+        description -> Rejected records by table
+        format -> {<table>: <records>}
+        options -> No apply
+
+    rejected_records : Dictionary
+        description -> The rejected records by table, not taken yet
+            ('pop_rejected')
+        format -> {<table>: [<Pandas Dataframe of one record>]}
+        options -> No apply
+
+    Methods
+    -------
+    load : Method
+        Load a batch, isolating and rejecting its failing records.
+    """
+    def __init__(self, path=None, max_rejects=DEFAULT_MAX_REJECTS):
+        self.path = path
+        self.max_rejects = max_rejects
+        self.source = None
+        self.rejected = {}
+        self.rejected_records = {}
+
+    def load(self, cur, dataframe, table, load):
+        """Load a batch, isolating and rejecting its failing records.
+
+        Parameters
+        ----------
+        cur : PostgreSQL Cursor Instance
+            description -> The cursor required to execute build-in
+                queries.
+            format -> No apply
+            options -> No apply
+
+        dataframe : Pandas Dataframe
+            description -> The records to load
+            format -> Columns ordered as
+                'sql_queries.TABLE_SPECS[table]'
+            options -> No apply
+
+        table : String
+            description -> The name of the target table
+            format -> No apply
+            options -> No apply
+
+        load : Function
+            description -> Loads a part of the dataframe with the load
+                engine
+            format -> load(<dataframe>) -> (<inserted>, <updated>)
+            options -> No apply
+
+        Returns
+        -------
+        written : Tuple
+            description -> The records inserted, updated and rejected
+            format -> (<inserted>, <updated>, <rejected>)
+            options -> No apply
+        """
+        cur.execute(f"SAVEPOINT {BATCH_SAVEPOINT};")
+        try:
+            inserted, updated = load(dataframe)
+        except RECORD_ERRORS as error:
+            cur.execute(f"ROLLBACK TO SAVEPOINT {BATCH_SAVEPOINT};")
+            cur.execute(f"RELEASE SAVEPOINT {BATCH_SAVEPOINT};")
+            if len(dataframe) == 1:
+                self._reject(cur, dataframe, table, error)
+
+                return 0, 0, 1
+
+            with metrics.stage(
+                f"quarantine:{table}", rows_in=len(dataframe)
+            ) as stage:
+                middle = len(dataframe) // 2
+                written = [
+                    self.load(cur, part, table, load)
+                    for part in (dataframe.iloc[:middle],
+                                 dataframe.iloc[middle:])
+                ]
+                written = tuple(map(sum, zip(*written)))
+                stage.rows_out = written[0] + written[1]
+
+            return written
+
+        cur.execute(f"RELEASE SAVEPOINT {BATCH_SAVEPOINT};")
+
+        return inserted, updated, 0
+
+    def _reject(self, cur, dataframe, table, error):
+        """Write a failing record with its error."""
+        total = sum(self.rejected.values())
+        if total >= self.max_rejects:
+            raise error
+        self.rejected[table] = self.rejected.get(table, 0) + 1
+        self.rejected_records.setdefault(table, []).append(dataframe)
+
+        columns = [
+            column.strip("\"")
+            for column in sql_queries.TABLE_SPECS[table]["columns"]
+        ]
+        values = dataframe.astype(object).iloc[0]
+        record = {
+            column: None if value is None or value != value else value
+            for column, value in zip(columns, values)
+        }
+        message = (error.pgerror or str(error)).strip()
+        if self.path is None:
+            cur.execute(
+                sql_queries.Queries.load_reject_insert(),
+                (
+                    table,
+                    json.dumps(record, default=str),
+                    message,
+                    error.pgcode,
+                    self.source
+                )
+            )
+            return
+
+        with open(self.path, "a") as file:
+            file.write(
+                json.dumps(
+                    {
+                        "table": table,
+                        "record": record,
+                        "error": message,
+                        "sqlstate": error.pgcode,
+                        "source": self.source,
+                        "rejected_at": datetime.datetime.now().isoformat()
+                    },
+                    default=str
+                ) + "\n"
+            )
+
+def enable(cur=None, path=None, max_rejects=DEFAULT_MAX_REJECTS):
+    """Start isolating and rejecting the failing records.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor used to create the table
+            'load_rejects' if it does not exist
+        format -> No apply
+        options -> 'None': Only allowed with a JSON lines file.
+
+    path : String
+        description -> Location of the JSON lines file of the rejected
+            records
+        format -> No apply
+        options -> 'None': Write them in the table 'load_rejects'.
+
+    max_rejects : Integer
+        description -> Rejected records allowed in the run
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    quarantine : Quarantine Instance
+        description -> The enabled quarantine
+        format -> No apply
+        options -> No apply
+    """
+    global _quarantine
+    if path is None:
+        cur.execute(sql_queries.Queries().load_rejects_table_create)
+    _quarantine = Quarantine(path, max_rejects)
+
+    return _quarantine
+
+def enabled():
+    """'True' if the quarantine is enabled."""
+    return _quarantine is not None
+
+def close():
+    """Stop isolating the failing records."""
+    global _quarantine
+    _quarantine = None
+
+def set_source(datafiles):
+    """Set the files of the records being loaded.
+
+    Parameters
+    ----------
+    datafiles : String List
+        description -> The files location as full paths
+        format -> No apply
+        options -> No apply
+    """
+    if _quarantine is not None:
+        _quarantine.source = ", ".join(datafiles)
+
+def pop_rejected(table):
+    """Take the records of a table rejected since the last call.
+
+    Parameters
+    ----------
+    table : String
+        description -> The name of the target table
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    dataframe : Pandas Dataframe
+        description -> The rejected records
+        format -> Columns ordered as 'sql_queries.TABLE_SPECS[table]'
+        options -> 'None': No record rejected or quarantine disabled.
+    """
+    if _quarantine is None:
+        return None
+    records = _quarantine.rejected_records.pop(table, None)
+    if not records:
+        return None
+
+    return pd.concat(records)
+
+def load(cur, dataframe, table, load):
+    """Load a batch with the enabled quarantine ('Quarantine.load')."""
+    return _quarantine.load(cur, dataframe, table, load)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Incrementally maintained rollups of the fact table 'songplay'.
+
+The analytical questions (plays per song per day, active users per
+hour, paid and free plays per week) are answered by the rollup tables
+of 'sql_queries.ROLLUP_SPECS' instead of scanning 'songplay':
+
+    * songplay_song_daily: plays by day, song and artist.
+    * songplay_user_hourly: plays by hour, user and level, the active
+      users of an hour are its records.
+    * songplay_level_weekly: plays by week and level.
+
+The table 'rollup_watermark' keeps the last 'songplay_id' counted, each
+refresh adds the plays of the songplays after the watermark and moves
+it in the same transaction, so the songplays are counted once. The ETL
+pipeline refreshes the rollups with each commit ('python etl.py
+--rollups'), they can also be refreshed, rebuilt or verified on demand:
+
+    python rollups.py refresh [--rebuild]
+    python rollups.py verify
+
+The rollups only add the new songplays, they must be rebuilt after the
+songplays are deleted or updated (e.g. a detached partition).
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import argparse
+import sys
+
+# Third-party imports
+# None
+
+# Propietary imports
+import database
+import metrics
+import sql_queries
+
+def create_tables(cur):
+    """Create the rollup tables and the watermark if they do not exist.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+    """
+    for query in sql_queries.Queries().create_rollup_queries:
+        cur.execute(query)
+
+def refresh(cur):
+    """Add the plays of the songplays after the watermark to the rollups.
+
+    * Lock the watermark, so the concurrent refreshes wait.
+    * Retrieve the last 'songplay_id' and the number of songplays after
+      the watermark, nothing is done if there are none.
+    * Add the plays of the range to each rollup table.
+    * Move the watermark to the last 'songplay_id'.
+
+    The caller commits the transaction, the songplays must be written
+    by a single connection, a songplay committed later with a lower
+    'songplay_id' is not counted until the rollups are rebuilt.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    refreshed : Dictionary
+        description -> The songplays counted and the records written in
+            each rollup table
+        format -> {"songplay": <songplays>, <rollup table>: <records>}
+        options -> No apply
+    """
+    sql = sql_queries.Queries
+    cur.execute(sql.rollup_watermark_select())
+    low, = cur.fetchone()
+    cur.execute(sql.rollup_range_select(), {"low": low})
+    high, songplays = cur.fetchone()
+    refreshed = {"songplay": songplays or 0}
+    if high is None:
+        return refreshed
+
+    with metrics.stage("rollups:refresh", rows_in=songplays) as stage:
+        for name in sql_queries.ROLLUP_SPECS:
+            cur.execute(sql.rollup_refresh(name), {"low": low, "high": high})
+            refreshed[name] = cur.rowcount
+        cur.execute(sql.rollup_watermark_update(), {"high": high})
+        stage.rows_out = sum(
+            records for name, records in refreshed.items()
+            if name != "songplay"
+        )
+
+    return refreshed
+
+def rebuild(cur):
+    """Empty the rollups and count all the songplays again.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    refreshed : Dictionary
+        description -> The result of 'refresh'
+        format -> {"songplay": <songplays>, <rollup table>: <records>}
+        options -> No apply
+    """
+    cur.execute(sql_queries.Queries.rollup_truncate())
+
+    return refresh(cur)
+
+def verify(cur):
+    """Compare each rollup table with a full recompute of 'songplay'.
+
+    Only the songplays up to the watermark are recomputed, so the
+    songplays loaded after the last refresh are not differences.
+
+    Parameters
+    ----------
+    cur : PostgreSQL Cursor Instance
+        description -> The cursor required to execute build-in queries.
+        format -> No apply
+        options -> No apply
+
+    Returns
+    -------
+    differences : Dictionary
+        description -> Number of records of each rollup table missing,
+            unexpected or with different plays
+        format -> {<rollup table>: <records>}
+        options -> No apply
+    """
+    differences = {}
+    for name in sql_queries.ROLLUP_SPECS:
+        with metrics.stage(f"rollups:verify:{name}"):
+            cur.execute(sql_queries.Queries.rollup_verify(name))
+            differences[name], = cur.fetchone()
+
+    return differences
+
+def parse_arguments(argv=None):
+    """Read the script options from the command line.
+
+    Parameters
+    ----------
+    argv : String List
+        description -> The command line arguments
+        format -> No apply
+        options -> 'None': Use the arguments given to the script.
+
+    Returns
+    -------
+    args : argparse.Namespace
+        description -> The parsed options
+        format -> No apply
+        options -> No apply
+    """
+    parser = argparse.ArgumentParser(
+        description="Refresh or verify the rollups of 'songplay'"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    refresh_parser = commands.add_parser(
+        "refresh",
+        help="Add the songplays loaded after the last refresh."
+    )
+    refresh_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Empty the rollups and count all the songplays again."
+    )
+    commands.add_parser(
+        "verify",
+        help=(
+            "Compare the rollups with a full recompute of 'songplay', "
+            "exit with status 1 if they differ."
+        )
+    )
+
+    return parser.parse_args(argv)
+
+def main():
+    """Refresh or verify the rollups.
+
+    * Read the script options.
+    * Connect to the Sparkify's database, the connection settings are
+      read by 'database.load_settings'.
+    * Create the rollup tables if they do not exist.
+    * Refresh (or rebuild) the rollups and print the records written,
+      or verify them and print the differences of each table.
+    * Commit and close the connection.
+    """
+    args = parse_arguments()
+    conn = database.connect()
+    cur = conn.cursor()
+    create_tables(cur)
+
+    status = 0
+    if args.command == "refresh":
+        refreshed = rebuild(cur) if args.rebuild else refresh(cur)
+        print(f"{refreshed.pop('songplay')} songplays counted.")
+        for name, records in refreshed.items():
+            print(f"{name}: {records} records written.")
+    else:
+        differences = verify(cur)
+        for name, records in differences.items():
+            print(f"{name}: {records} records differ.")
+        if any(differences.values()):
+            status = 1
+    conn.commit()
+
+    cur.close()
+    conn.close()
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,234 @@ import re
 # None
 
 # Propietary imports
-# None
+import metrics
+
+# Decimal places of the 'songs.duration' attribute, the song IDs search
+# compares the songplays length rounded to them.
+DURATION_SCALE = 5
+
+# Columns and conflict targets of each table, the columns order is the
+# same order used by the dataframes sent to the INSERT builders.
+TABLE_SPECS = {
+    "time": {
+        "name": "\"time\"",
+        "columns": [
+            "start_time",
+            "hour",
+            "day",
+            "week",
+            "month",
+            "\"year\"",
+            "weekday"
+        ],
+        "conflict": ["start_time"]
+    },
+    "users": {
+        "name": "users",
+        "columns": ["user_id", "first_name", "last_name", "gender", "level"],
+        "conflict": ["user_id"]
+    },
+    "artists": {
+        "name": "artists",
+        "columns": [
+            "artist_id",
+            "\"name\"",
+            "location",
+            "latitude",
+            "longitude"
+        ],
+        "conflict": ["artist_id"]
+    },
+    "songs": {
+        "name": "songs",
+        "columns": ["song_id", "title", "artist_id", "\"year\"", "duration"],
+        "conflict": ["song_id"]
+    },
+    "songplay": {
+        "name": "songplay",
+        "columns": [
+            "start_time",
+            "user_id",
+            "level",
+            "song_id",
+            "artist_id",
+            "session_id",
+            "location",
+            "user_agent"
+        ],
+        "conflict": []
+    },
+    "staging_events": {
+        "name": "staging_events",
+        "columns": [
+            "ts",
+            "user_id",
+            "first_name",
+            "last_name",
+            "gender",
+            "level",
+            "song",
+            "artist",
+            "length",
+            "session_id",
+            "location",
+            "user_agent"
+        ],
+        "conflict": []
+    }
+}
+
+# Foreign keys of the tables, the bulk-load profile drops them before
+# the load and adds them again at the end.
+FOREIGN_KEYS = {
+    "songs_artist_id_fkey": {
+        "table": "songs",
+        "column": "artist_id",
+        "references": "artists",
+        "reference_column": "artist_id",
+        "on_delete": "SET NULL"
+    },
+    "songplay_start_time_fkey": {
+        "table": "songplay",
+        "column": "start_time",
+        "references": "\"time\"",
+        "reference_column": "start_time",
+        "on_delete": None
+    },
+    "songplay_user_id_fkey": {
+        "table": "songplay",
+        "column": "user_id",
+        "references": "users",
+        "reference_column": "user_id",
+        "on_delete": "SET NULL"
+    },
+    "songplay_song_id_fkey": {
+        "table": "songplay",
+        "column": "song_id",
+        "references": "songs",
+        "reference_column": "song_id",
+        "on_delete": "SET NULL"
+    },
+    "songplay_artist_id_fkey": {
+        "table": "songplay",
+        "column": "artist_id",
+        "references": "artists",
+        "reference_column": "artist_id",
+        "on_delete": "SET NULL"
+    }
+}
+
+# Rollups of the fact table 'songplay', the plays are counted by the
+# given keys (column, expression over 'songplay'), only the records
+# that match the filter are counted.
+ROLLUP_SPECS = {
+    "songplay_song_daily": {
+        "keys": [
+            ("day", "CAST(start_time AS date)"),
+            ("song_id", "song_id"),
+            ("artist_id", "artist_id")
+        ],
+        "filter": "song_id IS NOT NULL AND artist_id IS NOT NULL"
+    },
+    "songplay_user_hourly": {
+        "keys": [
+            ("hour", "date_trunc('hour', start_time)"),
+            ("user_id", "user_id"),
+            ("level", "COALESCE(level, 'unknown')")
+        ],
+        "filter": "user_id IS NOT NULL"
+    },
+    "songplay_level_weekly": {
+        "keys": [
+            ("week", "CAST(date_trunc('week', start_time) AS date)"),
+            ("level", "COALESCE(level, 'unknown')")
+        ],
+        "filter": None
+    }
+}
+
+def upsert_clause(table):
+    """Build the 'ON CONFLICT ... DO UPDATE' clause of a given table.
+
+    The existing records are updated only if some attribute changed,
+    the unchanged records are not rewritten, so repeated loads do not
+    produce dead tuples, WAL or index updates.
+
+    Parameters
+    ----------
+    table : String
+        description -> The name of the target table
+        format -> No apply
+        options -> {'time', 'users', 'artists', 'songs', 'songplay'}
+
+    Returns
+    -------
+    clause : String
+        description -> The clause to append to an INSERT statement, it
+            is empty if the table has no conflict target
+        format -> No apply
+        options -> No apply
+    """
+    spec = TABLE_SPECS[table]
+    if not spec["conflict"]:
+        return ""
+
+    columns = [
+        column for column in spec["columns"]
+        if column not in spec["conflict"]
+    ]
+    updates = ",\n".join(
+        f"{column} = EXCLUDED.{column}" for column in columns
+    )
+    current = ", ".join(f"{spec['name']}.{column}" for column in columns)
+    excluded = ", ".join(f"EXCLUDED.{column}" for column in columns)
+    clause = (
+        f"ON CONFLICT ({', '.join(spec['conflict'])})\n"
+        "DO UPDATE SET\n"
+        f"{updates}\n"
+        f"WHERE ({current})\n"
+        f"IS DISTINCT FROM ({excluded})"
+    )
+
+    return clause
+
+def upsert_counts_query(query):
+    """Wrap an upsert statement to count the inserted and updated records.
+
+    The upsert returns '(xmax = 0)' for each written record, it is
+    'true' for the inserted records and 'false' for the updated ones;
+    the records skipped by the 'WHERE ... IS DISTINCT FROM' guard of
+    'upsert_clause' are not returned, they are the unchanged records.
+
+    Parameters
+    ----------
+    query : String
+        description -> An 'INSERT ... ON CONFLICT ... DO UPDATE'
+            statement
+        format -> Ended by ';'
+        options -> No apply
+
+    Returns
+    -------
+    query : String
+        description -> The statement that executes the upsert and
+            returns one record with the counts
+        format -> Columns: (<inserted records>, <updated records>)
+        options -> No apply
+    """
+    upsert = query.rstrip().rstrip(";")
+    query = (
+        "WITH upserted AS (\n"
+        f"{upsert}\n"
+        "RETURNING (xmax = 0) AS inserted\n"
+        ")\n"
+        "SELECT\n"
+        "    count(*) FILTER (WHERE inserted),\n"
+        "    count(*) FILTER (WHERE NOT inserted)\n"
+        "FROM upserted;\n"
+    )
+
+    return query
 
 class Queries():
     """Queries class.
@@ -34,12 +261,34 @@ class Queries():
                 3. 'time_table_create'
                 4. 'user_table_create'
                 5. 'songplay_table_create'
+                6. 'manifest_table_create'
+                7. 'load_rejects_table_create'
+                8. The queries of 'create_rollup_queries'
+                9. The queries of 'create_index_queries'
 
             Create tables in this order allows to reference the primary
             keys from tables with an especific foreign key.
         format -> No apply
         options -> No apply
 
+    create_index_queries : String List
+        description -> Each element has a query to create an index if
+            it does not exist, the indexes support the search of song
+            IDs and artist IDs and the foreign keys of 'songplay':
+                1. 'songs (title, duration)'
+                2. 'artists ("name")'
+                3. 'songs (artist_id)'
+                4. 'songplay (start_time)'
+                5. 'songplay (user_id)'
+                6. 'songplay (song_id)'
+                7. 'songplay (artist_id)'
+
+            The indexes are also included at the end of
+            'create_table_queries', they can be created after the
+            initial load instead, so the load does not maintain them.
+        format -> No apply
+        options -> No apply
+
     drop_table_queries : String List
         description -> Each element has a query to drop an especific
             table, the deletion order is:
@@ -48,12 +297,54 @@ class Queries():
                 3. 'user_table_drop'
                 4. 'song_table_drop'
                 5. 'artist_table_drop'
+                6. 'manifest_table_drop'
+                7. 'load_rejects_table_drop'
+                8. 'staging_events_table_drop'
+                9. The rollup tables and 'rollup_watermark'
 
             The tables are created with especific restrictions, so this
             deletion order is critical.
         format -> No apply
         options -> No apply
 
+    create_rollup_queries : String List
+        description -> Each element has a query to create a rollup
+            table of 'songplay' if it does not exist (see
+            'ROLLUP_SPECS'), the last query creates the table
+            'rollup_watermark' with the last 'songplay_id' counted in
+            the rollups
+        format -> No apply
+        options -> No apply
+
+    manifest_table_create : String
+        description -> Query to create the table 'ingest_manifest' if it
+            does not exist, the table records each ingested file, so
+            the ETL pipeline can skip the unchanged files
+        format -> No apply
+        options -> No apply
+
+    load_rejects_table_create : String
+        description -> Query to create the table 'load_rejects' if it
+            does not exist, the dead-letter table of the records
+            rejected by the constraints of the tables
+        format -> No apply
+        options -> No apply
+
+    staging_events_table_create : String
+        description -> Query to create the unlogged table
+            'staging_events' if it does not exist, the table keeps the
+            raw NextSong events of the log files loaded in the server
+        format -> No apply
+        options -> No apply
+
+    create_partitioned_table_queries : String List
+        description -> Same queries of 'create_table_queries', but the
+            table 'songplay' is partitioned by month of 'start_time'
+            ('songplay_partitioned_table_create'), the partitions are
+            created by the ETL pipeline as new months are loaded
+        format -> No apply
+        options -> No apply
+
     Methods
     -------
     artist_table_insert : Static Method
@@ -80,6 +371,130 @@ class Queries():
         Method to create a retrieve query statement from a dataframe
         with artists name, title songs and duretion of the song. The
         tables used are 'songs' and 'artists'.
+
+    staging_table_create : Static Method
+        Method to create the temporary staging table of a given table,
+        used by the COPY loader.
+
+    copy_from_stdin : Static Method
+        Method to create the COPY statement that streams CSV records
+        into a given table.
+
+    staging_table_merge : Static Method
+        Method to create the INSERT statement that moves the staging
+        records into a given table keeping the upsert behavior.
+
+    table_insert_template : Static Method
+        Method to create the parameterized INSERT statement of a given
+        table, the records are sent as bound parameters.
+
+    song_select_template : Static Method
+        Method to create the parameterized version of 'song_select',
+        the records are sent as bound parameters.
+
+    song_lookup_size : Static Method
+        Method to create a query to count the songs and the size of the
+        attributes used to find the song IDs and artist IDs.
+
+    song_lookup_select : Static Method
+        Method to create a query to retrieve all the songs with the
+        attributes used to find the song IDs and artist IDs.
+
+    manifest_select : Static Method
+        Method to create a query to retrieve the files recorded in the
+        table 'ingest_manifest'.
+
+    manifest_upsert : Static Method
+        Method to create the parameterized query to record a file in
+        the table 'ingest_manifest'.
+
+    manifest_touch : Static Method
+        Method to create the parameterized query to update the
+        modification time of an unchanged file in 'ingest_manifest'.
+
+    manifest_songplays_add : Static Method
+        Method to create a query to add the songplays range columns to
+        a table 'ingest_manifest' created without them.
+
+    songplay_last_id : Static Method
+        Method to create a query to retrieve the last 'songplay_id'.
+
+    songplay_range_delete : Static Method
+        Method to create the parameterized query to delete the
+        songplays of a range of 'songplay_id'.
+
+    load_reject_insert : Static Method
+        Method to create the parameterized query to record a rejected
+        record in the table 'load_rejects'.
+
+    foreign_key_drop : Static Method
+        Method to create a query to drop a foreign key of
+        'FOREIGN_KEYS'.
+
+    foreign_key_add : Static Method
+        Method to create a query to add a foreign key of
+        'FOREIGN_KEYS', optionally without checking the current
+        records.
+
+    foreign_key_violations : Static Method
+        Method to create a query to count the records that violate a
+        foreign key of 'FOREIGN_KEYS'.
+
+    foreign_key_validate : Static Method
+        Method to create a query to validate a foreign key added
+        without checking the current records.
+
+    staging_events_truncate : Static Method
+        Method to create a query to empty the table 'staging_events'.
+
+    time_table_insert_from_staging : Static Method
+        Method to create a query to insert the time records of the
+        events in 'staging_events' into the table 'time'.
+
+    user_table_insert_from_staging : Static Method
+        Method to create a query to insert the user records of the
+        events in 'staging_events' into the table 'users'.
+
+    songplay_table_insert_from_staging : Static Method
+        Method to create a query to insert the songplays records of
+        the events in 'staging_events' into the table 'songplay', the
+        song IDs and artist IDs are found in the same statement.
+
+    songplay_partitions_select : Static Method
+        Method to create a query to retrieve the partitions of the
+        table 'songplay', no records if it is not partitioned.
+
+    songplay_partition_create : Static Method
+        Method to create a query to create the partition of a month of
+        the table 'songplay'.
+
+    staging_events_months : Static Method
+        Method to create a query to retrieve the months of the events
+        in 'staging_events'.
+
+    rollup_watermark_select : Static Method
+        Method to create a query to lock and retrieve the last
+        'songplay_id' counted in the rollups.
+
+    rollup_range_select : Static Method
+        Method to create the parameterized query to retrieve the last
+        'songplay_id' and the number of songplays after the watermark.
+
+    rollup_refresh : Static Method
+        Method to create the parameterized query to add the plays of a
+        range of songplays to a rollup table.
+
+    rollup_watermark_update : Static Method
+        Method to create the parameterized query to move the watermark
+        of the rollups.
+
+    rollup_truncate : Static Method
+        Method to create a query to empty the rollup tables and reset
+        the watermark.
+
+    rollup_verify : Static Method
+        Method to create a query to count the records of a rollup table
+        that differ from a full recompute.
     """
     def __init__(self):
         # CREATE TABLES
@@ -142,6 +557,7 @@ class Queries():
             "    duration numeric(9, 5),\n"
             "    CHECK (\"year\" >= 0 AND \"year\" <= 2999),\n"
             "    CHECK (duration > 0),\n"
+            "    CONSTRAINT songs_artist_id_fkey\n"
             "    FOREIGN KEY (artist_id)\n"
             "    REFERENCES artists (artist_id) ON DELETE SET NULL"
             ");\n"
@@ -162,33 +578,249 @@ class Queries():
             "    user_agent text,\n"
             "    CHECK (session_id > 0),\n"
             "    CHECK (user_id > 0),\n"
+            "    CONSTRAINT songplay_start_time_fkey\n"
+            "    FOREIGN KEY (start_time)\n"
+            "    REFERENCES \"time\" (start_time),\n"
+            "    CONSTRAINT songplay_user_id_fkey\n"
+            "    FOREIGN KEY (user_id)\n"
+            "    REFERENCES users (user_id) ON DELETE SET NULL,\n"
+            "    CONSTRAINT songplay_song_id_fkey\n"
+            "    FOREIGN KEY (song_id)\n"
+            "    REFERENCES songs (song_id) ON DELETE SET NULL,\n"
+            "    CONSTRAINT songplay_artist_id_fkey\n"
+            "    FOREIGN KEY (artist_id)\n"
+            "    REFERENCES artists (artist_id) ON DELETE SET NULL\n"
+            ");\n"
+        )
+
+        # Fact Table 'songplay' partitioned by month, the primary key
+        # includes the partition key
+        songplay_partitioned_table_create = (
+            "CREATE TABLE IF NOT EXISTS songplay\n"
+            "(\n"
+            "    songplay_id serial,\n"
+            "    start_time timestamp NOT NULL,\n"
+            "    user_id int,\n"
+            "    level varchar(32),\n"
+            "    song_id char(18),\n"
+            "    artist_id char(18),\n"
+            "    session_id int,\n"
+            "    location varchar(512),\n"
+            "    user_agent text,\n"
+            "    PRIMARY KEY (songplay_id, start_time),\n"
+            "    CHECK (session_id > 0),\n"
+            "    CHECK (user_id > 0),\n"
+            "    CONSTRAINT songplay_start_time_fkey\n"
             "    FOREIGN KEY (start_time)\n"
             "    REFERENCES \"time\" (start_time),\n"
+            "    CONSTRAINT songplay_user_id_fkey\n"
             "    FOREIGN KEY (user_id)\n"
             "    REFERENCES users (user_id) ON DELETE SET NULL,\n"
+            "    CONSTRAINT songplay_song_id_fkey\n"
             "    FOREIGN KEY (song_id)\n"
             "    REFERENCES songs (song_id) ON DELETE SET NULL,\n"
+            "    CONSTRAINT songplay_artist_id_fkey\n"
             "    FOREIGN KEY (artist_id)\n"
             "    REFERENCES artists (artist_id) ON DELETE SET NULL\n"
+            ")\n"
+            "PARTITION BY RANGE (start_time);\n"
+        )
+
+        # Control Table 'ingest_manifest'
+        manifest_table_create = (
+            "CREATE TABLE IF NOT EXISTS ingest_manifest\n"
+            "(\n"
+            "    file_path text PRIMARY KEY,\n"
+            "    file_size bigint NOT NULL,\n"
+            "    file_mtime double precision NOT NULL,\n"
+            "    content_hash char(64) NOT NULL,\n"
+            "    row_counts jsonb,\n"
+            "    status varchar(16) NOT NULL,\n"
+            "    songplay_first bigint,\n"
+            "    songplay_last bigint,\n"
+            "    processed_at timestamp NOT NULL DEFAULT now(),\n"
+            "    CHECK (file_size >= 0),\n"
+            "    CHECK (status = 'loaded' OR status = 'failed')\n"
+            ");\n"
+        )
+
+        # Dead-letter Table 'load_rejects', records rejected by the
+        # tables constraints, isolated by 'quarantine'
+        load_rejects_table_create = (
+            "CREATE TABLE IF NOT EXISTS load_rejects\n"
+            "(\n"
+            "    reject_id bigserial PRIMARY KEY,\n"
+            "    table_name varchar(64) NOT NULL,\n"
+            "    record jsonb NOT NULL,\n"
+            "    error text NOT NULL,\n"
+            "    sqlstate char(5),\n"
+            "    source text,\n"
+            "    rejected_at timestamp NOT NULL DEFAULT now()\n"
+            ");\n"
+        )
+
+        # Staging Table 'staging_events', raw NextSong events of the log
+        # files, the records are processed into the tables with
+        # set-based statements.
+        staging_events_table_create = (
+            "CREATE UNLOGGED TABLE IF NOT EXISTS staging_events\n"
+            "(\n"
+            "    event_order bigserial,\n"
+            "    ts bigint NOT NULL,\n"
+            "    user_id varchar(32),\n"
+            "    first_name varchar(256),\n"
+            "    last_name varchar(256),\n"
+            "    gender varchar(8),\n"
+            "    level varchar(32),\n"
+            "    song text,\n"
+            "    artist text,\n"
+            "    length numeric,\n"
+            "    session_id int,\n"
+            "    location text,\n"
+            "    user_agent text\n"
+            ");\n"
+        )
+
+        # Rollup Tables of 'songplay', see 'ROLLUP_SPECS'
+        song_daily_table_create = (
+            "CREATE TABLE IF NOT EXISTS songplay_song_daily\n"
+            "(\n"
+            "    day date NOT NULL,\n"
+            "    song_id char(18) NOT NULL,\n"
+            "    artist_id char(18) NOT NULL,\n"
+            "    plays bigint NOT NULL,\n"
+            "    PRIMARY KEY (day, song_id, artist_id)\n"
+            ");\n"
+        )
+        user_hourly_table_create = (
+            "CREATE TABLE IF NOT EXISTS songplay_user_hourly\n"
+            "(\n"
+            "    hour timestamp NOT NULL,\n"
+            "    user_id int NOT NULL,\n"
+            "    level varchar(32) NOT NULL,\n"
+            "    plays bigint NOT NULL,\n"
+            "    PRIMARY KEY (hour, user_id, level)\n"
+            ");\n"
+        )
+        level_weekly_table_create = (
+            "CREATE TABLE IF NOT EXISTS songplay_level_weekly\n"
+            "(\n"
+            "    week date NOT NULL,\n"
+            "    level varchar(32) NOT NULL,\n"
+            "    plays bigint NOT NULL,\n"
+            "    PRIMARY KEY (week, level)\n"
             ");\n"
         )
 
+        # Control Table 'rollup_watermark', last 'songplay_id' counted
+        # in the rollups
+        rollup_watermark_table_create = (
+            "CREATE TABLE IF NOT EXISTS rollup_watermark\n"
+            "(\n"
+            "    source varchar(64) PRIMARY KEY,\n"
+            "    songplay_id bigint NOT NULL,\n"
+            "    refreshed_at timestamp NOT NULL DEFAULT now()\n"
+            ");\n"
+        )
+        rollup_watermark_init = (
+            "INSERT INTO rollup_watermark (source, songplay_id)\n"
+            "VALUES ('songplay', 0)\n"
+            "ON CONFLICT (source) DO NOTHING;\n"
+        )
+
+        # CREATE INDEXES
+        # Lookup of the songs by title, duration and artist name
+        song_lookup_index_create = (
+            "CREATE INDEX IF NOT EXISTS songs_title_duration_idx\n"
+            "ON songs (title, duration);\n"
+        )
+        artist_name_index_create = (
+            "CREATE INDEX IF NOT EXISTS artists_name_idx\n"
+            "ON artists (\"name\");\n"
+        )
+        song_artist_index_create = (
+            "CREATE INDEX IF NOT EXISTS songs_artist_id_idx\n"
+            "ON songs (artist_id);\n"
+        )
+
+        # Foreign keys of the fact table 'songplay'
+        songplay_start_time_index_create = (
+            "CREATE INDEX IF NOT EXISTS songplay_start_time_idx\n"
+            "ON songplay (start_time);\n"
+        )
+        songplay_user_index_create = (
+            "CREATE INDEX IF NOT EXISTS songplay_user_id_idx\n"
+            "ON songplay (user_id);\n"
+        )
+        songplay_song_index_create = (
+            "CREATE INDEX IF NOT EXISTS songplay_song_id_idx\n"
+            "ON songplay (song_id);\n"
+        )
+        songplay_artist_index_create = (
+            "CREATE INDEX IF NOT EXISTS songplay_artist_id_idx\n"
+            "ON songplay (artist_id);\n"
+        )
+
         # DROP TABLES
         songplay_table_drop = ("DROP TABLE IF EXISTS songplay;\n")
         time_table_drop = ("DROP TABLE IF EXISTS \"time\";\n")
         user_table_drop = ("DROP TABLE IF EXISTS users;\n")
         song_table_drop = ("DROP TABLE IF EXISTS songs;\n")
         artist_table_drop = ("DROP TABLE IF EXISTS artists;\n")
+        manifest_table_drop = ("DROP TABLE IF EXISTS ingest_manifest;\n")
+        load_rejects_table_drop = ("DROP TABLE IF EXISTS load_rejects;\n")
+        staging_events_table_drop = (
+            "DROP TABLE IF EXISTS staging_events;\n"
+        )
+        # The partitions of 'songplay' are dropped with the table
+        song_daily_table_drop = (
+            "DROP TABLE IF EXISTS songplay_song_daily;\n"
+        )
+        user_hourly_table_drop = (
+            "DROP TABLE IF EXISTS songplay_user_hourly;\n"
+        )
+        level_weekly_table_drop = (
+            "DROP TABLE IF EXISTS songplay_level_weekly;\n"
+        )
+        rollup_watermark_table_drop = (
+            "DROP TABLE IF EXISTS rollup_watermark;\n"
+        )
 
 
 
         # QUERY LISTS
+        self.create_rollup_queries = [
+            song_daily_table_create,
+            user_hourly_table_create,
+            level_weekly_table_create,
+            rollup_watermark_table_create,
+            rollup_watermark_init
+        ]
+
+        self.create_index_queries = [
+            song_lookup_index_create,
+            artist_name_index_create,
+            song_artist_index_create,
+            songplay_start_time_index_create,
+            songplay_user_index_create,
+            songplay_song_index_create,
+            songplay_artist_index_create
+        ]
+
         self.create_table_queries = [
             time_table_create,
             user_table_create,
             artist_table_create,
             song_table_create,
-            songplay_table_create
+            songplay_table_create,
+            manifest_table_create,
+            load_rejects_table_create
+        ] + self.create_rollup_queries + self.create_index_queries
+
+        self.create_partitioned_table_queries = [
+            songplay_partitioned_table_create
+            if query == songplay_table_create else query
+            for query in self.create_table_queries
         ]
 
         self.drop_table_queries = [
@@ -196,10 +828,22 @@ class Queries():
             time_table_drop,
             user_table_drop,
             song_table_drop,
-            artist_table_drop
+            artist_table_drop,
+            manifest_table_drop,
+            load_rejects_table_drop,
+            staging_events_table_drop,
+            song_daily_table_drop,
+            user_hourly_table_drop,
+            level_weekly_table_drop,
+            rollup_watermark_table_drop
         ]
 
+        self.manifest_table_create = manifest_table_create
+        self.load_rejects_table_create = load_rejects_table_create
+        self.staging_events_table_create = staging_events_table_create
+
     @staticmethod
+    @metrics.builder
     def artist_table_insert(dataframe, verbose=False):
         """Query to insert data from dataframe 'songs'.
 
@@ -248,7 +892,18 @@ class Queries():
             "\"name\" = EXCLUDED.\"name\",\n"
             "location = EXCLUDED.location,\n"
             "latitude = EXCLUDED.latitude,\n"
-            "longitude = EXCLUDED.longitude;\n"
+            "longitude = EXCLUDED.longitude\n"
+            "WHERE (\n"
+            "    artists.\"name\",\n"
+            "    artists.location,\n"
+            "    artists.latitude,\n"
+            "    artists.longitude\n"
+            ") IS DISTINCT FROM (\n"
+            "    EXCLUDED.\"name\",\n"
+            "    EXCLUDED.location,\n"
+            "    EXCLUDED.latitude,\n"
+            "    EXCLUDED.longitude\n"
+            ");\n"
         )
 
         if verbose:
@@ -257,6 +912,7 @@ class Queries():
         return query
 
     @staticmethod
+    @metrics.builder
     def song_table_insert(dataframe, verbose=False):
         """Query to insert data from dataframe 'songs'.
 
@@ -305,7 +961,18 @@ class Queries():
             "title = EXCLUDED.title,\n"
             "artist_id = EXCLUDED.artist_id,\n"
             "\"year\" = EXCLUDED.\"year\",\n"
-            "duration = EXCLUDED.duration;\n"
+            "duration = EXCLUDED.duration\n"
+            "WHERE (\n"
+            "    songs.title,\n"
+            "    songs.artist_id,\n"
+            "    songs.\"year\",\n"
+            "    songs.duration\n"
+            ") IS DISTINCT FROM (\n"
+            "    EXCLUDED.title,\n"
+            "    EXCLUDED.artist_id,\n"
+            "    EXCLUDED.\"year\",\n"
+            "    EXCLUDED.duration\n"
+            ");\n"
         )
 
         if verbose:
@@ -314,6 +981,7 @@ class Queries():
         return query
 
     @staticmethod
+    @metrics.builder
     def time_table_insert(dataframe, verbose=False):
         """Query to insert data from dataframe 'logs'.
 
@@ -364,7 +1032,22 @@ class Queries():
             "week = EXCLUDED.week,\n"
             "month = EXCLUDED.month,\n"
             "year = EXCLUDED.year,\n"
-            "weekday = EXCLUDED.weekday;\n"
+            "weekday = EXCLUDED.weekday\n"
+            "WHERE (\n"
+            "    \"time\".hour,\n"
+            "    \"time\".day,\n"
+            "    \"time\".week,\n"
+            "    \"time\".month,\n"
+            "    \"time\".\"year\",\n"
+            "    \"time\".weekday\n"
+            ") IS DISTINCT FROM (\n"
+            "    EXCLUDED.hour,\n"
+            "    EXCLUDED.day,\n"
+            "    EXCLUDED.week,\n"
+            "    EXCLUDED.month,\n"
+            "    EXCLUDED.\"year\",\n"
+            "    EXCLUDED.weekday\n"
+            ");\n"
         )
 
         if verbose:
@@ -373,6 +1056,7 @@ class Queries():
         return query
 
     @staticmethod
+    @metrics.builder
     def user_table_insert(dataframe, verbose=False):
         """Query to insert data from dataframe 'logs'.
 
@@ -421,7 +1105,18 @@ class Queries():
             "first_name = EXCLUDED.first_name,\n"
             "last_name = EXCLUDED.last_name,\n"
             "gender = EXCLUDED.gender,\n"
-            "level = EXCLUDED.level;\n"
+            "level = EXCLUDED.level\n"
+            "WHERE (\n"
+            "    users.first_name,\n"
+            "    users.last_name,\n"
+            "    users.gender,\n"
+            "    users.level\n"
+            ") IS DISTINCT FROM (\n"
+            "    EXCLUDED.first_name,\n"
+            "    EXCLUDED.last_name,\n"
+            "    EXCLUDED.gender,\n"
+            "    EXCLUDED.level\n"
+            ");\n"
         )
 
         if verbose:
@@ -430,6 +1125,7 @@ class Queries():
         return query
 
     @staticmethod
+    @metrics.builder
     def songplay_table_insert(dataframe, verbose=False):
         """Query to insert data from dataframe 'logs'.
 
@@ -493,6 +1189,7 @@ class Queries():
         return query
 
     @staticmethod
+    @metrics.builder
     def song_select(dataframe, verbose=False):
         """Query to find artist IDs and song IDs by names and song duration.
 
@@ -550,7 +1247,8 @@ class Queries():
             ") song_artist\n"
             "ON input_data.song = song_artist.title\n"
             "AND input_data.artist = song_artist.\"name\"\n"
-            "AND input_data.duration = song_artist.duration\n"
+            "AND ROUND(CAST(input_data.duration AS numeric), "
+            f"{DURATION_SCALE}) = song_artist.duration\n"
             "ORDER BY input_data.idx ASC;\n"
         )
 
@@ -558,3 +1256,1347 @@ class Queries():
             print(f"SQL statement:\n{query}\n")
 
         return query
+
+    @staticmethod
+    def staging_table_create(table, verbose=False):
+        """Query to create the staging table of a given table.
+
+        The staging table is a temporary table (only visible in the
+        current session) with the same column types as the target
+        table, but without constraints, so the COPY loader can stream
+        records before merging them. The table is emptied each time
+        the statement is executed.
+
+        Parameters
+        ----------
+        table : String
+            description -> The name of the target table
+            format -> No apply
+            options -> {
+                'time',
+                'users',
+                'artists',
+                'songs',
+                'songplay'
+            }
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        spec = TABLE_SPECS[table]
+        columns = ", ".join(spec["columns"])
+        query = (
+            f"CREATE TEMP TABLE IF NOT EXISTS staging_{table} AS\n"
+            f"SELECT {columns}\n"
+            f"FROM {spec['name']}\n"
+            "WITH NO DATA;\n"
+            f"TRUNCATE staging_{table};\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def copy_from_stdin(table, staging=False, verbose=False):
+        """Query to stream CSV records into a given table.
+
+        The records are sent in CSV format and the null values are
+        represented with the '\\N' marker.
+
+        Parameters
+        ----------
+        table : String
+            description -> The name of the target table
+            format -> No apply
+            options -> {
+                'time',
+                'users',
+                'artists',
+                'songs',
+                'songplay'
+            }
+
+        staging : bool
+            description -> Stream the records into the staging table of
+                the given table instead the table itself
+            format -> No apply
+            options -> No apply
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        spec = TABLE_SPECS[table]
+        target = f"staging_{table}" if staging else spec["name"]
+        columns = ", ".join(spec["columns"])
+        query = (
+            f"COPY {target} ({columns})\n"
+            "FROM STDIN WITH (FORMAT csv, NULL '\\N');\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def staging_table_merge(table, verbose=False):
+        """Query to move the staging records into a given table.
+
+        The statement keeps the same 'ON CONFLICT ... DO UPDATE' rules
+        used by the INSERT builders.
+
+        Parameters
+        ----------
+        table : String
+            description -> The name of the target table
+            format -> No apply
+            options -> {
+                'time',
+                'users',
+                'artists',
+                'songs',
+                'songplay'
+            }
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        spec = TABLE_SPECS[table]
+        columns = ", ".join(spec["columns"])
+        query = (
+            f"INSERT INTO {spec['name']}\n"
+            f"({columns})\n"
+            f"SELECT {columns}\n"
+            f"FROM staging_{table}\n"
+            f"{upsert_clause(table)}"
+            ";\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def table_insert_template(table, verbose=False):
+        """Parameterized query to insert records into a given table.
+
+        The statement has a single '%s' placeholder after 'VALUES' to be
+        used with 'psycopg2.extras.execute_values', each record is sent
+        as bound parameters, so no escaping is required. The upsert
+        behavior is the same used by the INSERT builders.
+
+        Parameters
+        ----------
+        table : String
+            description -> The name of the target table
+            format -> No apply
+            options -> {
+                'time',
+                'users',
+                'artists',
+                'songs',
+                'songplay'
+            }
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        spec = TABLE_SPECS[table]
+        query = (
+            f"INSERT INTO {spec['name']}\n"
+            f"({', '.join(spec['columns'])})\n"
+            "VALUES %s\n"
+            f"{upsert_clause(table)}"
+            ";\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def song_select_template(verbose=False):
+        """Parameterized query to find artist IDs and song IDs.
+
+        Same search of 'song_select', but the statement has a single
+        '%s' placeholder to be used with 'psycopg2.extras.execute_values'
+        and the template returned, each record is sent as bound
+        parameters (index, song title, artist name, song length).
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement to load IDs, the
+                result columns are (idx, song, artist)
+            format -> No apply
+            options -> No apply
+
+        template : string
+            description -> The template of each record in the VALUES
+                list, it sets the type of each input attribute
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "SELECT\n"
+            "    input_data.idx,\n"
+            "    song_artist.song_id song,\n"
+            "    song_artist.artist_id artist\n"
+            "FROM (\n"
+            "    VALUES %s\n"
+            ") AS input_data (idx, song, artist, duration)\n"
+            "LEFT JOIN (\n"
+            "    SELECT\n"
+            "        songs.song_id,\n"
+            "        songs.title,\n"
+            "        songs.duration,\n"
+            "        artists.artist_id,\n"
+            "        artists.\"name\"\n"
+            "    FROM songs\n"
+            "    LEFT JOIN artists\n"
+            "    ON songs.artist_id = artists.artist_id\n"
+            ") song_artist\n"
+            "ON input_data.song = song_artist.title\n"
+            "AND input_data.artist = song_artist.\"name\"\n"
+            "AND ROUND(input_data.duration, "
+            f"{DURATION_SCALE}) = song_artist.duration\n"
+            "ORDER BY input_data.idx ASC, song_artist.song_id ASC;\n"
+        )
+        template = "(%s::int, %s::varchar, %s::varchar, %s::numeric)"
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query, template
+
+    @staticmethod
+    def song_lookup_size(verbose=False):
+        """Query to count the songs and the size of the search attributes.
+
+        The result is used to estimate the memory required to keep all
+        the songs in memory (see 'lookup.SongLookupIndex').
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement, the result
+                columns are (songs, text_bytes)
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "SELECT\n"
+            "    count(*) songs,\n"
+            "    coalesce(\n"
+            "        sum(\n"
+            "            octet_length(songs.title)\n"
+            "            + octet_length(artists.\"name\")\n"
+            "        ),\n"
+            "        0\n"
+            "    ) text_bytes\n"
+            "FROM songs\n"
+            "LEFT JOIN artists\n"
+            "ON songs.artist_id = artists.artist_id;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def song_lookup_select(verbose=False):
+        """Query to retrieve all the songs with the search attributes.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement, the result
+                columns are (song_id, title, duration, artist_id, name)
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "SELECT\n"
+            "    songs.song_id,\n"
+            "    songs.title,\n"
+            "    songs.duration,\n"
+            "    songs.artist_id,\n"
+            "    artists.\"name\"\n"
+            "FROM songs\n"
+            "LEFT JOIN artists\n"
+            "ON songs.artist_id = artists.artist_id;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def manifest_select(verbose=False):
+        """Query to retrieve the files recorded in the manifest.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement, the result
+                columns are (file_path, file_size, file_mtime,
+                content_hash, status, songplay_first, songplay_last)
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "SELECT file_path, file_size, file_mtime, content_hash, status,\n"
+            "songplay_first, songplay_last\n"
+            "FROM ingest_manifest;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def manifest_upsert(verbose=False):
+        """Parameterized query to record a file in the manifest.
+
+        The parameters are (file_path, file_size, file_mtime,
+        content_hash, row_counts, status, songplay_first,
+        songplay_last), 'row_counts' is a JSON string.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "INSERT INTO ingest_manifest\n"
+            "(file_path, file_size, file_mtime, content_hash, row_counts, "
+            "status, songplay_first, songplay_last)\n"
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)\n"
+            "ON CONFLICT (file_path)\n"
+            "DO UPDATE SET\n"
+            "file_size = EXCLUDED.file_size,\n"
+            "file_mtime = EXCLUDED.file_mtime,\n"
+            "content_hash = EXCLUDED.content_hash,\n"
+            "row_counts = EXCLUDED.row_counts,\n"
+            "status = EXCLUDED.status,\n"
+            "songplay_first = EXCLUDED.songplay_first,\n"
+            "songplay_last = EXCLUDED.songplay_last,\n"
+            "processed_at = now();\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def manifest_touch(verbose=False):
+        """Parameterized query to update the modification time of a file.
+
+        Used when the modification time of a file changed but the
+        content is the same, the parameters are (file_mtime,
+        file_path).
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "UPDATE ingest_manifest\n"
+            "SET file_mtime = %s\n"
+            "WHERE file_path = %s;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def manifest_songplays_add(verbose=False):
+        """Query to add the songplays range columns to the manifest.
+
+        The manifests created before the columns existed are updated,
+        their files have no range.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "ALTER TABLE ingest_manifest\n"
+            "ADD COLUMN IF NOT EXISTS songplay_first bigint,\n"
+            "ADD COLUMN IF NOT EXISTS songplay_last bigint;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def songplay_last_id(verbose=False):
+        """Query to retrieve the last 'songplay_id', '0' if there is none.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = "SELECT COALESCE(max(songplay_id), 0) FROM songplay;\n"
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def songplay_range_delete(verbose=False):
+        """Parameterized query to delete the songplays of an ID range.
+
+        The parameters are (songplay_first, songplay_last), both
+        included.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "DELETE FROM songplay\n"
+            "WHERE songplay_id BETWEEN %s AND %s;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def load_reject_insert(verbose=False):
+        """Query to record a rejected record in 'load_rejects'.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The parameterized SQL statement
+            format -> Parameters: (table_name, record, error, sqlstate,
+                source)
+            options -> No apply
+        """
+        query = (
+            "INSERT INTO load_rejects\n"
+            "(table_name, record, error, sqlstate, source)\n"
+            "VALUES (%s, %s, %s, %s, %s);\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def foreign_key_drop(name, verbose=False):
+        """Query to drop a foreign key if it exists.
+
+        Parameters
+        ----------
+        name : String
+            description -> The name of the foreign key
+            format -> No apply
+            options -> The keys of 'FOREIGN_KEYS'
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        spec = FOREIGN_KEYS[name]
+        query = (
+            f"ALTER TABLE {spec['table']}\n"
+            f"DROP CONSTRAINT IF EXISTS {name};\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def foreign_key_add(name, valid=True, verbose=False):
+        """Query to add a foreign key.
+
+        Parameters
+        ----------
+        name : String
+            description -> The name of the foreign key
+            format -> No apply
+            options -> The keys of 'FOREIGN_KEYS'
+
+        valid : bool
+            description -> Check the current records of the table
+            format -> No apply
+            options -> 'False': Add the key as 'NOT VALID', only the
+                new records are checked until it is validated.
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        spec = FOREIGN_KEYS[name]
+        on_delete = ""
+        if spec["on_delete"] is not None:
+            on_delete = f" ON DELETE {spec['on_delete']}"
+        not_valid = "" if valid else " NOT VALID"
+        query = (
+            f"ALTER TABLE {spec['table']}\n"
+            f"ADD CONSTRAINT {name}\n"
+            f"FOREIGN KEY ({spec['column']})\n"
+            f"REFERENCES {spec['references']} "
+            f"({spec['reference_column']}){on_delete}{not_valid};\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def foreign_key_violations(name, verbose=False):
+        """Query to count the records that violate a foreign key.
+
+        Parameters
+        ----------
+        name : String
+            description -> The name of the foreign key
+            format -> No apply
+            options -> The keys of 'FOREIGN_KEYS'
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        spec = FOREIGN_KEYS[name]
+        query = (
+            "SELECT count(*)\n"
+            f"FROM {spec['table']} child\n"
+            f"WHERE child.{spec['column']} IS NOT NULL\n"
+            "AND NOT EXISTS (\n"
+            "    SELECT 1\n"
+            f"    FROM {spec['references']} parent\n"
+            f"    WHERE parent.{spec['reference_column']} = "
+            f"child.{spec['column']}\n"
+            ");\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def foreign_key_validate(name, verbose=False):
+        """Query to validate a foreign key added as 'NOT VALID'.
+
+        Parameters
+        ----------
+        name : String
+            description -> The name of the foreign key
+            format -> No apply
+            options -> The keys of 'FOREIGN_KEYS'
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        spec = FOREIGN_KEYS[name]
+        query = (
+            f"ALTER TABLE {spec['table']}\n"
+            f"VALIDATE CONSTRAINT {name};\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def staging_events_truncate(verbose=False):
+        """Query to empty the table 'staging_events'.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = "TRUNCATE staging_events RESTART IDENTITY;\n"
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def time_table_insert_from_staging(verbose=False):
+        """Query to insert the time records of the staged events.
+
+        One record per second, the week is the ISO week and the weekday
+        starts at '1' on Monday, the same records generated by
+        'etl.time_records'.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "INSERT INTO \"time\"\n"
+            "(start_time, hour, day, week, month, \"year\", weekday)\n"
+            "SELECT DISTINCT\n"
+            "    start_time,\n"
+            "    EXTRACT(hour FROM start_time),\n"
+            "    EXTRACT(day FROM start_time),\n"
+            "    EXTRACT(week FROM start_time),\n"
+            "    EXTRACT(month FROM start_time),\n"
+            "    EXTRACT(year FROM start_time),\n"
+            "    EXTRACT(isodow FROM start_time)\n"
+            "FROM (\n"
+            "    SELECT\n"
+            "        TIMESTAMP 'epoch' + (ts / 1000) * INTERVAL '1 second'\n"
+            "            AS start_time\n"
+            "    FROM staging_events\n"
+            ") events\n"
+            "ON CONFLICT (start_time)\n"
+            "DO UPDATE SET\n"
+            "hour = EXCLUDED.hour,\n"
+            "day = EXCLUDED.day,\n"
+            "week = EXCLUDED.week,\n"
+            "month = EXCLUDED.month,\n"
+            "\"year\" = EXCLUDED.\"year\",\n"
+            "weekday = EXCLUDED.weekday\n"
+            "WHERE (\n"
+            "    \"time\".hour,\n"
+            "    \"time\".day,\n"
+            "    \"time\".week,\n"
+            "    \"time\".month,\n"
+            "    \"time\".\"year\",\n"
+            "    \"time\".weekday\n"
+            ") IS DISTINCT FROM (\n"
+            "    EXCLUDED.hour,\n"
+            "    EXCLUDED.day,\n"
+            "    EXCLUDED.week,\n"
+            "    EXCLUDED.month,\n"
+            "    EXCLUDED.\"year\",\n"
+            "    EXCLUDED.weekday\n"
+            ");\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def user_table_insert_from_staging(verbose=False):
+        """Query to insert the user records of the staged events.
+
+        The last event of each user (in the files order) is used.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "INSERT INTO users\n"
+            "(user_id, first_name, last_name, gender, level)\n"
+            "SELECT DISTINCT ON (user_id)\n"
+            "    user_id,\n"
+            "    first_name,\n"
+            "    last_name,\n"
+            "    gender,\n"
+            "    level\n"
+            "FROM (\n"
+            "    SELECT\n"
+            "        event_order,\n"
+            "        CAST(NULLIF(user_id, '') AS int) user_id,\n"
+            "        first_name,\n"
+            "        last_name,\n"
+            "        upper(gender) gender,\n"
+            "        level\n"
+            "    FROM staging_events\n"
+            ") events\n"
+            "WHERE user_id IS NOT NULL\n"
+            "ORDER BY user_id, event_order DESC\n"
+            "ON CONFLICT (user_id)\n"
+            "DO UPDATE SET\n"
+            "first_name = EXCLUDED.first_name,\n"
+            "last_name = EXCLUDED.last_name,\n"
+            "gender = EXCLUDED.gender,\n"
+            "level = EXCLUDED.level\n"
+            "WHERE (\n"
+            "    users.first_name,\n"
+            "    users.last_name,\n"
+            "    users.gender,\n"
+            "    users.level\n"
+            ") IS DISTINCT FROM (\n"
+            "    EXCLUDED.first_name,\n"
+            "    EXCLUDED.last_name,\n"
+            "    EXCLUDED.gender,\n"
+            "    EXCLUDED.level\n"
+            ");\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def songplay_table_insert_from_staging(verbose=False):
+        """Query to insert the songplays records of the staged events.
+
+        The duplicated events are inserted once, and the song IDs and
+        artist IDs are found by song title, artist name and song
+        length, the same search of 'song_select'. If many songs match
+        an event, the lowest song ID is kept, so each event is inserted
+        once.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "INSERT INTO songplay (\n"
+            "    start_time,\n"
+            "    user_id,\n"
+            "    level,\n"
+            "    song_id,\n"
+            "    artist_id,\n"
+            "    session_id,\n"
+            "    location,\n"
+            "    user_agent\n"
+            ")\n"
+            "SELECT\n"
+            "    events.start_time,\n"
+            "    events.user_id,\n"
+            "    events.level,\n"
+            "    song_artist.song_id,\n"
+            "    song_artist.artist_id,\n"
+            "    events.session_id,\n"
+            "    events.location,\n"
+            "    events.user_agent\n"
+            "FROM (\n"
+            "    SELECT DISTINCT\n"
+            "        TIMESTAMP 'epoch' + (ts / 1000) * INTERVAL '1 second'\n"
+            "            AS start_time,\n"
+            "        CAST(NULLIF(user_id, '') AS int) user_id,\n"
+            "        level,\n"
+            "        song,\n"
+            "        artist,\n"
+            "        length,\n"
+            "        session_id,\n"
+            "        location,\n"
+            "        user_agent\n"
+            "    FROM staging_events\n"
+            ") events\n"
+            "LEFT JOIN LATERAL (\n"
+            "    SELECT\n"
+            "        songs.song_id,\n"
+            "        artists.artist_id\n"
+            "    FROM songs\n"
+            "    JOIN artists\n"
+            "    ON songs.artist_id = artists.artist_id\n"
+            "    WHERE songs.title = events.song\n"
+            "    AND artists.\"name\" = events.artist\n"
+            "    AND songs.duration =\n"
+            f"        ROUND(events.length, {DURATION_SCALE})\n"
+            "    ORDER BY songs.song_id\n"
+            "    LIMIT 1\n"
+            ") song_artist\n"
+            "ON TRUE;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def songplay_partitions_select(verbose=False):
+        """Query to retrieve the partitions of the table 'songplay'.
+
+        The query returns no records if the table is not partitioned,
+        the partitioned tables are registered in the catalog
+        'pg_partitioned_table'.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> Columns: (<is partitioned>, <partition name>), the
+                partition name is 'NULL' if there are no partitions
+            options -> No apply
+        """
+        query = (
+            "SELECT\n"
+            "    true,\n"
+            "    partitions.relname\n"
+            "FROM pg_partitioned_table partitioned\n"
+            "LEFT JOIN pg_inherits inherits\n"
+            "ON inherits.inhparent = partitioned.partrelid\n"
+            "LEFT JOIN pg_class partitions\n"
+            "ON partitions.oid = inherits.inhrelid\n"
+            "WHERE partitioned.partrelid = to_regclass('songplay');\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def songplay_partition_create(month, verbose=False):
+        """Query to create the partition of a month of 'songplay'.
+
+        Parameters
+        ----------
+        month : String
+            description -> The month of the partition
+            format -> 'YYYY-MM'
+            options -> No apply
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement, the partition is
+                named 'songplay_<YYYY>_<MM>'
+            format -> No apply
+            options -> No apply
+        """
+        year, month = (int(value) for value in month.split("-"))
+        next_year, next_month = (
+            (year + 1, 1) if month == 12 else (year, month + 1)
+        )
+        query = (
+            "CREATE TABLE IF NOT EXISTS "
+            f"songplay_{year:04d}_{month:02d}\n"
+            "PARTITION OF songplay\n"
+            f"FOR VALUES FROM ('{year:04d}-{month:02d}-01')\n"
+            f"TO ('{next_year:04d}-{next_month:02d}-01');\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def staging_events_months(verbose=False):
+        """Query to retrieve the months of the events in 'staging_events'.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> Columns: (<month>), format 'YYYY-MM'
+            options -> No apply
+        """
+        query = (
+            "SELECT DISTINCT to_char(\n"
+            "    TIMESTAMP 'epoch' + (ts / 1000) * INTERVAL '1 second',\n"
+            "    'YYYY-MM'\n"
+            ")\n"
+            "FROM staging_events;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def rollup_watermark_select(verbose=False):
+        """Query to lock and retrieve the watermark of the rollups.
+
+        The record is locked until the end of the transaction, so two
+        refreshes can not count the same songplays.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> Columns: (<last songplay_id counted>)
+            options -> No apply
+        """
+        query = (
+            "SELECT songplay_id\n"
+            "FROM rollup_watermark\n"
+            "WHERE source = 'songplay'\n"
+            "FOR UPDATE;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def rollup_range_select(verbose=False):
+        """Query to retrieve the songplays after the watermark.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The parameterized SQL statement, the
+                watermark is given as '%(low)s'
+            format -> Columns: (<last songplay_id>, <songplays>), the
+                last 'songplay_id' is 'NULL' if there are no songplays
+            options -> No apply
+        """
+        query = (
+            "SELECT max(songplay_id), count(*)\n"
+            "FROM songplay\n"
+            "WHERE songplay_id > %(low)s;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def rollup_refresh(name, verbose=False):
+        """Query to add the plays of a range of songplays to a rollup.
+
+        The songplays are grouped by the keys of 'ROLLUP_SPECS' and the
+        plays are added to the existing records, so each songplay is
+        counted once if the ranges do not overlap.
+
+        Parameters
+        ----------
+        name : String
+            description -> The name of the rollup table
+            format -> No apply
+            options -> The keys of 'ROLLUP_SPECS'
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The parameterized SQL statement, the range
+                is given as '%(low)s' (excluded) and '%(high)s'
+                (included)
+            format -> No apply
+            options -> No apply
+        """
+        spec = ROLLUP_SPECS[name]
+        columns = ", ".join(column for column, _ in spec["keys"])
+        expressions = ",\n".join(
+            f"    {expression}" for _, expression in spec["keys"]
+        )
+        groups = ", ".join(str(i) for i in range(1, len(spec["keys"]) + 1))
+        condition = ""
+        if spec["filter"] is not None:
+            condition = f"AND {spec['filter']}\n"
+        query = (
+            f"INSERT INTO {name} ({columns}, plays)\n"
+            "SELECT\n"
+            f"{expressions},\n"
+            "    count(*)\n"
+            "FROM songplay\n"
+            "WHERE songplay_id > %(low)s\n"
+            "AND songplay_id <= %(high)s\n"
+            f"{condition}"
+            f"GROUP BY {groups}\n"
+            f"ON CONFLICT ({columns})\n"
+            f"DO UPDATE SET plays = {name}.plays + EXCLUDED.plays;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def rollup_watermark_update(verbose=False):
+        """Query to move the watermark of the rollups.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The parameterized SQL statement, the last
+                'songplay_id' counted is given as '%(high)s'
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            "UPDATE rollup_watermark\n"
+            "SET songplay_id = %(high)s, refreshed_at = now()\n"
+            "WHERE source = 'songplay';\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def rollup_truncate(verbose=False):
+        """Query to empty the rollup tables and reset the watermark.
+
+        Parameters
+        ----------
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> No apply
+            options -> No apply
+        """
+        query = (
+            f"TRUNCATE {', '.join(ROLLUP_SPECS)};\n"
+            "UPDATE rollup_watermark\n"
+            "SET songplay_id = 0, refreshed_at = now()\n"
+            "WHERE source = 'songplay';\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
+
+    @staticmethod
+    def rollup_verify(name, verbose=False):
+        """Query to compare a rollup with a full recompute.
+
+        The songplays up to the watermark are grouped again and joined
+        with the rollup table, the records missing on any side or with
+        different plays are counted.
+
+        Parameters
+        ----------
+        name : String
+            description -> The name of the rollup table
+            format -> No apply
+            options -> The keys of 'ROLLUP_SPECS'
+
+        verbose : bool
+            description -> Print process workflow or results, useful for
+                debugging
+            format -> No apply
+            options -> No apply
+
+        Returns
+        -------
+        query : string
+            description -> The complete SQL statement
+            format -> Columns: (<records that differ>)
+            options -> No apply
+        """
+        spec = ROLLUP_SPECS[name]
+        columns = ", ".join(column for column, _ in spec["keys"])
+        expressions = ",\n".join(
+            f"        {expression} AS {column}"
+            for column, expression in spec["keys"]
+        )
+        groups = ", ".join(str(i) for i in range(1, len(spec["keys"]) + 1))
+        condition = ""
+        if spec["filter"] is not None:
+            condition = f"    AND {spec['filter']}\n"
+        query = (
+            "WITH expected AS (\n"
+            "    SELECT\n"
+            f"{expressions},\n"
+            "        count(*) AS plays\n"
+            "    FROM songplay\n"
+            "    WHERE songplay_id <= (\n"
+            "        SELECT songplay_id\n"
+            "        FROM rollup_watermark\n"
+            "        WHERE source = 'songplay'\n"
+            "    )\n"
+            f"{condition}"
+            f"    GROUP BY {groups}\n"
+            ")\n"
+            "SELECT count(*)\n"
+            "FROM expected\n"
+            f"FULL JOIN {name} stored USING ({columns})\n"
+            "WHERE expected.plays IS DISTINCT FROM stored.plays;\n"
+        )
+
+        if verbose:
+            print(f"SQL statement:\n{query}\n")
+
+        return query
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""Transactions and commit policies of the loaded files.
+
+Each commit waits for the WAL flush, with many small files the commits
+dominate the load time. The commit policy sets when the loaded files
+are committed:
+
+    * batch: Commit each batch of records and each file (default), in
+      an incremental run (with a manifest) only each file, so a file
+      is never committed without its manifest record.
+    * files:N: Commit every N files.
+    * bytes:B: Commit when the committed files reach about B bytes.
+    * run: Commit once at the end of the run.
+
+With the policies that keep many files in a transaction, each file is
+loaded inside a savepoint, a file that fails rolls back only its own
+records, it is reported and recorded as 'failed' in the manifest, and
+the next files are loaded. The manifest records are written in the
+transaction that commits the files, so they match the committed
+records with every policy.
+
+Mantaniner: Rolando Gonzalez
+Version: 1.0.0
+"""
+# Standard library imports
+import contextlib
+import os
+import traceback
+
+# Third-party imports
+# None
+
+# Propietary imports
+import metrics
+import quarantine
+import rollups as songplay_rollups
+
+COMMIT_POLICIES = ("batch", "files", "bytes", "run")
+
+# Savepoint of the file being loaded
+FILE_SAVEPOINT = "load_file"
+
+class CommitPolicy():
+    """When the loaded files are committed.
+
+    Attributes
+    ----------
+    mode : String
+        description -> The policy
+        format -> No apply
+        options -> {'batch', 'files', 'bytes', 'run'}
+
+    limit : Integer
+        description -> Files ('files') or bytes ('bytes') of each
+            transaction
+        format -> No apply
+        options -> No apply
+
+    Methods
+    -------
+    parse : Class Method
+        Create the policy from its text specification.
+
+    add : Method
+        Account a loaded file.
+
+    is_due : Method
+        Check if the loaded files must be committed.
+
+    reset : Method
+        Start a new transaction.
+    """
+    def __init__(self, mode="batch", limit=0):
+        if mode not in COMMIT_POLICIES:
+            raise ValueError(f"unknown commit policy '{mode}'")
+        if mode in ("files", "bytes") and limit < 1:
+            raise ValueError(f"the policy '{mode}' requires a limit > 0")
+        self.mode = mode
+        self.limit = limit
+        self.files = 0
+        self.bytes = 0
+
+    @classmethod
+    def parse(cls, spec):
+        """Create the policy from its text specification.
+
+        Parameters
+        ----------
+        spec : String
+            description -> The policy and its limit
+            format -> '<policy>[:<limit>]'
+            options -> {'batch', 'files:<N>', 'bytes:<B>', 'run'}
+
+        Returns
+        -------
+        policy : CommitPolicy Instance
+            description -> The commit policy
+            format -> No apply
+            options -> No apply
+        """
+        mode, _, limit = spec.partition(":")
+        try:
+            return cls(mode, int(limit) if limit else 0)
+        except ValueError as error:
+            raise ValueError(
+                f"invalid commit policy '{spec}': {error}"
+            ) from error
+
+    @property
+    def batch_commits(self):
+        """'True' if each batch of records is committed."""
+        return self.mode == "batch"
+
+    @property
+    def savepoints(self):
+        """'True' if the files are isolated with savepoints."""
+        return self.mode != "batch"
+
+    def add(self, datafile):
+        """Account a loaded file in the current transaction.
+
+        Parameters
+        ----------
+        datafile : String
+            description -> The file location as a full path
+            format -> No apply
+            options -> No apply
+        """
+        self.files += 1
+        if self.mode == "bytes":
+            self.bytes += os.path.getsize(datafile)
+
+    def is_due(self):
+        """Check if the loaded files must be committed.
+
+        Returns
+        -------
+        due : bool
+            description -> 'True' if the transaction reached the limit
+                of the policy
+            format -> No apply
+            options -> No apply
+        """
+        if self.mode == "batch":
+            return self.files > 0
+        if self.mode == "files":
+            return self.files >= self.limit
+        if self.mode == "bytes":
+            return self.bytes >= self.limit
+
+        return False
+
+    def reset(self):
+        """Start a new transaction."""
+        self.files = 0
+        self.bytes = 0
+
+class FileTransactions():
+    """Savepoints and commits of the loaded files.
+
+    Attributes
+    ----------
+    conn : PostgreSQL Connection Instance
+        description -> The connection that loads the files
+        format -> No apply
+        options -> No apply
+
+    policy : CommitPolicy Instance
+        description -> When the files are committed
+        format -> No apply
+        options -> No apply
+
+    manifest : manifest.IngestManifest Instance
+        description -> The manifest of the ingested files
+        format -> No apply
+        options -> 'None': Only commit.
+
+    rollups : bool
+        description -> Refresh the rollups of 'songplay' in each commit
+            ('rollups.refresh')
+        format -> No apply
+        options -> No apply
+
+    on_rollback : Function
+        description -> Called with a cursor after a file is rolled
+            back, it discards the in-memory state of its records
+        format -> No apply
+        options -> 'None': Nothing to discard.
+
+    failed : String List
+        description -> The files rolled back
+        format -> No apply
+        options -> No apply
+
+    Methods
+    -------
+    isolate : Method
+        Context manager that loads files inside a savepoint.
+
+    begin : Method
+        Start the savepoint of a file.
+
+    rollback : Method
+        Roll back a failed file to its savepoint.
+
+    release : Method
+        Release the savepoint of the loaded files and commit them if
+        the policy requires it.
+
+    commit : Method
+        Record the loaded files in the manifest and commit.
+
+    close : Method
+        Commit the files loaded since the last commit.
+    """
+    def __init__(
+        self,
+        conn,
+        policy=None,
+        manifest=None,
+        rollups=False,
+        on_rollback=None
+    ):
+        self.conn = conn
+        self.policy = policy or CommitPolicy()
+        self.manifest = manifest
+        self.rollups = rollups
+        self.on_rollback = on_rollback
+        self.failed = []
+        self._pending = []
+
+    @contextlib.contextmanager
+    def isolate(self, datafiles):
+        """Load files inside a savepoint.
+
+        The block fills the given dictionary with the number of records
+        by table of each file. If the block fails the files are rolled
+        back, with the policy 'batch' the error is raised.
+
+        Parameters
+        ----------
+        datafiles : String List
+            description -> The files loaded by the block
+            format -> No apply
+            options -> No apply
+
+        Yields
+        ------
+        row_counts : Dictionary
+            description -> Filled by the block
+            format -> {<file_path>: {<table>: <records>}}
+            options -> No apply
+        """
+        row_counts = {}
+        self.begin(datafiles)
+        try:
+            yield row_counts
+        except Exception as error:
+            self.rollback(datafiles, error)
+        else:
+            self.release(
+                [(datafile, row_counts.get(datafile, {}))
+                 for datafile in datafiles]
+            )
+
+    def begin(self, datafiles):
+        """Start the savepoint of a file.
+
+        The files are also the source of the records rejected by the
+        quarantine ('quarantine.set_source'), with a manifest the range
+        of their songplays is started ('manifest.IngestManifest.begin').
+
+        Parameters
+        ----------
+        datafiles : String List
+            description -> The files loaded inside the savepoint
+            format -> No apply
+            options -> No apply
+        """
+        quarantine.set_source(datafiles)
+        if self.policy.savepoints or self.manifest is not None:
+            cur = self.conn.cursor()
+            if self.policy.savepoints:
+                cur.execute(f"SAVEPOINT {FILE_SAVEPOINT};")
+            if self.manifest is not None:
+                self.manifest.begin(cur)
+            cur.close()
+
+    def rollback(self, datafiles, error):
+        """Roll back failed files to their savepoint.
+
+        The files are reported and recorded as 'failed' in the next
+        commit. Without savepoints (policy 'batch') the error is raised.
+
+        Parameters
+        ----------
+        datafiles : String List
+            description -> The failed files
+            format -> No apply
+            options -> No apply
+
+        error : Exception Instance
+            description -> The error raised by the load
+            format -> No apply
+            options -> No apply
+        """
+        if not self.policy.savepoints:
+            raise error
+
+        with metrics.stage("transactions:rollback", rows_in=len(datafiles)):
+            cur = self.conn.cursor()
+            cur.execute(f"ROLLBACK TO SAVEPOINT {FILE_SAVEPOINT};")
+            cur.execute(f"RELEASE SAVEPOINT {FILE_SAVEPOINT};")
+            if self.on_rollback is not None:
+                self.on_rollback(cur)
+            cur.close()
+
+        message = "".join(
+            traceback.format_exception(type(error), error, error.__traceback__)
+        )
+        for datafile in datafiles:
+            print(f"ERROR: The file '{datafile}' was rolled back!!! :c\n")
+        print(f"Error:\n{error}\n")
+        print(f"Complete log error:\n{message}\n")
+
+        self.failed.extend(datafiles)
+        self._add([(datafile, {}, "failed") for datafile in datafiles])
+
+    def release(self, loaded_files):
+        """Release the savepoint of the loaded files.
+
+        The files are committed if the policy requires it, with a
+        manifest the range of their songplays is closed
+        ('manifest.IngestManifest.end').
+
+        Parameters
+        ----------
+        loaded_files : Tuple List
+            description -> The loaded files and their number of records
+                by table
+            format -> [(<file_path>, {<table>: <records>})]
+            options -> No apply
+        """
+        if self.policy.savepoints or self.manifest is not None:
+            cur = self.conn.cursor()
+            if self.policy.savepoints:
+                cur.execute(f"RELEASE SAVEPOINT {FILE_SAVEPOINT};")
+            if self.manifest is not None:
+                self.manifest.end(
+                    cur, [datafile for datafile, _ in loaded_files]
+                )
+            cur.close()
+        self._add(
+            [(datafile, row_counts, "loaded")
+             for datafile, row_counts in loaded_files]
+        )
+
+    def commit(self):
+        """Record the loaded files in the manifest and commit.
+
+        With the rollups, the songplays loaded since the last commit are
+        added to the rollup tables in the same transaction.
+        """
+        if self.manifest is not None or self.rollups:
+            cur = self.conn.cursor()
+            if self.rollups:
+                songplay_rollups.refresh(cur)
+            if self.manifest is not None:
+                for datafile, row_counts, status in self._pending:
+                    self.manifest.record(cur, datafile, row_counts, status)
+            cur.close()
+        self.conn.commit()
+        self._pending = []
+        self.policy.reset()
+
+    def close(self):
+        """Commit the files loaded since the last commit."""
+        if self._pending:
+            self.commit()
+
+    def _add(self, processed_files):
+        """Account the processed files and commit them if it is due."""
+        for datafile, _, _ in processed_files:
+            self.policy.add(datafile)
+        self._pending.extend(processed_files)
+        if self.policy.is_due():
+            self.commit()